@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+
+"""Per record cost of walking a filter tree against running it compiled,
+with the clauses as written, sorted by static cost and adaptively reordered.
+The first column walks the tree the way it was before filters were
+compiled, converting each constant again for every record.
+
+  python benchmarks/bench_filter.py [--records N] [--repeat N]
+"""
+
+import argparse
+import collections
+import copy
+import datetime
+import gc
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import dateutil.parser
+
+import synthetic
+import qutiepy.filter.BaseTypes
+import qutiepy.filter.Compiler
+import qutiepy.filter.Parser
+from qutiepy.sge_accounting import SGEAccountingFile
+
+FILTERS = [
+  '(qname=all.q)',
+  '(submission_time > Jan 2015)',
+  '(and (submission_time.hour >= 9) (submission_time.hour < 12) (submission_time > Jan 2015) (not (qname=all.q)) (ru_wallclock>=300))',
+  '(or (owner*=se*) (job_name ~= /job_1[0-9]/) (failed != 0))',
+  '(and (job_name ~= /job_4[0-9]/) (end_time > Jan 2015) (mem > 10) (slots >= 2) (qname=gpu.q) (owner=bob))',
+]
+
+def per_record(run, records, repeat):
+  best = float('inf')
+  for i in range(repeat):
+    # fresh rows each pass so no decoded value is carried over
+    rows = [SGEAccountingFile.make_row(record) for record in records]
+
+    # as timeit does, a collection landing in one run but not another
+    # swamps the difference between them
+    gc.disable()
+    try:
+      start = time.time()
+      collections.deque(run(rows), 0)
+      best = min(best, time.time() - start)
+    finally:
+      gc.enable()
+
+  return best / len(records) * 1e6
+
+class PerRecordComparator(qutiepy.filter.BaseTypes.ComparatorFilter):
+  """The comparison as it was, the constant parsed for every record"""
+
+  def __call__(self, row):
+    value = self.fieldgetter(row)
+
+    t = type(value)
+    rhs = self.rhs
+    if t is datetime.datetime:
+      rhs = dateutil.parser.parse(self.rhs)
+
+    elif t is not str:
+      rhs = t(self.rhs)
+
+    return self.predicate(value, rhs)
+
+def uncached(tree):
+  """A copy of tree comparing with PerRecordComparator"""
+  if isinstance(tree, qutiepy.filter.BaseTypes.ComparatorFilter):
+    return PerRecordComparator(tree.predicate, tree.field, tree.rhs)
+
+  tree = copy.copy(tree)
+  if isinstance(tree, qutiepy.filter.BaseTypes.FilterAggrigator):
+    tree.filters = [uncached(f) for f in tree.filters]
+  return tree
+
+def filtered(predicate):
+  return lambda rows: itertools.ifilter(predicate, rows)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--records', type=int, default=20000)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  records = list(SGEAccountingFile.build_reader(synthetic.accounting_lines(args.records)))
+
+  print('{0:>8} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8}  filter (us per record)'.format(
+    'per-row', 'tree', 'compiled', 'sorted', 'adaptive', 'speedup'))
+  for text in FILTERS:
+    tree = qutiepy.filter.Parser.parse(text)
+    in_order = qutiepy.filter.Compiler.compile_filter(tree)
+    by_cost = qutiepy.filter.Compiler.compile_filter(tree, reorder=True)
+    adaptive = qutiepy.filter.Compiler.AdaptiveFilter(qutiepy.filter.Parser.parse(text))
+
+    expected = [bool(tree(SGEAccountingFile.make_row(r))) for r in records[:1000]]
+    for predicate in (in_order, by_cost):
+      assert expected == [bool(predicate(SGEAccountingFile.make_row(r))) for r in records[:1000]]
+
+    baseline = uncached(qutiepy.filter.Parser.parse(text))
+    assert expected == [bool(baseline(SGEAccountingFile.make_row(r))) for r in records[:1000]]
+
+    before = per_record(filtered(baseline), records, args.repeat)
+    times = [per_record(run, records, args.repeat)
+      for run in (filtered(tree), filtered(in_order), filtered(by_cost), adaptive.filter)]
+    print('{0:8.2f} {1:8.2f} {2:8.2f} {3:8.2f} {4:8.2f} {5:7.1f}x  {6}'.format(
+      before, times[0], times[1], times[2], times[3], before / min(times), text))
+
+if __name__ == '__main__':
+  main()
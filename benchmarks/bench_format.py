@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+
+"""Per record cost of the format stage, string.Formatter.vformat and a
+print() per record against the format string parsed once and written in
+large chunks, for the default qacct -j style template and a short csv one.
+
+  python benchmarks/bench_format.py [--records N] [--repeat N]
+"""
+
+import argparse
+import collections
+import os
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+import qutiepy.commands.format as fmt
+from qutiepy.sge_accounting import SGEAccountingFile
+
+TEMPLATES = [
+  ('default', fmt.DEFAULT_FORMAT),
+  ('csv', '{owner},{job_name},{slots},{waiting_time},{maxvmem!h}'),
+]
+
+class VFormatter(string.Formatter):
+  """The format stage as it was, the template parsed for every record"""
+
+  def __init__(self, format_str, stream):
+    self.format_str = format_str
+    self.stream = stream
+
+  def __call__(self, row):
+    print(self.vformat(self.format_str, row, row), file=self.stream)
+    return row
+
+  def convert_field(self, value, conversion):
+    if conversion == 'h':
+      return fmt.SI_Format(value)
+    return super(VFormatter, self).convert_field(value, conversion)
+
+def vformatted(format_str, stream):
+  return lambda rows: (VFormatter(format_str, stream)(row) for row in rows)
+
+def compiled(format_str, stream):
+  return lambda rows: fmt.format_row(argparse.Namespace(format_str=format_str, output=stream), rows)
+
+def per_record(run, records, repeat):
+  best = float('inf')
+  for i in range(repeat):
+    # fresh rows each pass so no decoded value is carried over
+    rows = [SGEAccountingFile.make_row(record) for record in records]
+
+    start = time.time()
+    collections.deque(run(rows), 0)
+    best = min(best, time.time() - start)
+
+  return best / len(records) * 1e6
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--records', type=int, default=20000)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  records = list(SGEAccountingFile.build_reader(synthetic.accounting_lines(args.records)))
+  devnull = open(os.devnull, 'w')
+
+  print('{0:>8} {1:>8} {2:>8}  template (us per record)'.format('vformat', 'compiled', 'speedup'))
+  for name, format_str in TEMPLATES:
+    rows = [SGEAccountingFile.make_row(record) for record in records[:1000]]
+    formatter = fmt._Formatter(format_str, devnull)
+    assert [formatter.format(row) for row in rows] == [
+      VFormatter(format_str, devnull).vformat(format_str, row, row) + '\n' for row in rows]
+
+    before = per_record(vformatted(format_str, devnull), records, args.repeat)
+    after = per_record(compiled(format_str, devnull), records, args.repeat)
+    print('{0:8.2f} {1:8.2f} {2:7.1f}x  {3}'.format(before, after, before / after, name))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from __future__ import division
+
+"""Time parsing large machine written filters, the per clause cost should
+stay flat as the expression grows.
+
+  python benchmarks/bench_parser.py [--clauses N [N ...]] [--repeat N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import qutiepy.filter.Parser
+
+CLAUSES = [
+  '(owner = user{0})',
+  '(job_number >= {0})',
+  '(job_name *= job_{0}*)',
+  '(qname ~= /q{0}$/I)',
+  '(hostname in node{0}, node{1})',
+]
+
+def expression(count, seed=0):
+  """An or of count clauses, grouped under nested ands and nots"""
+  rand = random.Random(seed)
+  parts = []
+  for i in range(count):
+    clause = rand.choice(CLAUSES).format(i, i + 1)
+    if i % 10 == 0:
+      clause = '(and {0} (not (slots > {1})))'.format(clause, i % 64)
+    parts.append(clause)
+
+  return '(or\n  {0}\n)'.format('\n  '.join(parts))
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--clauses', type=int, nargs='+', default=[1000, 10000, 50000])
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  print('{0:>8} {1:>10} {2:>10} {3:>10}'.format('clauses', 'chars', 'seconds', 'us/clause'))
+  for count in args.clauses:
+    text = expression(count)
+    best = float('inf')
+    for i in range(args.repeat):
+      start = time.time()
+      qutiepy.filter.Parser.parse(text)
+      best = min(best, time.time() - start)
+
+    print('{0:8d} {1:10d} {2:10.4f} {3:10.2f}'.format(count, len(text), best, best / count * 1e6))
+
+if __name__ == '__main__':
+  main()
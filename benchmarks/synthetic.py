@@ -0,0 +1,36 @@
+from __future__ import print_function
+
+"""Synthetic accounting records for the benchmarks"""
+
+import random
+
+OWNERS = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'sethsims']
+QUEUES = ['all.q', 'long.q', 'short.q', 'gpu.q']
+EPOCH = 1420070400
+
+def accounting_line(i, rand):
+  submission = EPOCH + i * 37
+  start = submission + rand.randint(0, 600)
+  end = start + rand.randint(1, 90000)
+
+  fields = [
+    rand.choice(QUEUES), 'node{0:02d}'.format(rand.randint(1, 32)), 'users',
+    rand.choice(OWNERS), 'job_{0}'.format(rand.randint(1, 50)), str(1000 + i), 'sge', '0',
+    str(submission), str(start), str(end),
+    str(rand.choice([0, 0, 0, 0, 100, 37])), str(rand.choice([0, 0, 0, 1, 137])),
+    str(end - start), '{0:.3f}'.format(rand.random() * 1000), '{0:.3f}'.format(rand.random() * 10),
+    '{0}.000000'.format(rand.randint(0, 10**7))]
+  fields += ['0'] * 7 + ['0.000000'] + ['0'] * 6
+  fields += [
+    'NONE', 'defaultdepartment', rand.choice(['NONE', 'smp', 'mpi']),
+    str(rand.choice([1, 1, 2, 4, 8, 16])), str(rand.choice([0, 1, 2])),
+    '{0:.3f}'.format(rand.random() * 10000), '{0:.6f}'.format(rand.random() * 100),
+    '{0:.6f}'.format(rand.random()), '-l h_vmem=4G', '0.000000', 'NONE',
+    '{0}.000000'.format(rand.randint(0, 10**9)), '0', '0']
+
+  return ':'.join(fields) + '\n'
+
+def accounting_lines(count, seed=0):
+  """count lines of an SGE accounting log, the same ones for the same seed"""
+  rand = random.Random(seed)
+  return [accounting_line(i, rand) for i in range(count)]
@@ -0,0 +1,181 @@
+from __future__ import print_function
+from __future__ import division
+
+"""Streaming accumulators for summarizing records.
+
+Each accumulator takes values one at a time and keeps a fixed amount of
+state however many it sees, so a group by over any number of records only
+costs memory per group. Two accumulators of the same kind can be merged,
+which is what lets partial results from separate runs or processes be
+combined."""
+
+import datetime
+
+import qutiepy.sketches as sketches
+
+class Accumulator(object):
+  """Base of the accumulators, name is what they are called on the command
+  line and in the headers of the results"""
+  name = None
+
+  def add(self, value):
+    raise NotImplementedError()
+
+  def merge(self, other):
+    raise NotImplementedError()
+
+  @property
+  def value(self):
+    raise NotImplementedError()
+
+  def headers(self, field):
+    """The names of the columns of values"""
+    return [self.name if field is None else '{0}_{1}'.format(self.name, field)]
+
+  @property
+  def values(self):
+    return [self.value]
+
+class Count(Accumulator):
+  name = 'count'
+
+  def __init__(self):
+    self.count = 0
+
+  def add(self, value):
+    self.count += 1
+
+  def merge(self, other):
+    self.count += other.count
+
+  @property
+  def value(self):
+    return self.count
+
+class Sum(Accumulator):
+  name = 'sum'
+
+  def __init__(self):
+    # None until a value is seen so sums of timedeltas work
+    self.total = None
+
+  def add(self, value):
+    self.total = value if self.total is None else self.total + value
+
+  def merge(self, other):
+    if other.total is not None:
+      self.add(other.total)
+
+  @property
+  def value(self):
+    return self.total
+
+class Min(Accumulator):
+  name = 'min'
+
+  def __init__(self):
+    self.least = None
+
+  def add(self, value):
+    if self.least is None or value < self.least:
+      self.least = value
+
+  def merge(self, other):
+    if other.least is not None:
+      self.add(other.least)
+
+  @property
+  def value(self):
+    return self.least
+
+class Max(Accumulator):
+  name = 'max'
+
+  def __init__(self):
+    self.greatest = None
+
+  def add(self, value):
+    if self.greatest is None or value > self.greatest:
+      self.greatest = value
+
+  def merge(self, other):
+    if other.greatest is not None:
+      self.add(other.greatest)
+
+  @property
+  def value(self):
+    return self.greatest
+
+class Mean(Accumulator):
+  name = 'mean'
+
+  def __init__(self):
+    self.total = Sum()
+    self.count = 0
+
+  def add(self, value):
+    self.total.add(value)
+    self.count += 1
+
+  def merge(self, other):
+    self.total.merge(other.total)
+    self.count += other.count
+
+  @property
+  def value(self):
+    if not self.count:
+      return None
+
+    total = self.total.value
+    if isinstance(total, datetime.timedelta):
+      # timedelta has no true division in python 2
+      return total // self.count
+    return total / self.count
+
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+
+class Quantiles(Accumulator):
+  """Approximate quantiles in fixed memory, see qutiepy.sketches.KLL for
+  the error bounds"""
+  name = 'quantile'
+
+  def __init__(self, quantiles=DEFAULT_QUANTILES):
+    self.quantiles = quantiles
+    self.sketch = sketches.KLL()
+
+  def add(self, value):
+    self.sketch.add(value)
+
+  def merge(self, other):
+    self.sketch.merge(other.sketch)
+
+  @property
+  def value(self):
+    return self.sketch.quantiles(self.quantiles)
+
+  def headers(self, field):
+    return ['p{0:g}_{1}'.format(q * 100, field) for q in self.quantiles]
+
+  @property
+  def values(self):
+    return self.value
+
+class Distinct(Accumulator):
+  """Approximate count of distinct values in fixed memory, see
+  qutiepy.sketches.HyperLogLog for the error bounds"""
+  name = 'distinct'
+
+  def __init__(self):
+    self.sketch = sketches.HyperLogLog()
+
+  def add(self, value):
+    self.sketch.add(value)
+
+  def merge(self, other):
+    self.sketch.merge(other.sketch)
+
+  @property
+  def value(self):
+    return len(self.sketch)
+
+ACCUMULATORS = dict((cls.name, cls) for cls in (Count, Sum, Min, Max, Mean, Quantiles, Distinct))
@@ -1,2 +1,8 @@
 from qutiepy.commands.filter import Filter
 from qutiepy.commands.format import Format
+from qutiepy.commands.aggregate import Aggregate
+from qutiepy.commands.topk import TopK
+from qutiepy.commands.export import Export
+from qutiepy.commands.sort import Sort
+from qutiepy.commands.top import Top
+from qutiepy.commands.serve import Serve
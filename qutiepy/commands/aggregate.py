@@ -0,0 +1,173 @@
+from __future__ import print_function
+
+import argparse
+import csv
+import functools
+import operator
+import textwrap
+
+import qutiepy.accumulators
+import qutiepy.sge_accounting
+from qutiepy.commands.Command import Command
+from qutiepy.commands.format import flush_outputs
+
+COMMAND_DESCRIPTION = '''\
+Aggregate groups the records in the stream by the values of some fields and
+keeps running totals for each group. The records are passed on untouched and
+the totals are written as csv, one row per group, once the stream ends.
+
+Available Variables:
+{field_list}
+
+ Variables that are complex python types can have any of their
+ attributes accessed, e.x. --by owner,end_time.month
+
+Accumulators:
+ - --count               records in the group
+ - --sum FIELD[,FIELD]   total of the field
+ - --min FIELD[,FIELD]   smallest value of the field
+ - --max FIELD[,FIELD]   largest value of the field
+ - --mean FIELD[,FIELD]  average of the field
+ - --quantile FIELD[,FIELD]
+                         approximate quantiles of the field, those
+                         listed by --quantiles
+ - --distinct FIELD[,FIELD]
+                         approximate count of the distinct values of
+                         the field
+
+ Each can be given more than once. With none at all the records are
+ counted. Every group keeps one running value per accumulator, memory
+ grows with the number of groups and not the number of records.
+
+ Quantiles come from a KLL sketch of about 600 values per group and
+ field. The rank of each answer is within about 1.7% of the one asked
+ for with 99% confidence, e.x. a p95 lies between the p93.3 and p96.7.
+
+ Distinct counts are exact up to 256 values, past that they come from a
+ 16KB HyperLogLog and are within 1.6% of the true count 95% of the time.
+
+ ex. qutiepy aggregate --by end_time.year,end_time.month --distinct owner
+
+ ex. qutiepy aggregate --by owner,qname --sum cpu --count --max maxvmem --mean waiting_time_sec
+'''.format(
+  field_list=textwrap.fill(
+    ", ".join(qutiepy.sge_accounting.SGEAccountingRow.fields()),
+    initial_indent=' '*2, subsequent_indent=' '*2
+    )
+)
+
+def _split_fields(value):
+  return [field.strip() for field in value.split(',') if field.strip()]
+
+def _split_quantiles(value):
+  try:
+    quantiles = tuple(float(q) for q in _split_fields(value))
+  except ValueError:
+    raise argparse.ArgumentTypeError('quantiles must be numbers: {0}'.format(value))
+
+  if not quantiles or not all(0 <= q <= 1 for q in quantiles):
+    raise argparse.ArgumentTypeError('quantiles must be between 0 and 1: {0}'.format(value))
+  return quantiles
+
+def _check_fields(fields):
+  known = qutiepy.sge_accounting.UGEAccountingRow.descriptors()
+  for field in fields:
+    if field.split('.')[0] not in known:
+      raise ValueError('aggregate: unknown field {0}'.format(field))
+
+def measures(namespace):
+  """(accumulator name, field) pairs in the order they were asked for, the
+  field is None for a count"""
+  measures = [(name, field) for name, fields in namespace.measures for field in fields]
+  if not measures:
+    measures.append(('count', None))
+  return measures
+
+class _Aggregator(object):
+  def __init__(self, by, measures, quantiles=qutiepy.accumulators.DEFAULT_QUANTILES):
+    self.by = by
+    self.measures = measures
+    self.groups = {}
+
+    self.key = (lambda row: ())
+    if by:
+      getter = operator.attrgetter(*by)
+      self.key = getter if len(by) > 1 else (lambda row: (getter(row),))
+
+    self.values = [operator.attrgetter(field) if field else (lambda row: None)
+      for name, field in measures]
+    self.factories = [qutiepy.accumulators.ACCUMULATORS[name] for name, field in measures]
+    self.factories = [functools.partial(factory, quantiles) if factory is qutiepy.accumulators.Quantiles else factory
+      for factory in self.factories]
+
+  def add(self, row):
+    key = self.key(row)
+    accumulators = self.groups.get(key)
+    if accumulators is None:
+      accumulators = self.groups[key] = [factory() for factory in self.factories]
+
+    for accumulator, value in zip(accumulators, self.values):
+      accumulator.add(value(row))
+
+  def header(self):
+    return self.by + [header for factory, (name, field) in zip(self.factories, self.measures)
+      for header in factory().headers(field)]
+
+  def results(self):
+    """A row of group values then accumulated values for each group"""
+    for key, accumulators in sorted(self.groups.iteritems()):
+      yield list(key) + [value for accumulator in accumulators for value in accumulator.values]
+
+def aggregate(namespace, filter_chain):
+  _check_fields(namespace.by)
+  _check_fields([field for name, field in measures(namespace) if field])
+
+  aggregator = _Aggregator(namespace.by, measures(namespace), namespace.quantiles)
+
+  def stream():
+    for row in filter_chain:
+      aggregator.add(row)
+      yield row
+
+    # lines format stages still hold go out before the totals
+    flush_outputs()
+    writer = csv.writer(namespace.output)
+    writer.writerow(aggregator.header())
+    writer.writerows(aggregator.results())
+    namespace.output.flush()
+
+  return stream()
+
+def fields(namespace):
+  """The fields of a record this stage reads"""
+  return set(field.split('.')[0]
+    for field in namespace.by + [field for name, field in measures(namespace) if field])
+
+class _AppendMeasure(argparse.Action):
+  def __call__(self, parser, namespace, values, option_string=None):
+    measures = list(getattr(namespace, self.dest) or [])
+    # a count takes no field
+    measures.append((self.const, _split_fields(values) if self.nargs != 0 else [None]))
+    setattr(namespace, self.dest, measures)
+
+class Aggregate(Command):
+  @classmethod
+  def register_self(cls, argparsers):
+    parser = argparsers.add_parser('aggregate',
+      help='Group records and total fields over each group',
+      description=COMMAND_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.set_defaults(func=aggregate, fields=fields, measures=[])
+
+    parser.add_argument('--by', type=_split_fields, default=[], dest='by', metavar='FIELD[,FIELD]',
+      help='Fields whose values make up the groups [Default: everything is one group]')
+    parser.add_argument('--count', nargs=0, action=_AppendMeasure, const='count', dest='measures',
+      help='Count the records in each group')
+    for name in ('sum', 'min', 'max', 'mean', 'quantile', 'distinct'):
+      parser.add_argument('--' + name, action=_AppendMeasure, const=name, dest='measures',
+        metavar='FIELD[,FIELD]', help='The {0} of the fields over each group'.format(name))
+    parser.add_argument('--quantiles', type=_split_quantiles, default=qutiepy.accumulators.DEFAULT_QUANTILES,
+      dest='quantiles', metavar='Q[,Q]',
+      help='The quantiles --quantile reports, fractions between 0 and 1 [Default: 0.5,0.95,0.99]')
+
+    parser.add_argument('-o', '--output', default='-', type=argparse.FileType('w'), dest='output',
+      help='Where the totals are written to [Default: stdout]')
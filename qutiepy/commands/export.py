@@ -0,0 +1,285 @@
+from __future__ import print_function
+
+import argparse
+import collections
+import csv
+import datetime
+import decimal
+import json
+import operator
+import sys
+import textwrap
+
+import qutiepy.sge_accounting
+from qutiepy.commands.Command import Command
+from qutiepy.commands.aggregate import _check_fields, _split_fields
+from qutiepy.commands.format import flush_outputs
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+try:
+  import pyarrow
+except ImportError:
+  pyarrow = None
+
+COMMAND_DESCRIPTION = '''\
+Export writes the records in the stream to a file other tools can load
+without parsing text, a batch of records at a time. The records are passed
+on untouched.
+
+Available Variables:
+{field_list}
+
+ Variables that are complex python types can have any of their
+ attributes accessed, e.x. --fields owner,end_time.year
+
+Output types:
+ - csv        a header of the field names then a row per record
+ - jsonl      a json object per line, keyed by field name in no
+              particular order
+ - npz        a numpy array per field, numpy.load() reads it back, needs
+              numpy and -o
+ - arrow-ipc  an Arrow IPC file of record batches, pyarrow.ipc.open_file()
+              reads it back, needs pyarrow
+
+ Values keep their types. Times are written as ISO 8601 local times in
+ csv and jsonl and as datetime64[us] and timestamp[us] columns in npz and
+ arrow-ipc. Intervals like waiting_time are seconds in csv and jsonl.
+ failed is its error number, decimals are floats except in csv.
+
+ ex. qutiepy export --as csv --fields owner,job_name,cpu,end_time -o jobs.csv
+
+ ex. qutiepy filter '(end_time > Jan 2015)' export --as npz -o jobs.npz
+'''.format(
+  field_list=textwrap.fill(
+    ", ".join(qutiepy.sge_accounting.SGEAccountingRow.fields()),
+    initial_indent=' '*2, subsequent_indent=' '*2
+    )
+)
+
+# records are written this many at a time
+BATCH_ROWS = 65536
+
+def default_fields():
+  """The fields of an SGE accounting line in the order they are written"""
+  descriptors = qutiepy.sge_accounting.SGEAccountingRow.descriptors()
+  return [name for pos, name in sorted(
+    (field.pos, name) for name, field in descriptors.items() if field.pos is not None)]
+
+def _seconds(delta):
+  return delta.total_seconds()
+
+def value_kind(value):
+  """What a field holds going by one of its values"""
+  if isinstance(value, bool) or isinstance(value, (int, long)):
+    return 'int'
+  if isinstance(value, (float, decimal.Decimal)):
+    return 'float'
+  if isinstance(value, datetime.datetime):
+    return 'datetime'
+  if isinstance(value, datetime.timedelta):
+    return 'timedelta'
+  if isinstance(value, qutiepy.sge_accounting.GEFailedField):
+    return 'failed'
+  return 'str'
+
+# kind -> value -> plain python value for csv, None if written as it is
+CSV_VALUES = {
+  'failed': operator.attrgetter('errno'),
+  'datetime': datetime.datetime.isoformat,
+  'timedelta': _seconds,
+}
+
+# kind -> value -> plain python value for json
+JSON_VALUES = dict(CSV_VALUES, float=float, str=str)
+
+# kind -> (numpy dtype, value -> value numpy takes)
+NUMPY_TYPES = {
+  'int': ('i8', None),
+  'float': ('f8', float),
+  'failed': ('i8', operator.attrgetter('errno')),
+  'datetime': ('M8[us]', None),
+  'timedelta': ('m8[us]', None),
+  'str': (None, str),
+}
+
+def _converted(columns, kinds, converters):
+  """columns with the values of each kind run through its converter"""
+  for column, kind in zip(columns, kinds):
+    convert = converters.get(kind)
+    yield column if convert is None else [convert(value) for value in column]
+
+class _Writer(object):
+  """Writes batches of records, each a list of value tuples in field
+  order. kinds is set from the first record before the first batch"""
+
+  def __init__(self, fields, output):
+    self.fields = fields
+    self.output = output
+    self.kinds = None
+
+  def write(self, records):
+    raise NotImplementedError()
+
+  def close(self):
+    self.output.flush()
+
+class _CsvWriter(_Writer):
+  """The header goes out with the first batch, or on close if there is
+  none, so output from earlier stages that is flushed first comes before it"""
+
+  def __init__(self, fields, output):
+    super(_CsvWriter, self).__init__(fields, output)
+    self.writer = csv.writer(output)
+    self.header = False
+
+  def write_header(self):
+    if not self.header:
+      self.writer.writerow(self.fields)
+      self.header = True
+
+  def write(self, records):
+    if any(kind in CSV_VALUES for kind in self.kinds):
+      records = zip(*_converted(zip(*records), self.kinds, CSV_VALUES))
+    self.write_header()
+    self.writer.writerows(records)
+
+  def close(self):
+    self.write_header()
+    super(_CsvWriter, self).close()
+
+class _JsonLinesWriter(_Writer):
+  def __init__(self, fields, output):
+    super(_JsonLinesWriter, self).__init__(fields, output)
+    self.encode = json.JSONEncoder(separators=(',', ':')).encode
+
+  def write(self, records):
+    records = zip(*_converted(zip(*records), self.kinds, JSON_VALUES))
+    fields = self.fields
+    # a plain dict, python 2's OrderedDict is too slow to build per record
+    self.output.write(''.join(self.encode(dict(zip(fields, record))) + '\n' for record in records))
+
+class _NpzWriter(_Writer):
+  """Keeps an array per field and batch, they are joined and written out
+  once the stream ends since npz is a zip file"""
+
+  def __init__(self, fields, output):
+    if numpy is None:
+      raise ValueError('export: --as npz needs numpy installed')
+    if output is sys.stdout:
+      raise ValueError('export: --as npz needs a file to write to, -o')
+
+    super(_NpzWriter, self).__init__(fields, output)
+    self.batches = [[] for field in fields]
+
+  def write(self, records):
+    for batches, column, kind in zip(self.batches, zip(*records), self.kinds):
+      dtype, convert = NUMPY_TYPES[kind]
+      batches.append(numpy.array(column if convert is None else [convert(value) for value in column], dtype))
+
+  def close(self):
+    arrays = dict((field, numpy.concatenate(batches) if batches else numpy.zeros(0))
+      for field, batches in zip(self.fields, self.batches))
+    numpy.savez(self.output, **arrays)
+    super(_NpzWriter, self).close()
+
+class _ArrowWriter(_Writer):
+  """Writes each batch as an Arrow record batch"""
+
+  def __init__(self, fields, output):
+    if pyarrow is None:
+      raise ValueError('export: --as arrow-ipc needs pyarrow installed')
+
+    super(_ArrowWriter, self).__init__(fields, output)
+    self.writer = None
+
+  def _types(self):
+    return {
+      'int': pyarrow.int64(),
+      'float': pyarrow.float64(),
+      'failed': pyarrow.int64(),
+      'datetime': pyarrow.timestamp('us'),
+      'timedelta': pyarrow.duration('us'),
+      'str': pyarrow.string(),
+    }
+
+  def write(self, records):
+    types = self._types()
+    if self.writer is None:
+      self.schema = pyarrow.schema([pyarrow.field(field, types[kind])
+        for field, kind in zip(self.fields, self.kinds)])
+      self.writer = pyarrow.RecordBatchFileWriter(self.output, self.schema)
+
+    columns = _converted(zip(*records), self.kinds, {
+      'float': float, 'failed': operator.attrgetter('errno')})
+    self.writer.write_batch(pyarrow.RecordBatch.from_arrays(
+      [pyarrow.array(column, types[kind]) for column, kind in zip(columns, self.kinds)],
+      self.fields))
+
+  def close(self):
+    if self.writer is None:
+      self.writer = pyarrow.RecordBatchFileWriter(self.output,
+        pyarrow.schema([pyarrow.field(field, pyarrow.string()) for field in self.fields]))
+    self.writer.close()
+    super(_ArrowWriter, self).close()
+
+WRITERS = collections.OrderedDict([
+  ('csv', _CsvWriter),
+  ('jsonl', _JsonLinesWriter),
+  ('npz', _NpzWriter),
+  ('arrow-ipc', _ArrowWriter),
+])
+
+def export(namespace, filter_chain):
+  fields = namespace.names or default_fields()
+  _check_fields(fields)
+
+  writer = WRITERS[namespace.format](fields, namespace.output)
+  getter = operator.attrgetter(*fields)
+  values = getter if len(fields) > 1 else (lambda row: (getter(row),))
+
+  def write(batch):
+    # lines format stages hold for the records before these go out first
+    flush_outputs()
+    if writer.kinds is None:
+      writer.kinds = [value_kind(value) for value in batch[0]]
+    writer.write(batch)
+
+  def stream():
+    batch = []
+    for row in filter_chain:
+      batch.append(values(row))
+      if len(batch) >= BATCH_ROWS:
+        write(batch)
+        batch = []
+      yield row
+
+    if batch:
+      write(batch)
+    flush_outputs()
+    writer.close()
+
+  return stream()
+
+def fields(namespace):
+  """The fields of a record this stage reads"""
+  return set(field.split('.')[0] for field in namespace.names or default_fields())
+
+class Export(Command):
+  @classmethod
+  def register_self(cls, argparsers):
+    parser = argparsers.add_parser('export',
+      help='Write records as csv, json lines, npz or Arrow',
+      description=COMMAND_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.set_defaults(func=export, fields=fields)
+
+    parser.add_argument('--as', choices=list(WRITERS), default='csv', dest='format',
+      help='What to write [Default: csv]')
+    parser.add_argument('--fields', type=_split_fields, default=[], dest='names', metavar='FIELD[,FIELD]',
+      help='The fields to write [Default: every field of an SGE accounting line]')
+
+    parser.add_argument('-o', '--output', default='-', type=argparse.FileType('wb'), dest='output',
+      help='Where the records are written to [Default: stdout]')
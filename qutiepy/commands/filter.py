@@ -1,16 +1,17 @@
 from __future__ import print_function
 
 import argparse
-import itertools
 import textwrap
 
+import qutiepy.filter.Compiler
 import qutiepy.filter.Parser
 import qutiepy.sge_accounting
 from qutiepy.commands.Command import Command
 
 COMMAND_DESCRIPTION = '''\
 Filter allows records to be dropped from the stream based on expressive
-rules with a lisp/ldap like syntax.
+rules with a lisp/ldap like syntax. The filter can be read from a file by
+passing @file instead.
 
 Available Variables:
 {field_list}
@@ -27,6 +28,8 @@ Operators:
  Supported by All Types
  - (var = value) equality
  - (var != value) inequality
+ - (var in value[, value...]) equal to any of the listed values
+ - (var in @file) equal to any line of file, blank and # lines are skipped
  Strings
  - (var ~= /<regex>/<flags>) Regex match using the Python re syntax
   See notes on regex below
@@ -55,6 +58,14 @@ Conjunctions:
  - (and predicate [[predicate]...])
  - (or predicate [[predicate]...])
  - (not predicate [[predicate]...])
+
+ Equality and glob tests of one variable under an or are merged into
+ a single lookup.
+
+ Conjunctions stop at the first predicate that decides them. Predicates
+ are run in the order they are written. With --reorder the cheapest and
+ most often deciding are run first, as measured on samples of the
+ records, when that turns out faster.
 '''.format(
   field_list=textwrap.fill(
     ", ".join(qutiepy.sge_accounting.SGEAccountingRow.fields()),
@@ -63,8 +74,17 @@ Conjunctions:
 )
 
 def filter(namespace, filter_chain):
-  filter = getattr(namespace, 'filter_str')
-  return itertools.ifilter(filter, filter_chain)
+  return qutiepy.filter.Compiler.filter_rows(namespace.filter_str, filter_chain, namespace.reorder)
+
+def pushdown(namespace):
+  """The (filter tree, reorder) a record reader runs in place of this stage"""
+  # compiled here so a bad constant is reported now rather than by a worker
+  qutiepy.filter.Compiler.compile_filter(namespace.filter_str)
+  return namespace.filter_str, namespace.reorder
+
+def fields(namespace):
+  """The fields of a record this stage reads"""
+  return qutiepy.filter.Compiler.referenced_fields(namespace.filter_str)
 
 class Filter(Command):
   @classmethod
@@ -72,6 +92,8 @@ class Filter(Command):
     parser = argparsers.add_parser('filter',
       help='Drop records that do not match the given filter',
       description=COMMAND_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
-    parser.set_defaults(func=filter)
+    parser.set_defaults(func=filter, pushdown=pushdown, fields=fields)
 
-    parser.add_argument('filter_str', nargs=1, action=qutiepy.filter.Parser.Parser)
+    parser.add_argument('--reorder', action='store_true', default=False,
+      help='Run the predicates in the order measured to be fastest rather than as written')
+    parser.add_argument('filter_str', nargs=1, action=qutiepy.filter.Parser.Parser, metavar='filter|@file')
@@ -1,7 +1,9 @@
 from __future__ import print_function
 
 import argparse
-import itertools
+import functools
+import operator
+import re
 import string
 import textwrap
 import sys
@@ -9,67 +11,216 @@ import sys
 import qutiepy.sge_accounting
 from qutiepy.commands.Command import Command
 
+def human(value):
+  """value scaled down or up to between 1 and 1000 and its metric prefix"""
+  prefix = ''
+
+  temp = abs(value)
+  if temp != 0:
+    if temp >= 1000:
+      i = 0
+      while temp >= 1000 and i < len(SI_Format.big_prefixes):
+        i += 1
+        temp /= 1000
+
+      prefix = SI_Format.big_prefixes[i]
+
+    elif temp < 0.01:
+      i = 0
+      while temp < 1 and i < len(SI_Format.small_prefixes):
+        i += 1
+        temp *= 1000
+
+      prefix = SI_Format.small_prefixes[i]
+
+  return temp, prefix
+
+def format_human(value, spec):
+  """value formatted like {value!h:spec}"""
+  temp, prefix = human(value)
+  # limit to 4 sigfigs for general printing
+  return format(temp, spec or '.4g') + prefix
+
 class SI_Format(object):
   big_prefixes = ['', 'K', 'M', 'G', 'T', 'E', 'Z', 'Y']
   small_prefixes = ['m', 'u', 'n', 'p', 'f', 'a', 'z', 'y']
 
   def __init__(self, value):
-    self.prefix = ''
+    self.value, self.prefix = human(value)
+
+  def __format__(self, spec):
+    return format(self.value, spec or '.4g') + self.prefix
 
-    temp = abs(value)
-    if temp != 0:
-      if temp >= 1000:
-        i = 0
-        while temp >= 1000 and i < len(SI_Format.big_prefixes):
-          i += 1
-          temp /= 1000
+# output is written in chunks of about this many bytes
+BUFFER_BYTES = 1 << 20
 
-        self.prefix = SI_Format.big_prefixes[i]
+class _BufferedOutput(object):
+  """Collects lines for a stream and writes them in large chunks. Every
+  stage writing to the same stream shares one, so their lines stay in the
+  order they were made"""
+  outputs = {}
 
-      elif temp < 0.01:
-        i = 0
-        while temp < 1 and i < len(SI_Format.small_prefixes):
-          i += 1
-          temp *= 1000
+  def __init__(self, stream):
+    self.stream = stream
+    self.chunks = []
+    self.size = 0
 
-        self.prefix = SI_Format.small_prefixes[i]
+  @classmethod
+  def of(cls, stream):
+    output = cls.outputs.get(stream)
+    if output is None:
+      output = cls.outputs[stream] = cls(stream)
+    return output
 
-    self.value = temp
+  def write(self, text):
+    self.chunks.append(text)
+    self.size += len(text)
+    if self.size >= BUFFER_BYTES:
+      self.flush()
 
-  def __format__(self, spec):
-    # limit to 4 sigfigs for general printing
-    tmp_spec = spec
-    if not spec:
-      tmp_spec = '.4g'
+  def flush(self):
+    if self.chunks:
+      self.stream.write(''.join(self.chunks))
+      self.chunks = []
+      self.size = 0
+    self.stream.flush()
+
+def flush_outputs():
+  """Write out the lines every format stage has collected so far"""
+  for output in _BufferedOutput.outputs.values():
+    output.flush()
+
+# a field that is a record field followed by attributes, e.x. failed.full
+_ATTRIBUTE_FIELD = re.compile(r'[A-Za-z_]\w*(\.[A-Za-z_]\w*)*$')
+
+def _item_getter(field):
+  """Looks up field in a row the way string.Formatter does"""
+  first, rest = field._formatter_field_name_split()
+  rest = list(rest)
+
+  def get(row):
+    value = row[first]
+    for is_attr, key in rest:
+      value = getattr(value, key) if is_attr else value[key]
+    return value
+
+  return get
+
+class _Formatter(object):
+  """A format string parsed once.
 
-    return '{0}{1}'.format(
-      format(self.value, tmp_spec),
-      self.prefix)
+  The string is rewritten with every field replaced by its position, so
+  {owner} {maxvmem!h}b becomes {0} {1}b. Each record is formatted by looking
+  its values up, all of the plain field.attribute ones with a single
+  attrgetter, and handing them to str.format, which does the rest in C.
+  Values converted with !h are formatted beforehand unless their spec has
+  fields of its own."""
 
-class _Formatter(string.Formatter):
   def __init__(self, format_str, stream):
     self.format_str = format_str
 
     self.stream = stream
     if type(stream) is list:
       self.stream = stream[-1]
+    self.output = _BufferedOutput.of(self.stream)
+
+    self.fields = []
+    self.converters = []
+    self.template = self._rewrite(format_str) + '\n'
+
+    descriptors = qutiepy.sge_accounting.UGEAccountingRow.descriptors()
+    if all(_ATTRIBUTE_FIELD.match(field) and field.split('.')[0] in descriptors for field in self.fields):
+      getter = operator.attrgetter(*self.fields) if self.fields else (lambda row: ())
+      self.values = getter if len(self.fields) != 1 else (lambda row: (getter(row),))
+    else:
+      getters = [_item_getter(field) for field in self.fields]
+      self.values = lambda row: [get(row) for get in getters]
+
+  def _rewrite(self, format_str):
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(format_str):
+      parts.append(literal.replace('{', '{{').replace('}', '}}'))
+      if field is None:
+        continue
+
+      index = len(self.fields)
+      self.fields.append(field)
+
+      if conversion == 'h':
+        if '{' in spec:
+          self.converters.append((index, SI_Format))
+        else:
+          self.converters.append((index, functools.partial(format_human, spec=spec)))
+          spec = ''
+        conversion = None
+
+      parts.append('{' + str(index))
+      if conversion:
+        parts.append('!' + conversion)
+      if spec:
+        parts.append(':' + self._rewrite(spec))
+      parts.append('}')
+
+    return ''.join(parts)
+
+  def format(self, row):
+    values = self.values(row)
+    if self.converters:
+      values = list(values)
+      for index, convert in self.converters:
+        values[index] = convert(values[index])
+    return self.template.format(*values)
 
   def __call__(self, row):
-    print(self.vformat(self.format_str, row, row), file=self.stream)
+    self.output.write(self.format(row))
     return row
 
-  def convert_field(self, value, conversion):
-    if conversion == 'h':
-      return SI_Format(value)
-
-    return super(_Formatter, self).convert_field(value, conversion)
+  def flush(self):
+    self.output.flush()
 
 def format_row(namespace, filter_chain):
-  return itertools.imap(
-    _Formatter(
-      namespace.format_str,
-      namespace.output),
-    filter_chain)
+  formatter = _Formatter(namespace.format_str, namespace.output)
+  write = formatter.output.write
+  render = formatter.format
+
+  def stream():
+    try:
+      for row in filter_chain:
+        write(render(row))
+        yield row
+    finally:
+      formatter.flush()
+
+  return stream()
+
+def format_fields(format_str):
+  """The fields of a record format_str reads or None if it can't be told,
+  when it has positional fields like {0}"""
+  fields = set()
+  try:
+    for literal, field, spec, conversion in string.Formatter().parse(format_str):
+      if field is None:
+        continue
+
+      name = re.match(r'[^.\[]*', field).group()
+      if not name or name.isdigit():
+        return None
+      fields.add(name)
+
+      # a spec like {start_time:{fmt}} can have fields of its own
+      nested = format_fields(spec)
+      if nested is None:
+        return None
+      fields.update(nested)
+
+  except ValueError:
+    return None
+
+  return fields
+
+def fields(namespace):
+  """The fields of a record this stage reads"""
+  return format_fields(namespace.format_str)
 
 COMMAND_DESCRIPTION = '''\
 Format turns records from a stream into strings.
@@ -160,7 +311,7 @@ class Format(Command):
     parser = argparsers.add_parser('format',
       help='Format records as strings',
       description=COMMAND_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
-    parser.set_defaults(func=format_row)
+    parser.set_defaults(func=format_row, fields=fields)
 
     parser.add_argument('-o', '--output', nargs=1,
       default='-', type=argparse.FileType('w'), dest='output',
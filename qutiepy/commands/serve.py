@@ -0,0 +1,46 @@
+from __future__ import print_function
+
+import argparse
+import os
+
+import qutiepy.sge_server
+from qutiepy.commands.Command import Command
+
+COMMAND_DESCRIPTION = '''\
+Serve keeps the records that reach it in memory and answers queries about
+them on a Unix domain socket until interrupted. It has to be the last
+pipeline component. Queries are qutiepy command lines run with --connect,
+their pipeline components run in the server and their output comes back.
+
+ With --follow the whole live accounting file is read and records written
+ to it are added as they come, queries are taken once it has been read to
+ its end. The submission, start and end times of every 1024 records are
+ indexed, leading filters on those times only look at the records that can
+ match.
+
+ The logs are read as text, --cache can't be used.
+
+ The socket can only be used by the user running the server, chmod it to
+ share it. Queries run as that user, files written with -o included.
+
+ ex. qutiepy --follow serve /run/qutiepy.sock
+     qutiepy --connect /run/qutiepy.sock filter '(end_time > Oct 2015)' aggregate --by owner
+'''
+
+def serve(namespace, filter_chain):
+  directory = os.path.dirname(os.path.abspath(namespace.socket_path))
+  if not os.path.isdir(directory):
+    raise ValueError('serve: {0} is not a directory'.format(directory))
+
+  return qutiepy.sge_server.RecordServer(namespace.socket_path, filter_chain)
+
+class Serve(Command):
+  @classmethod
+  def register_self(cls, argparsers):
+    parser = argparsers.add_parser('serve',
+      help='Answer queries about the records in memory over a Unix domain socket',
+      description=COMMAND_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.set_defaults(func=serve, whole_log=True)
+
+    parser.add_argument('socket_path', metavar='SOCKET',
+      help='Where the socket is created, a stale one left there is replaced')
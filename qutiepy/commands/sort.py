@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+import argparse
+import operator
+import os
+import textwrap
+
+import qutiepy.sge_accounting
+import qutiepy.sge_sort
+from qutiepy.commands.Command import Command
+from qutiepy.commands.aggregate import _check_fields, _split_fields
+
+COMMAND_DESCRIPTION = '''\
+Sort orders the records in the stream by the values of some fields before
+passing them on. Records with equal keys keep the order they came in.
+
+Available Variables:
+{field_list}
+
+ Variables that are complex python types can have any of their
+ attributes accessed, e.x. --key end_time.day,maxvmem
+
+ Records are held in memory up to --buffer-size, past that each sorted
+ batch is spilled to a compressed temporary file and the files are merged
+ at the end. Memory stays bounded however many records there are, the
+ temporary files take a fraction of the size of the log.
+
+ ex. qutiepy sort --key maxvmem --reverse format '{{owner}} {{job_number}} {{maxvmem!h}}b'
+'''.format(
+  field_list=textwrap.fill(
+    ", ".join(qutiepy.sge_accounting.SGEAccountingRow.fields()),
+    initial_indent=' '*2, subsequent_indent=' '*2
+    )
+)
+
+def _megabytes(value):
+  try:
+    size = int(value)
+  except ValueError:
+    size = 0
+
+  if size < 1:
+    raise argparse.ArgumentTypeError('must be a whole number of megabytes above 0: {0}'.format(value))
+  return size
+
+def sort(namespace, filter_chain):
+  _check_fields(namespace.key)
+  if namespace.temporary_directory and not os.path.isdir(namespace.temporary_directory):
+    raise ValueError('sort: {0} is not a directory'.format(namespace.temporary_directory))
+
+  sorter = qutiepy.sge_sort.ExternalSorter(operator.attrgetter(*namespace.key), namespace.reverse,
+    namespace.buffer_size * 2**20, namespace.temporary_directory)
+
+  def stream():
+    for row in filter_chain:
+      sorter.add(row)
+
+    for row in sorter:
+      yield row
+
+  return stream()
+
+def fields(namespace):
+  """The fields of a record this stage reads"""
+  return set(field.split('.')[0] for field in namespace.key)
+
+class Sort(Command):
+  @classmethod
+  def register_self(cls, argparsers):
+    parser = argparsers.add_parser('sort',
+      help='Order records by the values of some fields',
+      description=COMMAND_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.set_defaults(func=sort, fields=fields)
+
+    parser.add_argument('--key', type=_split_fields, required=True, dest='key', metavar='FIELD[,FIELD]',
+      help='Fields to order by, the first one first')
+    parser.add_argument('-r', '--reverse', action='store_true', default=False, dest='reverse',
+      help='Largest first')
+    parser.add_argument('-S', '--buffer-size', type=_megabytes, default=qutiepy.sge_sort.DEFAULT_BUFFER_MB,
+      dest='buffer_size', metavar='MB',
+      help='About how much memory the records held at once take [Default: %(default)sMB]')
+    parser.add_argument('-T', '--temporary-directory', default=None, dest='temporary_directory', metavar='DIR',
+      help='Where sorted runs are spilled to [Default: $TMPDIR or /tmp]')
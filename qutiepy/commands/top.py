@@ -0,0 +1,77 @@
+from __future__ import print_function
+
+import argparse
+import heapq
+import itertools
+import operator
+import textwrap
+
+import qutiepy.sge_accounting
+from qutiepy.commands.Command import Command
+from qutiepy.commands.aggregate import _check_fields, _split_fields
+from qutiepy.commands.topk import _positive
+from qutiepy.sge_sort import Descending
+
+COMMAND_DESCRIPTION = '''\
+Top passes on only the N records with the largest values of some fields,
+largest first. Records with equal values keep the order they came in.
+
+Available Variables:
+{field_list}
+
+ Variables that are complex python types can have any of their
+ attributes accessed, e.x. --by end_time.month,maxvmem
+
+ Only the N records kept so far are held, as their raw fields rather
+ than whole records, so memory depends on N and not on the input.
+
+ ex. qutiepy filter '(end_time > Oct 2015)' top -n 100 --by maxvmem format '{{owner}} {{job_number}} {{maxvmem!h}}b'
+'''.format(
+  field_list=textwrap.fill(
+    ", ".join(qutiepy.sge_accounting.SGEAccountingRow.fields()),
+    initial_indent=' '*2, subsequent_indent=' '*2
+    )
+)
+
+def top(namespace, filter_chain):
+  _check_fields(namespace.by)
+
+  key = operator.attrgetter(*namespace.by)
+  if namespace.bottom:
+    key = lambda row, key=key: Descending(key(row))
+  n = namespace.n
+
+  def stream():
+    # (key, -seq, row class, raw row), the least is dropped first so of
+    # equal keys the later record goes
+    heap = []
+    for seq, row in itertools.izip(itertools.count(), filter_chain):
+      value = key(row)
+      if len(heap) < n:
+        heapq.heappush(heap, (value, -seq, type(row), row._rawrow))
+      elif heap[0][0] < value:
+        heapq.heapreplace(heap, (value, -seq, type(row), row._rawrow))
+
+    for value, seq, cls, raw in sorted(heap, reverse=True):
+      yield cls(raw)
+
+  return stream()
+
+def fields(namespace):
+  """The fields of a record this stage reads"""
+  return set(field.split('.')[0] for field in namespace.by)
+
+class Top(Command):
+  @classmethod
+  def register_self(cls, argparsers):
+    parser = argparsers.add_parser('top',
+      help='Keep the N records with the largest values of some fields',
+      description=COMMAND_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.set_defaults(func=top, fields=fields)
+
+    parser.add_argument('-n', type=_positive, default=10, dest='n',
+      help='How many records are kept [Default: 10]')
+    parser.add_argument('--by', type=_split_fields, required=True, dest='by', metavar='FIELD[,FIELD]',
+      help='Fields to rank by, the first one first')
+    parser.add_argument('--bottom', action='store_true', default=False, dest='bottom',
+      help='Keep the records with the smallest values instead, smallest first')
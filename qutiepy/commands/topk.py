@@ -0,0 +1,103 @@
+from __future__ import print_function
+
+import argparse
+import csv
+import operator
+import textwrap
+
+import qutiepy.sge_accounting
+import qutiepy.sketches
+from qutiepy.commands.Command import Command
+from qutiepy.commands.aggregate import _check_fields, _split_fields
+from qutiepy.commands.format import flush_outputs
+
+COMMAND_DESCRIPTION = '''\
+Topk finds the keys with the most weight in the stream, the owners using
+the most cpu say, in fixed memory however many distinct keys there are. The
+records are passed on untouched and the top keys are written as csv once the
+stream ends.
+
+Available Variables:
+{field_list}
+
+ Variables that are complex python types can have any of their
+ attributes accessed, e.x. --key owner,end_time.year
+
+ Counters are kept for --counters keys at most, a new key takes over the
+ counter of the lightest one (Space-Saving). Each weight reported is at
+ least the key's true total and at most its error column more, the error
+ is never more than the total weight / --counters. Any key with more than
+ that share of the total is sure to be reported. guaranteed is True when a
+ key is surely in the true top k.
+
+ ex. qutiepy topk --key owner --weight cpu -k 20
+
+ ex. qutiepy topk --key owner,job_name -k 50 --counters 10000
+'''.format(
+  field_list=textwrap.fill(
+    ", ".join(qutiepy.sge_accounting.SGEAccountingRow.fields()),
+    initial_indent=' '*2, subsequent_indent=' '*2
+    )
+)
+
+def _positive(value):
+  try:
+    number = int(value)
+  except ValueError:
+    number = 0
+
+  if number < 1:
+    raise argparse.ArgumentTypeError('must be a whole number above 0: {0}'.format(value))
+  return number
+
+def topk(namespace, filter_chain):
+  _check_fields(namespace.key + ([namespace.weight] if namespace.weight else []))
+  if namespace.counters < namespace.k:
+    raise ValueError('topk: --counters must be at least -k')
+
+  sketch = qutiepy.sketches.SpaceSaving(namespace.counters)
+  key = operator.attrgetter(*namespace.key)
+  weight = operator.attrgetter(namespace.weight) if namespace.weight else (lambda row: 1)
+
+  def stream():
+    for row in filter_chain:
+      sketch.add(key(row), weight(row))
+      yield row
+
+    # lines format stages still hold go out before the top keys
+    flush_outputs()
+    writer = csv.writer(namespace.output)
+    writer.writerow(namespace.key + [namespace.weight or 'count', 'error', 'guaranteed'])
+    for value, total, error, guaranteed in sketch.top(namespace.k):
+      values = list(value) if len(namespace.key) > 1 else [value]
+      writer.writerow(values + [total, error, guaranteed])
+    namespace.output.flush()
+
+  return stream()
+
+def fields(namespace):
+  """The fields of a record this stage reads"""
+  return set(field.split('.')[0]
+    for field in namespace.key + ([namespace.weight] if namespace.weight else []))
+
+class TopK(Command):
+  @classmethod
+  def register_self(cls, argparsers):
+    parser = argparsers.add_parser('topk',
+      help='Find the keys with the most weight in fixed memory',
+      description=COMMAND_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.set_defaults(func=topk, fields=fields)
+
+    parser.add_argument('--key', type=_split_fields, required=True, dest='key', metavar='FIELD[,FIELD]',
+      help='Fields whose values make up the keys')
+    parser.add_argument('--weight', default=None, dest='weight', metavar='FIELD',
+      help='A numeric field totalled for each key [Default: the records are counted]')
+    parser.add_argument('-k', type=_positive, default=10, dest='k',
+      help='How many keys are reported [Default: 10]')
+    parser.add_argument('--counters', type=_positive, default=qutiepy.sketches.DEFAULT_COUNTERS,
+      dest='counters', metavar='N',
+      help='How many keys are counted at once, the error falls as this rises [Default: {0}]'.format(
+        qutiepy.sketches.DEFAULT_COUNTERS))
+
+    parser.add_argument('-o', '--output', default='-', type=argparse.FileType('w'), dest='output',
+      help='Where the top keys are written to [Default: stdout]')
@@ -1,15 +1,24 @@
 #!/usr/bin/env python
+from __future__ import absolute_import
 from __future__ import print_function
 
 import collections
 import itertools
 import csv
 import bisect
+import multiprocessing
+import signal
 
 import argparse
-import fileinput
+import os
 
 import qutiepy.sge_accounting
+import qutiepy.sge_cache
+import qutiepy.sge_common
+import qutiepy.sge_dedup
+import qutiepy.sge_parallel
+import qutiepy.sge_rollup
+import qutiepy.sketches
 
 class histogram(object):
     def __init__(self, *bins):
@@ -19,18 +28,44 @@ class histogram(object):
     def count(self, key, delta):
         self.histo[bisect.bisect_right(self.bins, key)] += delta
 
+    def merge(self, other):
+        if self.bins != other.bins:
+            raise ValueError('Only histograms with the same bins can be merged')
+
+        for k, v in other.histo.iteritems():
+            self.histo[k] += v
+
     def __iter__(self):
+        # count() files a key under the number of bins at or below it
         return itertools.imap(lambda k: self.histo[k],
-            self.bins)
+            xrange(len(self.bins) + 1))
 
     def get_headers(self):
-        sec = itertools.tee(self.bins)
+        first, sec = itertools.tee(self.bins)
         next(sec)
-        return tuple(
-            itertools.imap("to".join,
-                itertools.izip_longest(self.bins, sec, fillvalue='+')))
+        return ('<{0}'.format(self.bins[0]),) + tuple(
+            itertools.imap(lambda pair: '{0}to{1}'.format(*pair),
+                itertools.izip_longest(first, sec, fillvalue='+')))
+
+def _quantile(sketch, q):
+    return property(lambda self: getattr(self, sketch).quantile(q))
 
 class runtime_rec(object):
+    # approximate, see qutiepy.sketches.KLL for the error bounds
+    p50_wallclock = _quantile('wallclock_sketch', 0.5)
+    p95_wallclock = _quantile('wallclock_sketch', 0.95)
+    p99_wallclock = _quantile('wallclock_sketch', 0.99)
+    p50_wait = _quantile('wait_sketch', 0.5)
+    p95_wait = _quantile('wait_sketch', 0.95)
+    p99_wait = _quantile('wait_sketch', 0.99)
+    p50_maxvmem = _quantile('maxvmem_sketch', 0.5)
+    p95_maxvmem = _quantile('maxvmem_sketch', 0.95)
+    p99_maxvmem = _quantile('maxvmem_sketch', 0.99)
+
+    # approximate, see qutiepy.sketches.HyperLogLog for the error bounds
+    active_users = property(lambda self: len(self.users_sketch))
+    distinct_hosts = property(lambda self: len(self.hosts_sketch))
+
     def __init__(self):
         self.job_count = 0
 
@@ -51,6 +86,14 @@ class runtime_rec(object):
 
         self.queue_histo = collections.defaultdict(int)
 
+        # wallclock of the successful jobs like the other wallclock stats
+        self.wallclock_sketch = qutiepy.sketches.KLL()
+        self.wait_sketch = qutiepy.sketches.KLL()
+        self.maxvmem_sketch = qutiepy.sketches.KLL()
+
+        self.users_sketch = qutiepy.sketches.HyperLogLog()
+        self.hosts_sketch = qutiepy.sketches.HyperLogLog()
+
     @property
     def avg_runtime(self):
         return self.total_wallclock / float(self.successful_jobs)
@@ -63,6 +106,11 @@ class runtime_rec(object):
         self.slots_histo.count(row.slots, 1)
         self.queue_histo[row.qname] += 1
 
+        self.wait_sketch.add(row.waiting_time_sec)
+        self.maxvmem_sketch.add(row.maxvmem)
+        self.users_sketch.add(row.owner)
+        self.hosts_sketch.add(row.hostname)
+
         if row.exit_status == 0:
             self.successful_jobs += 1
 
@@ -70,6 +118,30 @@ class runtime_rec(object):
             self.max_wallclock = max(row.ru_wallclock, self.max_wallclock)
             self.min_wallclock = min(row.ru_wallclock, self.min_wallclock)
             self.runtime_histo.count(row.ru_wallclock, 1)
+            self.wallclock_sketch.add(row.ru_wallclock)
+
+    def merge(self, other):
+        """Fold in the records other has seen, in any order and grouping"""
+        self.job_count += other.job_count
+        self.successful_jobs += other.successful_jobs
+
+        self.total_wallclock += other.total_wallclock
+        self.max_wallclock = max(other.max_wallclock, self.max_wallclock)
+        self.min_wallclock = min(other.min_wallclock, self.min_wallclock)
+
+        self.total_time += other.total_time
+
+        self.slots_histo.merge(other.slots_histo)
+        self.runtime_histo.merge(other.runtime_histo)
+
+        for queue, count in other.queue_histo.iteritems():
+            self.queue_histo[queue] += count
+
+        self.wallclock_sketch.merge(other.wallclock_sketch)
+        self.wait_sketch.merge(other.wait_sketch)
+        self.maxvmem_sketch.merge(other.maxvmem_sketch)
+        self.users_sketch.merge(other.users_sketch)
+        self.hosts_sketch.merge(other.hosts_sketch)
 
     @classmethod
     def header_row(cls):
@@ -79,46 +151,241 @@ class runtime_rec(object):
             'min_wallclock',
             'max_wallclock',
             'avg_runtime',
-            'total_time'
+            'total_time',
+            'p50_wallclock',
+            'p95_wallclock',
+            'p99_wallclock',
+            'p50_wait',
+            'p95_wait',
+            'p99_wait',
+            'p50_maxvmem',
+            'p95_maxvmem',
+            'p99_maxvmem',
+            'active_users',
+            'distinct_hosts'
         )
 
     def dump(self):
         return map(lambda name: getattr(self, name), type(self).header_row())
 
-def main():
-  try:
-    parser = argparse.ArgumentParser()
-    parser.add_argument('accounting_files', nargs='*', default=None,
-      help='Additional accounting files to parse')
-    args = parser.parse_args()
-
-    account = qutiepy.sge_accounting.SGEAccountingFile()
-    if args.accounting_files:
-      account = itertools.chain(
-        qutiepy.sge_accounting.SGEAccountingFile(
-          fileinput.input(args.accounting_files, openhook=fileinput.hook_compressed)),
-        account)
+class rollups(object):
+    """Every total the reports are made from"""
+    def __init__(self):
+        self.records = 0
 
-    rollup_dict_by_user = collections.defaultdict(float)
-    rollup_dict_jobs_by_user = collections.defaultdict(int)
+        self.system_stats = collections.defaultdict(runtime_rec)
+        self.by_user = collections.defaultdict(float)
+        self.jobs_by_user = collections.defaultdict(int)
+        self.job_names_by_user = collections.defaultdict(qutiepy.sketches.HyperLogLog)
 
-    rollup_dict_system_stats = collections.defaultdict(runtime_rec)
-    for i,r in enumerate(account):
-        if i % 1000000 == 0:
-            print('\rprocessed {0}M records'.format( i // 1000000))
+    def __call__(self, r):
+        self.records += 1
 
-        rollup_dict_system_stats[ (r.start_time.month, r.start_time.year) ](r)
+        self.system_stats[ (r.start_time.month, r.start_time.year) ](r)
 
         # compute time by user
-        rollup_dict_by_user[ (r.start_time.month, r.start_time.year, r.owner) ] += r.ru_utime + r.ru_stime
+        self.by_user[ (r.start_time.month, r.start_time.year, r.owner) ] += r.ru_utime + r.ru_stime
 
         # job count by user
-        rollup_dict_jobs_by_user[ (r.start_time.month, r.start_time.year, r.owner) ] += 1
+        self.jobs_by_user[ (r.start_time.month, r.start_time.year, r.owner) ] += 1
+
+        # distinct job names by user
+        self.job_names_by_user[ (r.start_time.month, r.start_time.year, r.owner) ].add(r.job_name)
+
+    def merge(self, other):
+        self.records += other.records
+
+        for k, v in other.system_stats.iteritems():
+            self.system_stats[k].merge(v)
+
+        for k, v in other.by_user.iteritems():
+            self.by_user[k] += v
+
+        for k, v in other.jobs_by_user.iteritems():
+            self.jobs_by_user[k] += v
+
+        for k, v in other.job_names_by_user.iteritems():
+            self.job_names_by_user[k].merge(v)
+
+    def split(self):
+        """{(month, year): rollups of just that month}"""
+        months = collections.defaultdict(rollups)
+
+        for k, v in self.system_stats.iteritems():
+            months[k].system_stats[k] = v
+            months[k].records += v.job_count
+
+        for k, v in self.by_user.iteritems():
+            months[k[:2]].by_user[k] = v
+
+        for k, v in self.jobs_by_user.iteritems():
+            months[k[:2]].jobs_by_user[k] = v
+
+        for k, v in self.job_names_by_user.iteritems():
+            months[k[:2]].job_names_by_user[k] = v
+
+        return dict(months)
+
+# bump when rollups changes so stored totals pickled by older ones are dropped
+ROLLUP_VERSION = 3
+
+# every field rollups and runtime_rec read
+FIELDS = ('start_time', 'owner', 'ru_utime', 'ru_stime', 'slots', 'qname', 'exit_status', 'ru_wallclock',
+    'waiting_time_sec', 'maxvmem', 'hostname', 'job_name')
+
+def _init_worker():
+    # ^C is the parent's to handle, it tears the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _fold_part(task):
+    """(path, rollups) of one part of the input, a byte range of a plain
+    file or a whole file"""
+    path, start, end, cache_dir, columns = task
+
+    if start is None:
+        cache = qutiepy.sge_cache.AccountingCache.from_option(cache_dir)
+        account = qutiepy.sge_accounting.open_accounting_files([path], cache, columns=columns)
+    else:
+        account = itertools.imap(qutiepy.sge_accounting.SGEAccountingFile.make_row,
+            qutiepy.sge_accounting.SGEAccountingFile.build_reader(
+                qutiepy.sge_parallel.range_lines(path, start, end), columns=columns))
+
+    part = rollups()
+    for r in account:
+        part(r)
+    return path, part
+
+def _fold_deduplicated(paths, cache_dir, columns, jobs):
+    """(duplicates, rollups) of every record of paths with each job counted
+    once however many of the files it is in. The files are read in order
+    as one stream, with jobs processes parsing them"""
+    cache = qutiepy.sge_cache.AccountingCache.from_option(cache_dir)
+    reader = None
+    if jobs != 1:
+        reader = qutiepy.sge_parallel.ParallelReader(jobs or None, True, columns=columns)
+        account = reader.open_accounting_files(paths, cache)
+    else:
+        account = qutiepy.sge_accounting.open_accounting_files(paths, cache, columns=columns)
+
+    dedup = qutiepy.sge_dedup.Deduplicator()
+    part = rollups()
+    try:
+        for r in dedup.filter(account):
+            part(r)
+    finally:
+        if reader is not None:
+            reader.close()
+    return dedup.duplicates, part
+
+def _parts(paths, cache_dir, columns):
+    for path in paths:
+        if cache_dir is None and qutiepy.sge_parallel.ParallelReader.splittable(path):
+            with open(path, 'rb') as fd:
+                for start, end in qutiepy.sge_parallel.byte_ranges(fd):
+                    yield path, start, end, cache_dir, columns
+        else:
+            yield path, None, None, cache_dir, columns
+
+def _stored_parts(sources, cache_dir, columns):
+    """The parts of each source its stored totals don't cover yet"""
+    for source in sources:
+        for start, end in source.ranges:
+            if end is None:
+                yield source.path, None, None, cache_dir, columns
+                continue
+
+            with open(source.path, 'rb') as fd:
+                for chunk_start, chunk_end in qutiepy.sge_parallel.byte_ranges(fd, start=start, end=end):
+                    yield source.path, chunk_start, chunk_end, None, columns
+
+def main():
+  try:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('accounting_files', nargs='*', default=None,
+      help='Additional accounting files to parse')
+    parser.add_argument('--cache', default=os.environ.get(qutiepy.sge_cache.AccountingCache.ENVIRONMENT_VARIABLE),
+      dest='cache_dir', metavar='DIR', help='Directory of parsed columnar copies of the accounting files')
+    parser.add_argument('-j', '--jobs', type=int, default=1, dest='jobs', metavar='N',
+      help='Total up the accounting files with N processes, 0 for one per core. Plain files are split into '
+        'parts and compressed ones taken whole, each process totals its parts and the totals are merged '
+        '[Default: %(default)s]')
+    parser.add_argument('--store', default=os.environ.get(qutiepy.sge_rollup.RollupStore.ENVIRONMENT_VARIABLE),
+      dest='store_dir', metavar='DIR', help='Keep the monthly totals of each accounting file in DIR and only total '
+        'the records written since the last run [Default: ${0}]'.format(qutiepy.sge_rollup.RollupStore.ENVIRONMENT_VARIABLE))
+    parser.add_argument('--dedup', action='store_true', default=False, dest='dedup',
+      help='Count each job once when the accounting files overlap, matching jobs on their job_number, '
+        'task_number, pe_taskid, end_time and hostname. The files are read as one stream')
+    # merging doesn't depend on order, kept so existing command lines still work
+    parser.add_argument('--unordered', action='store_true', default=False, dest='unordered',
+      help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    paths = (args.accounting_files or []) + [qutiepy.sge_common.Paths().accouting_file]
+    columns = qutiepy.sge_accounting.projected_columns(FIELDS)
+    store = qutiepy.sge_rollup.RollupStore.from_option(args.store_dir, 'qgraph', ROLLUP_VERSION)
+
+    sources = []
+    if args.dedup:
+      if store is not None:
+        parser.error('--dedup has to see every record at once, it can not be used with --store')
+
+      duplicates, part = _fold_deduplicated(paths, args.cache_dir,
+        qutiepy.sge_accounting.projected_columns(FIELDS + qutiepy.sge_dedup.DEDUP_FIELDS), args.jobs)
+      print('skipped {0} duplicate records'.format(duplicates))
+      new = {None: part}
+
+    else:
+      if store is not None:
+        # a file named twice would wait on its own lock
+        for path in paths:
+          if all(os.path.abspath(path) != source.source for source in sources):
+            sources.append(store.source(path))
+        for source in sources:
+          source.lock()
+        parts = _stored_parts(sources, args.cache_dir, columns)
+      else:
+        parts = _parts(paths, args.cache_dir, columns)
+
+      pool = None
+      if args.jobs != 1:
+        pool = multiprocessing.Pool(args.jobs or None, _init_worker)
+        results = pool.imap_unordered(_fold_part, parts)
+      else:
+        results = itertools.imap(_fold_part, parts)
+
+      new = collections.defaultdict(rollups)
+      records = 0
+      try:
+        for path, part in results:
+          new[path].merge(part)
+          if (records + part.records) // 1000000 != records // 1000000:
+            print('\rprocessed {0}M records'.format((records + part.records) // 1000000))
+          records += part.records
+      finally:
+        if pool is not None:
+          pool.terminate()
+          pool.join()
+
+    totals = rollups()
+    if store is not None:
+      for source in sources:
+        source.commit(new[source.path].split())
+        for bucket in source.buckets().itervalues():
+          totals.merge(bucket)
+    else:
+      for part in new.itervalues():
+        totals.merge(part)
+
+    rollup_dict_system_stats = totals.system_stats
+    rollup_dict_by_user = totals.by_user
+    rollup_dict_jobs_by_user = totals.jobs_by_user
+    rollup_dict_job_names_by_user = totals.job_names_by_user
 
     # (12, 1969) is the key for dates that didn't parse. So remove that.
     rollup_dict_system_stats.pop((12, 1969), 1)
     rollup_dict_by_user.pop((12, 1969), 1)
     rollup_dict_jobs_by_user.pop((12, 1969), 1)
+    rollup_dict_job_names_by_user.pop((12, 1969), 1)
 
     # total successful jobs
     with open('cluster-system-stats.csv', 'wb+') as out_file:
@@ -127,25 +394,27 @@ def main():
         csv_writer.writerow(tuple(itertools.chain(('month', 'year'), runtime_rec.header_row())))
         csv_writer.writerows(
           itertools.imap(lambda r: list(itertools.chain(r[0], r[1].dump())),
-            rollup_dict_system_stats.iteritems()))
+            sorted(rollup_dict_system_stats.iteritems())))
 
     # count of jobs per slots
     with open('cluster-slots-per-job.csv', 'wb+') as out_file:
         csv_writer = csv.writer(out_file, delimiter=',')
 
-        csv_writer.writerow(tuple(itertools.chain(('month', 'year'), next(rollup_dict_system_stats.itervalues()).slots_histo.get_headers())))
+        csv_writer.writerow(tuple(itertools.chain(('month', 'year'), runtime_rec().slots_histo.get_headers())))
         csv_writer.writerows(
           itertools.imap(lambda r: tuple(itertools.chain((r[0][0], r[0][1]), iter(r[1].slots_histo))),
-              rollup_dict_system_stats.iteritems()))
+              sorted(rollup_dict_system_stats.iteritems())))
 
     ## job count by queue
     with open('cluster-jobs-by-queue.csv', 'wb+') as out_file:
         csv_writer = csv.writer(out_file, delimiter=',')
 
-        csv_writer.writerow(tuple(itertools.chain(('month', 'year'), next(rollup_dict_system_stats.itervalues()).queue_histo.get_headers())))
+        queues = sorted(set(itertools.chain.from_iterable(
+          rec.queue_histo for rec in rollup_dict_system_stats.itervalues())))
+        csv_writer.writerow(tuple(itertools.chain(('month', 'year'), queues)))
         csv_writer.writerows(
-          itertools.imap(lambda r: tuple(itertools.chain((r[0][0], r[0][1]), iter(r[1].queue_histo))),
-              rollup_dict_system_stats.iteritems()))
+          itertools.imap(lambda r: tuple(itertools.chain((r[0][0], r[0][1]), (r[1].queue_histo.get(q, 0) for q in queues))),
+              sorted(rollup_dict_system_stats.iteritems())))
 
     # compute time by user
     with open('cluster-cpu-hours-by-user.csv', 'wb+') as out_file:
@@ -154,17 +423,26 @@ def main():
         csv_writer.writerow(('month', 'year', 'user', 'cpu_time'))
         csv_writer.writerows(
             itertools.imap(lambda r: (r[0][0], r[0][1], r[0][2], r[1]),
-                rollup_dict_by_user.iteritems()))
+                sorted(rollup_dict_by_user.iteritems())))
 
 
     # job count by user
-    with open('cluster-cpu-hours-by-user.csv', 'wb+') as out_file:
+    with open('cluster-jobs-by-user.csv', 'wb+') as out_file:
         csv_writer = csv.writer(out_file, delimiter=',')
 
         csv_writer.writerow(('month', 'year', 'user', 'job count'))
         csv_writer.writerows(
             itertools.imap(lambda r: (r[0][0], r[0][1], r[0][2], r[1]),
-                rollup_dict_jobs_by_user.iteritems()))
+                sorted(rollup_dict_jobs_by_user.iteritems())))
+
+    # distinct job names by user
+    with open('cluster-job-names-by-user.csv', 'wb+') as out_file:
+        csv_writer = csv.writer(out_file, delimiter=',')
+
+        csv_writer.writerow(('month', 'year', 'user', 'distinct job names'))
+        csv_writer.writerows(
+            itertools.imap(lambda r: (r[0][0], r[0][1], r[0][2], len(r[1])),
+                sorted(rollup_dict_job_names_by_user.iteritems())))
 
   except KeyboardInterrupt:
     pass
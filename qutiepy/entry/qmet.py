@@ -1,21 +1,27 @@
 #!/usr/bin/env python
+from __future__ import absolute_import
 from __future__ import print_function
 
 """Parses the sge accounting log"""
 
 import pkg_resources
 
+import os
 import sys
 import re
 import operator
 import optparse
-import itertools
 import functools
 import string
 import dateutil, dateutil.parser
 
 import qutiepy.sge_accounting
+import qutiepy.sge_cache
+import qutiepy.sge_common
+import qutiepy.sge_index
+import qutiepy.sge_parallel
 import qutiepy.filter.BaseTypes
+import qutiepy.filter.Compiler
 import qutiepy.filter.Parser
 
 class SGEOption(optparse.Option):
@@ -23,7 +29,7 @@ class SGEOption(optparse.Option):
 
 class SGEFilterOption(SGEOption):
     def take_action(self, action, dest, opt, value, values, parser):
-        filter_stack = values.ensure_value('filter', qutiepy.filter.FilterStack())
+        filter_stack = values.ensure_value('filter', qutiepy.filter.BaseTypes.FilterStack())
 
         self.filter_action(filter_stack, action, dest, opt, value, values, parser)
 
@@ -33,7 +39,7 @@ class SGEAndOption(SGEFilterOption):
             help='Group actions together using and')
 
     def filter_action(self, filter_stack, actio, dest, opt, value, values, parser):
-        filter_stack.push(qutiepy.filter.AndFilter())
+        filter_stack.push(qutiepy.filter.BaseTypes.AndFilter())
 
 class SGEOrOption(SGEFilterOption):
     def __init__(self):
@@ -41,7 +47,7 @@ class SGEOrOption(SGEFilterOption):
             help='Group actions together using or')
 
     def filter_action(self, filter_stack, actio, dest, opt, value, values, parser):
-        filter_stack.push(qutiepy.filter.OrFilter())
+        filter_stack.push(qutiepy.filter.BaseTypes.OrFilter())
 
 class SGENotOption(SGEFilterOption):
     def __init__(self):
@@ -49,7 +55,7 @@ class SGENotOption(SGEFilterOption):
             help='Group actions together using not')
 
     def filter_action(self, filter_stack, actio, dest, opt, value, values, parser):
-        filter_stack.push(qutiepy.filter.NotFilter())
+        filter_stack.push(qutiepy.filter.BaseTypes.NotFilter())
 
 class SGEGroupEndOption(SGEFilterOption):
     def __init__(self):
@@ -66,7 +72,7 @@ class SGEGlobOption(SGEFilterOption):
         self.field_name = field_name
 
     def filter_action(self, filter_stack, action, dest, opt, value, values, parser):
-        filter_stack.add_filter(qutiepy.filter.GlobFilter(self.field_name, value))
+        filter_stack.add_filter(qutiepy.filter.BaseTypes.GlobFilter(self.field_name, value))
 
 class SGEAfterOption(SGEFilterOption):
     def __init__(self, long, field_name):
@@ -75,10 +81,10 @@ class SGEAfterOption(SGEFilterOption):
         self.field_name = field_name
 
     def filter_action(self, filter_stack, action, dest, opt, value, values, parser):
-        ti = dateutil.parser.parse(value)
+        # parsed now so a bad date is reported before any records are read
+        dateutil.parser.parse(value)
         filter_stack.add_filter(
-            qutiepy.filter.PredicateFilter(self.field_name,
-                functools.partial(operator.le, ti)))
+            qutiepy.filter.BaseTypes.ComparatorFilter(operator.ge, self.field_name, value))
 
 class SGEBeforeOption(SGEFilterOption):
     def __init__(self, long, field_name):
@@ -87,10 +93,9 @@ class SGEBeforeOption(SGEFilterOption):
         self.field_name = field_name
 
     def filter_action(self, filter_stack, action, dest, opt, value, values, parser):
-        ti = dateutil.parser.parse(value)
+        dateutil.parser.parse(value)
         filter_stack.add_filter(
-           qutiepy.filter.PredicateFilter(self.field_name,
-                functools.partial(operator.ge, ti)))
+            qutiepy.filter.BaseTypes.ComparatorFilter(operator.le, self.field_name, value))
 
 class SGERangeOption(SGEFilterOption):
     PATTERN = re.compile(r"""
@@ -136,7 +141,7 @@ class SGERangeOption(SGEFilterOption):
 
         del parser.rargs[:count]
 
-        filters = qutiepy.filter.PredicateFilter(self.field_name)
+        filters = qutiepy.filter.BaseTypes.PredicateFilter(self.field_name)
         for match in SGERangeOption.PATTERN.finditer(''.join(args)):
             d = match.groupdict()
 
@@ -257,6 +262,16 @@ def main():
         help='Only display the last record which matches')
     parser.add_option('--dry-run', action='store_true', default=False, dest='dry_run',
         help='Only helpful for debugging, just prepairs to walk the file but never actually does anything')
+    parser.add_option('--cache', action='store', dest='cache_dir',
+        default=os.environ.get(qutiepy.sge_cache.AccountingCache.ENVIRONMENT_VARIABLE),
+        help='Directory of parsed columnar copies of the accounting file')
+    parser.add_option('--index', action='store', dest='index_dir',
+        default=os.environ.get(qutiepy.sge_index.AccountingIndex.ENVIRONMENT_VARIABLE),
+        help='Directory of sparse time indexes of the accounting file, time filters then only read the part they can match')
+    parser.add_option('-j', '--jobs', action='store', type='int', default=1, dest='jobs',
+        help='Parse the accounting file with this many processes, 0 for one per core')
+    parser.add_option('--unordered', action='store_true', default=False, dest='unordered',
+        help='With --jobs match records as each part of the file is parsed rather than in file order')
 
     group = optparse.OptionGroup(parser, "Grouping Predicates",
         "Filter rows by field values. Filters are grouped using prefix notation, "
@@ -319,20 +334,29 @@ def main():
         print('This is a test it was only a test.')
         sys.exit(0)
 
-    account = qutiepy.sge_accounting.SGEAccountingFile()
-
-
     str_filter = getattr(options, 'str_filter', None)
     if str_filter:
-      p = qutiepy.filter.Parser.Parser()
-      filter = p.parse(str_filter)
+      filter = qutiepy.filter.Parser.parse(str_filter)
     else:
       filter = getattr(options, 'filter', None)
 
-    if filter:
-        records = itertools.ifilter(filter, account)
+    paths = [qutiepy.sge_common.Paths().accouting_file]
+    cache = qutiepy.sge_cache.AccountingCache.from_option(options.cache_dir)
+    index = qutiepy.sge_index.AccountingIndex.from_option(options.index_dir)
+    bounds = qutiepy.sge_index.time_bounds(filter) if filter and index else None
+
+    if options.jobs != 1:
+        reader = qutiepy.sge_parallel.ParallelReader(options.jobs or None, not options.unordered,
+            [(filter, False)] if filter else [])
+        records = reader.open_accounting_files(paths, cache, index, bounds)
+
+    elif filter:
+        records = qutiepy.filter.Compiler.filter_rows(filter,
+            qutiepy.sge_accounting.open_accounting_files(paths, cache, index, bounds,
+                qutiepy.filter.Compiler.compile_line_filter(filter)))
+
     else:
-        records = iter(account)
+        records = qutiepy.sge_accounting.open_accounting_files(paths, cache)
 
     try:
         templ = string.Template(options.output_template)
@@ -351,7 +375,8 @@ def main():
             print('No matching records', file=sys.stderr)
             sys.exit(1)
 
-    except IndexError as ex:
+    except (IndexError, KeyError) as ex:
+        # rows raise KeyError for a field they don't have
         print('Malformed format option', ex[0], file=sys.stderr)
         sys.exit(2)
 
@@ -6,15 +6,67 @@ from __future__ import division
 Top level qutiepy command and entry point. Loads sub-modules through package
 inspection."""
 
-import pkg_resources
+import os
 import sys
 import argparse
 import collections
-import fileinput
 import itertools
+import socket
 
 from ..commands import *
-from ..sge_accounting import SGEAccountingFile
+from ..commands.format import flush_outputs
+from ..filter.BaseTypes import AndFilter
+from ..filter.Compiler import compile_line_filter
+from ..sge_accounting import SGEAccountingFile, open_accounting_files, projected_columns
+from ..sge_cache import AccountingCache
+from ..sge_checkpoint import Checkpoint
+from ..sge_common import Paths
+from ..sge_dedup import DEDUP_FIELDS, Deduplicator
+from ..sge_follow import AccountingFollower
+from ..sge_index import AccountingIndex, time_bounds
+from ..sge_parallel import ParallelReader
+from ..sge_server import RecordServer, query
+
+# the options that decide which records a pipeline reads, a server decides
+# that when it is started
+SOURCE_OPTIONS = (
+  ('--include', 'extra_accounting_files'),
+  ('--skip-accounting', 'skip_system_account_file'),
+  ('--since-checkpoint', 'checkpoint'),
+  ('--jobs', 'jobs'),
+  ('--unordered', 'unordered'),
+  ('--dedup', 'dedup'),
+  ('--follow', 'follow'),
+)
+
+class _qutiepy_ArgumentParser(argparse.ArgumentParser):
+  """Only expand @file arguments in front of the first pipeline component.
+
+  Components take @file arguments of their own, filter @expr.txt reads the
+  expression from the file, and those have to reach them untouched."""
+
+  pipeline_commands = ()
+
+  def _read_args_from_files(self, arg_strings):
+    for i, arg_string in enumerate(arg_strings):
+      if arg_string in self.pipeline_commands:
+        head = super(_qutiepy_ArgumentParser, self)._read_args_from_files(arg_strings[:i])
+        return head + arg_strings[i:]
+
+    return super(_qutiepy_ArgumentParser, self)._read_args_from_files(arg_strings)
+
+class _VersionAction(argparse.Action):
+  """Print the installed version, pkg_resources is slow to load so it is
+  only loaded when the version is asked for"""
+
+  def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS,
+      help="show program's version number and exit"):
+    super(_VersionAction, self).__init__(option_strings=option_strings, dest=dest,
+      default=default, nargs=0, help=help)
+
+  def __call__(self, parser, namespace, values, option_string=None):
+    import pkg_resources
+    parser.exit(message='{0} {1}\n'.format(parser.prog, pkg_resources.require("qutiepy")[0].version))
 
 # borrowed this class from the argparse backport and hacked it up
 class _qutiepy_SubParsersAction(argparse.Action):
@@ -84,7 +136,7 @@ class _qutiepy_SubParsersAction(argparse.Action):
         j += 1
 
       arg_strings = values[i+1:j]
-      i += j
+      i = j
 
       sub_namespace = argparse.Namespace()
       subcommands.append(sub_namespace)
@@ -106,15 +158,39 @@ class _qutiepy_SubParsersAction(argparse.Action):
         vars(namespace).setdefault(argparse._UNRECOGNIZED_ARGS_ATTR, [])
         getattr(namespace, argparse._UNRECOGNIZED_ARGS_ATTR).extend(arg_strings)
 
-def main():
-  parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-  parser.add_argument('-v', '--version', action='version',
-    version='%(prog)s {0}'.format(pkg_resources.require("qutiepy")[0].version))
+def _make_parser():
+  parser = _qutiepy_ArgumentParser(fromfile_prefix_chars='@')
+  parser.add_argument('-v', '--version', action=_VersionAction)
   # using nargs=1 in appends cause argparse to create a list of lists
   parser.add_argument('-i', '--include', action='append', default=None, dest='extra_accounting_files', type=str,
     metavar='ACCOUNTING FILE', help='Include additonal source files in the record stream before the standard stream.')
   parser.add_argument('-s', '--skip-accounting', action='store_true', default=False, dest='skip_system_account_file',
     help='Skip reading of the live accounting file [Default: %(default)s]')
+  parser.add_argument('-c', '--cache', default=os.environ.get(AccountingCache.ENVIRONMENT_VARIABLE), dest='cache_dir',
+    metavar='DIR', help='Keep a parsed columnar copy of each accounting file in DIR and read from it while it is current '
+      '[Default: ${0}]'.format(AccountingCache.ENVIRONMENT_VARIABLE))
+  parser.add_argument('--index', default=os.environ.get(AccountingIndex.ENVIRONMENT_VARIABLE), dest='index_dir',
+    metavar='DIR', help='Keep a sparse index of the submission, start and end times of each accounting file in DIR '
+      'and only read the parts of it that leading filters on those times can match '
+      '[Default: ${0}]'.format(AccountingIndex.ENVIRONMENT_VARIABLE))
+  parser.add_argument('--since-checkpoint', default=None, dest='checkpoint', metavar='NAME',
+    help='Only read live accounting records written since the last run that used checkpoint NAME, '
+      'the checkpoint is moved up once the pipeline finishes. Checkpoints are kept in ${0} '
+      '[Default: {1}]'.format(Checkpoint.ENVIRONMENT_VARIABLE, Checkpoint.DEFAULT_DIRECTORY))
+  parser.add_argument('-j', '--jobs', type=int, default=1, dest='jobs', metavar='N',
+    help='Parse uncompressed accounting files with N processes, 0 for one per core. Leading filter '
+      'components run in those processes as well [Default: %(default)s]')
+  parser.add_argument('--unordered', action='store_true', default=False, dest='unordered',
+    help='With --jobs pass records on as each part of a file is parsed rather than in file order')
+  parser.add_argument('--dedup', action='store_true', default=False, dest='dedup',
+    help='Only pass on the first record of a job read more than once, from overlapping copies and archives '
+      'of the log. Jobs are matched on their job_number, task_number, pe_taskid, end_time and hostname')
+  parser.add_argument('-f', '--follow', action='store_true', default=False, dest='follow',
+    help='Keep the live accounting file open and pass on records as they are written to it, until interrupted. '
+      'Reading starts at its end, or at the checkpoint with --since-checkpoint, which is moved up whenever '
+      'every record written so far has been handled')
+  parser.add_argument('--connect', default=None, dest='connect', metavar='SOCKET',
+    help='Run the pipeline in the server listening on SOCKET, see serve, over the records it holds')
 
   subparsers = parser.add_subparsers(action=_qutiepy_SubParsersAction, dest='subcommands',
     title="Pipeline components",
@@ -123,27 +199,172 @@ def main():
   for command in Command.Command.__subclasses__():
     c = command()
     c.register_self(subparsers)
+  parser.pipeline_commands = frozenset(subparsers._name_parser_map)
+
+  return parser
+
+def _source_option(parser, args):
+  """The first option given that decides which records are read"""
+  for option, dest in SOURCE_OPTIONS:
+    if getattr(args, dest) != parser.get_default(dest):
+      return option
+  return None
+
+def _connect(parser, args):
+  option = _source_option(parser, args)
+  if option is not None:
+    parser.error('{0} is set when the server is started, it can not be used with --connect.'.format(option))
+
+  try:
+    status = query(args.connect, sys.argv[1:])
+  except socket.error as ex:
+    parser.error("Error querying the server at '{0}'. {1}".format(args.connect, ex.strerror or ex))
+  except IOError as ioex:
+    parser.error(ioex)
+  except KeyboardInterrupt:
+    sys.exit(1)
+
+  sys.exit(status)
+
+def _answer(parser, argv, store):
+  """Run a query sent to a server over the records in store"""
+  args = parser.parse_args(argv)
+  option = _source_option(parser, args)
+  if option is not None:
+    parser.error('{0} is set when the server is started.'.format(option))
 
+  _run(parser, args, store=store)
+
+def main():
+  parser = _make_parser()
   args = parser.parse_args()
 
-  record_streams = []
-  if args.extra_accounting_files:
-     record_streams.append(SGEAccountingFile(
-        fileinput.input(args.extra_accounting_files, openhook=fileinput.hook_compressed)))
+  if args.connect:
+    _connect(parser, args)
+
+  sources = list(args.extra_accounting_files or [])
+  if not args.skip_system_account_file and not args.checkpoint and not args.follow:
+    sources.append(Paths().accouting_file)
+
+  if args.checkpoint and args.skip_system_account_file:
+    parser.error('--since-checkpoint reads the live accounting file, it can not be skipped.')
 
-  if not args.skip_system_account_file:
-    record_streams.append(SGEAccountingFile())
+  if args.follow and args.skip_system_account_file:
+    parser.error('--follow reads the live accounting file, it can not be skipped.')
 
-  if not record_streams:
+  if not sources and not args.checkpoint and not args.follow:
     parser.error('No source files. System accounting file skipped and no others included.')
 
-  pipeline = itertools.chain(*record_streams)
-  for stage in args.subcommands:
-    pipeline = stage.func(stage, pipeline)
+  if args.jobs < 0:
+    parser.error('--jobs must be 0 or more.')
 
+  _run(parser, args, sources)
+
+def _run(parser, args, sources=(), store=None):
+  """Run the pipeline over the records of sources, or those held by the
+  server store belongs to"""
   try:
+    stages = list(args.subcommands)
+    cache = AccountingCache.from_option(args.cache_dir)
+
+    # leading filters can be run by the readers and narrow what they read
+    leading = []
+    for stage in stages:
+      if not getattr(stage, 'pushdown', None):
+        break
+
+      try:
+        leading.append(stage.pushdown(stage))
+      except ValueError as ex:
+        parser.error(ex)
+
+    # when every stage says what it reads only that much of a line is split
+    names = set()
+    for stage in stages:
+      fields = getattr(stage, 'fields', None)
+      used = fields(stage) if fields else None
+      if used is None:
+        names = None
+        break
+      names.update(used)
+    if names is not None and args.dedup:
+      names.update(DEDUP_FIELDS)
+    columns = projected_columns(names) if names is not None else None
+
+    index = AccountingIndex.from_option(args.index_dir)
+    bounds = line_filter = None
+    if leading:
+      trees = AndFilter(*[tree for tree, reorder in leading])
+      line_filter = compile_line_filter(trees)
+      if index is not None or store is not None:
+        bounds = time_bounds(trees)
+
+    reader = None
+    if store is not None:
+      record_streams = [store.rows_within(bounds, columns)]
+    elif args.jobs != 1:
+      stages = stages[len(leading):]
+      reader = ParallelReader(args.jobs or None, not args.unordered, leading, columns)
+      record_streams = [reader.open_accounting_files(sources, cache, index, bounds)]
+    else:
+      record_streams = [open_accounting_files(sources, cache, index, bounds, line_filter, columns)]
+
+    checkpoint = None
+    if args.checkpoint:
+      checkpoint = Checkpoint(args.checkpoint)
+
+    if args.follow:
+      def idle():
+        # every record so far has made it through the pipeline
+        flush_outputs()
+        sys.stdout.flush()
+        if checkpoint is not None:
+          checkpoint.save(follower.fd, follower.offset)
+        if server is not None:
+          server.caught_up()
+
+      follower = AccountingFollower(Paths().accouting_file, line_filter=line_filter, columns=columns, idle=idle)
+      if checkpoint is not None:
+        follower.offset = checkpoint.resume_offset(follower.fd)
+      elif any(getattr(stage, 'whole_log', False) for stage in stages):
+        # a server holds what was written before it started as well
+        follower.offset = 0
+      record_streams.append(follower if reader is None else reader.filter(follower))
+
+    elif checkpoint is not None:
+      live_file = open(Paths().accouting_file, 'rb')
+      live = SGEAccountingFile(live_file, offset=checkpoint.resume_offset(live_file),
+        line_filter=line_filter, columns=columns)
+      record_streams.append(live if reader is None else reader.filter(live))
+
+    pipeline = itertools.chain(*record_streams)
+    if args.dedup:
+      pipeline = Deduplicator().filter(pipeline)
+    server = None
+    for stage in stages:
+      if server is not None:
+        parser.error('serve has to be the last pipeline component.')
+
+      try:
+        pipeline = stage.func(stage, pipeline)
+      except ValueError as ex:
+        parser.error(ex)
+
+      if isinstance(pipeline, RecordServer):
+        if store is not None:
+          parser.error('serve can not be run by a server.')
+        if cache is not None:
+          # cached rows hold decoded values, not the text a server keeps
+          parser.error('serve can not read through a cache, leave out --cache and ${0}.'.format(
+            AccountingCache.ENVIRONMENT_VARIABLE))
+        server = pipeline
+        server.answer = lambda argv, store: _answer(parser, argv, store)
+
     collections.deque(pipeline, 0)
 
+    if checkpoint is not None and not args.follow:
+      checkpoint.save(live_file, live.offset)
+
   except IOError as ioex:
     if ioex.filename:
       parser.error("Error reading '{0.filename}'. {0.strerror} [Errno {0.errno}]".format(ioex))
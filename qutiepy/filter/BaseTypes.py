@@ -6,25 +6,6 @@ import operator
 import fnmatch
 import datetime, dateutil.parser
 
-def flattened(l):
-    result = _flatten(l, lambda x: x)
-
-    while type(result) == list and len(result) and callable(result[0]):
-        if result[1] != []:
-            yield result[1]
-
-        result = result[0]([])
-        yield result
-
-def _flatten(l, fn, val=[]):
-    if type(l) != list:
-        return fn(l)
-
-    if len(l) == 0:
-        return fn(val)
-
-    return [lambda x: _flatten(l[0], lambda y: _flatten(l[1:],fn,y), x), val]
-
 class FilterBase(object):
     def __repr__(self):
         return "<%s (%s) %s>" % (self.__class__.__name__, id(self), self.field if hasattr(self, 'field') else "")
@@ -47,9 +28,11 @@ class FilterAggrigator(FilterBase):
 
 class AndFilter(FilterAggrigator):
     def __call__(self, row):
-        return all(
-            flattened(
-                map(lambda f: f(row), self.filters)))
+        for f in self.filters:
+            if not f(row):
+                return False
+
+        return True
 
 class FilterStack(AndFilter):
     def __init__(self):
@@ -71,19 +54,29 @@ class FilterStack(AndFilter):
 
 class OrFilter(FilterAggrigator):
     def __call__(self, row):
-        return any(
-            flattened(
-                map(lambda f: f(row), self.filters)))
+        for f in self.filters:
+            if f(row):
+                return True
+
+        return False
 
 class NotFilter(FilterAggrigator):
+    # matches when none of the filters do
     def __call__(self, row):
-        return map(lambda f: not f(row), self.filters)
+        for f in self.filters:
+            if f(row):
+                return False
+
+        return True
 
 class GlobFilter(FilterBase):
-    def __init__(self, field, pattern):
+    # matches if any of the patterns do
+    def __init__(self, field, *patterns):
         self.field = field
+        self.patterns = patterns
         self.filter = re.compile(
-            fnmatch.translate(pattern), re.IGNORECASE)
+            '|'.join(map(lambda p: '(?:%s)' % fnmatch.translate(p), patterns)),
+            re.IGNORECASE)
 
     def __call__(self, row):
         return self.filter.match(str(getattr(row, self.field)))
@@ -108,6 +101,7 @@ class PredicateFilter(FilterBase):
 
 class RegexFilter(FilterBase):
   def __init__(self, field, pattern, flags):
+    self.field = field
     self.predicate = re.compile(pattern, flags)
     self.fieldgetter = operator.attrgetter(field)
 
@@ -115,21 +109,54 @@ class RegexFilter(FilterBase):
     value = self.fieldgetter(row)
     return bool(self.predicate.match(value))
 
+def coerce(text, t):
+  """Convert the text of a filter constant to the type t it is compared to"""
+  if t is datetime.datetime:
+    return dateutil.parser.parse(text)
+
+  elif t is not str:
+    return t(text)
+
+  return text
+
+class CoercedConstant(dict):
+  """A filter constant converted at most once for each type it meets"""
+  def __init__(self, text):
+    super(CoercedConstant, self).__init__()
+    self.text = text
+
+  def __missing__(self, t):
+    value = self[t] = coerce(self.text, t)
+    return value
+
 class ComparatorFilter(FilterBase):
   def __init__(self, predicate, field, rhs):
     self.predicate = predicate
+    self.field = field
     self.fieldgetter = operator.attrgetter(field)
     self.rhs = rhs
+    self.constant = CoercedConstant(rhs)
 
   def __call__(self, row):
     value = self.fieldgetter(row)
+    return self.predicate(value, self.constant[type(value)])
 
-    t = type(value)
-    rhs = self.rhs
-    if t is datetime.datetime:
-      rhs = dateutil.parser.parse(self.rhs)
+class MembershipFilter(FilterBase):
+  """Matches when the field equals one of values, in one hash lookup"""
+  def __init__(self, field, values):
+    self.field = field
+    self.fieldgetter = operator.attrgetter(field)
+    self.values = list(values)
+    self.sets = {}
 
-    elif t is not str:
-      rhs = t(self.rhs)
+  def constant(self, t):
+    """The values converted to type t"""
+    try:
+      return self.sets[t]
+    except KeyError:
+      converted = self.sets[t] = frozenset(map(lambda v: coerce(v, t), self.values))
+      return converted
 
-    return self.predicate(value, rhs)
+  def __call__(self, row):
+    value = self.fieldgetter(row)
+    return value in self.constant(type(value))
@@ -0,0 +1,561 @@
+from __future__ import print_function
+
+# Turns the filter tree built by qutiepy.filter.Parser into a single python
+# function. Walking the tree costs a python call per node per record, and the
+# comparators only find out what type their constant should be once they see
+# a value. The compiler looks the field types up on the row class instead so
+# constants are converted once, fields are read with plain attribute access
+# and and/or/not become python's own short circuiting operators.
+#
+# Since and/or stop at the first deciding clause the order of the clauses
+# matters. By default they run as written. compile_filter can sort them by a
+# rough static cost, cheap string and number checks before times, decimals
+# and patterns, and AdaptiveFilter times each clause on a sample of records,
+# orders them by observed cost and selectivity and keeps that order only
+# when it runs faster than the one in use.
+#
+# compile_line_filter() builds a cheaper, looser test from the same tree
+# that the readers run on each raw line before tokenizing it, comparing only
+# the few fields it needs split off the front of the line.
+#
+# Before compiling, simplify() merges the clauses of an or (or a not) that
+# test one field for equality into a single set lookup and those that glob
+# one field into a single regex, so a machine written (or (owner=a)(owner=b)...)
+# costs one hash lookup per record instead of one comparison per clause.
+
+import copy
+import datetime
+import decimal
+import itertools
+import operator
+import re
+import timeit
+
+import qutiepy.filter.BaseTypes as BaseTypes
+import qutiepy.sge_accounting as sge_accounting
+
+# converter -> type of the value it produces
+CONVERTER_TYPES = {
+  str: str,
+  sge_accounting.uge_unescape: str,
+  int: int,
+  float: float,
+  decimal.Decimal: decimal.Decimal,
+  sge_accounting.sge_datetime: datetime.datetime,
+  sge_accounting.uge_datetime: datetime.datetime,
+  sge_accounting.GEFailedField: sge_accounting.GEFailedField,
+}
+
+# instances used to find the type of an attribute like submission_time.hour
+SAMPLE_VALUES = {
+  str: '',
+  int: 0,
+  float: 0.0,
+  decimal.Decimal: decimal.Decimal(0),
+  datetime.datetime: datetime.datetime(2000, 1, 1),
+  datetime.timedelta: datetime.timedelta(0),
+  sge_accounting.GEFailedField: sge_accounting.GEFailedField(0),
+}
+
+OPERATORS = {
+  operator.eq: '==',
+  operator.ne: '!=',
+  operator.lt: '<',
+  operator.le: '<=',
+  operator.gt: '>',
+  operator.ge: '>=',
+}
+
+# rough relative cost of reading a value of each type, the first read of a
+# field includes converting it from text
+TYPE_COSTS = {
+  str: 1,
+  int: 1,
+  float: 1,
+  sge_accounting.GEFailedField: 2,
+  decimal.Decimal: 3,
+  datetime.datetime: 4,
+}
+UNKNOWN_COST = 5
+PATTERN_COST = 3
+
+FIELD_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+
+class _Compiler(object):
+  def __init__(self, row_class, reorder=True):
+    self.fields = row_class.descriptors()
+    self.reorder = reorder
+    self.namespace = {}
+
+  def constant(self, value):
+    name = '_k{0}'.format(len(self.namespace))
+    self.namespace[name] = value
+    return name
+
+  def value_type(self, field):
+    """The type a field holds or None if it can't be known without a row"""
+    parts = field.split('.')
+    descriptor = self.fields.get(parts[0])
+    if descriptor is None or descriptor.pos is None:
+      return None
+
+    t = CONVERTER_TYPES.get(descriptor.converter)
+    for attr in parts[1:]:
+      if t not in SAMPLE_VALUES:
+        return None
+
+      try:
+        value = getattr(SAMPLE_VALUES[t], attr)
+      except AttributeError:
+        return None
+
+      if callable(value):
+        return None
+      t = type(value)
+
+    return t
+
+  def field_cost(self, field):
+    root_type = self.value_type(field.split('.')[0])
+    return TYPE_COSTS.get(root_type, UNKNOWN_COST) + field.count('.')
+
+  def cost(self, f):
+    """A static guess at what evaluating f costs"""
+    if isinstance(f, BaseTypes.FilterAggrigator):
+      return sum(map(self.cost, f.filters))
+
+    elif isinstance(f, (BaseTypes.ComparatorFilter, BaseTypes.MembershipFilter)):
+      if self.value_type(f.field) is None:
+        return UNKNOWN_COST
+      return self.field_cost(f.field)
+
+    elif isinstance(f, (BaseTypes.GlobFilter, BaseTypes.RegexFilter)):
+      return self.field_cost(f.field) + PATTERN_COST
+
+    return UNKNOWN_COST
+
+  def field(self, field):
+    if FIELD_PATTERN.match(field):
+      return 'row.' + field
+
+    return '{0}(row)'.format(self.constant(operator.attrgetter(field)))
+
+  def join(self, filters, conjunction, empty):
+    if not filters:
+      return empty
+
+    if self.reorder:
+      filters = sorted(filters, key=self.cost)
+
+    return '({0})'.format(' {0} '.format(conjunction).join(map(self.expression, filters)))
+
+  def expression(self, f):
+    if isinstance(f, BaseTypes.NotFilter):
+      return 'not {0}'.format(self.join(f.filters, 'or', 'False'))
+
+    elif isinstance(f, BaseTypes.AndFilter):
+      return self.join(f.filters, 'and', 'True')
+
+    elif isinstance(f, BaseTypes.OrFilter):
+      return self.join(f.filters, 'or', 'False')
+
+    elif isinstance(f, BaseTypes.ComparatorFilter):
+      return self.comparison(f)
+
+    elif isinstance(f, BaseTypes.MembershipFilter):
+      t = self.value_type(f.field)
+      if t is None:
+        return '{0}(row)'.format(self.constant(f))
+      return '({0} in {1})'.format(self.field(f.field), self.constant(f.constant(t)))
+
+    elif isinstance(f, BaseTypes.GlobFilter):
+      return '({0}.match(str({1})) is not None)'.format(self.constant(f.filter), self.field(f.field))
+
+    elif isinstance(f, BaseTypes.RegexFilter):
+      return '({0}.match({1}) is not None)'.format(self.constant(f.predicate), self.field(f.field))
+
+    # anything else is called as it is
+    return '{0}(row)'.format(self.constant(f))
+
+  def comparison(self, f):
+    t = self.value_type(f.field)
+    if t is None:
+      # the comparator caches its converted constant by type itself
+      return '{0}(row)'.format(self.constant(f))
+
+    rhs = self.constant(BaseTypes.coerce(f.rhs, t))
+    op = OPERATORS.get(f.predicate)
+    if op is None:
+      return '{0}({1}, {2})'.format(self.constant(f.predicate), self.field(f.field), rhs)
+
+    return '({0} {1} {2})'.format(self.field(f.field), op, rhs)
+
+def _merge_alternatives(filters):
+  # Clauses of an or that can be combined are grouped by field, each group
+  # takes the place of its first clause so the order is otherwise kept.
+  groups = {}
+  order = []
+  for f in filters:
+    if isinstance(f, BaseTypes.MembershipFilter) or (
+        isinstance(f, BaseTypes.ComparatorFilter) and f.predicate is operator.eq):
+      key = ('=', f.field)
+    elif isinstance(f, BaseTypes.GlobFilter):
+      key = ('*=', f.field)
+    else:
+      key = f
+
+    if key not in groups:
+      order.append(key)
+      groups[key] = []
+    groups[key].append(f)
+
+  merged = []
+  for key in order:
+    group = groups[key]
+    if len(group) == 1:
+      merged.append(group[0])
+
+    elif key[0] == '=':
+      values = []
+      for f in group:
+        values.extend(f.values if isinstance(f, BaseTypes.MembershipFilter) else [f.rhs])
+      merged.append(BaseTypes.MembershipFilter(key[1], values))
+
+    else:
+      patterns = []
+      for f in group:
+        patterns.extend(f.patterns)
+      merged.append(BaseTypes.GlobFilter(key[1], *patterns))
+
+  return merged
+
+def simplify(filter):
+  """An equivalent filter tree with nested and/or flattened into their
+  parent and the equality and glob tests of an or merged by field.
+  The tree passed in is left alone."""
+  if not isinstance(filter, BaseTypes.FilterAggrigator):
+    return filter
+
+  if isinstance(filter, BaseTypes.NotFilter):
+    # not matches when none of its clauses do so its clauses are an or
+    kind, nested = BaseTypes.NotFilter, BaseTypes.OrFilter
+  elif isinstance(filter, BaseTypes.OrFilter):
+    kind, nested = BaseTypes.OrFilter, BaseTypes.OrFilter
+  else:
+    kind, nested = BaseTypes.AndFilter, BaseTypes.AndFilter
+
+  filters = []
+  for f in map(simplify, filter.filters):
+    if type(f) is nested:
+      filters.extend(f.filters)
+    else:
+      filters.append(f)
+
+  if kind is not BaseTypes.AndFilter:
+    filters = _merge_alternatives(filters)
+
+  return kind(*filters)
+
+def referenced_fields(filter):
+  """The names of the row fields filter reads, submission_time for
+  (submission_time.hour > 9)"""
+  fields = set()
+  filters = [filter]
+  while filters:
+    f = filters.pop()
+    if isinstance(f, BaseTypes.FilterAggrigator):
+      filters.extend(f.filters)
+    else:
+      fields.add(f.field.split('.')[0])
+
+  return fields
+
+def compile_filter(filter, row_class=sge_accounting.UGEAccountingRow, reorder=False):
+  """Compile a filter tree into one function of a row.
+
+  Constants are converted to the type of the field they are compared with
+  here, so a bad constant raises ValueError now rather than on the first
+  record. With reorder the clauses of and/or/not are sorted by their
+  static cost. Trees python can't compile, say nested too deeply, are
+  returned as they are. The generated code is kept in the source attribute."""
+  filter = simplify(filter)
+  compiler = _Compiler(row_class, reorder)
+  source = 'def compiled_filter(row):\n  return {0}\n'.format(compiler.expression(filter))
+
+  try:
+    code = compile(source, '<filter>', 'exec')
+  except (SyntaxError, MemoryError, RuntimeError):
+    return filter
+
+  namespace = compiler.namespace
+  exec(code, namespace)
+  compiled = namespace['compiled_filter']
+  compiled.source = source
+  return compiled
+
+def filter_rows(filter, rows, reorder=False):
+  """The rows that pass filter, with its clauses run as written or, with
+  reorder, in the order an AdaptiveFilter measures to be fastest"""
+  if reorder:
+    return AdaptiveFilter(filter).filter(rows)
+
+  return itertools.ifilter(compile_filter(filter), rows)
+
+# converter -> (what converts the raw text, the type it gives) for fields
+# a line filter can test without building a row
+RAW_CONVERTERS = {
+  str: (None, str),
+  int: ('int', int),
+  float: ('float', float),
+  sge_accounting.GEFailedField: ('int', int),
+}
+
+class _LineCompiler(object):
+  # Each clause becomes (code, exact) or None when it can't be tested on the
+  # raw line. An exact test gives the same answer as the filter would, the
+  # rest only ever let through more, so a not can only be pushed down when
+  # everything under it is exact.
+  def __init__(self):
+    # only fields where SGE and UGE agree, the line could be either
+    self.fields = sge_accounting.SGEAccountingRow.descriptors()
+    self.namespace = {}
+    self.positions = set()
+
+  def constant(self, value):
+    name = '_k{0}'.format(len(self.namespace))
+    self.namespace[name] = value
+    return name
+
+  def raw(self, field):
+    descriptor = self.fields.get(field)
+    if descriptor is None or descriptor.pos is None or descriptor.converter not in RAW_CONVERTERS:
+      return None, None
+
+    self.positions.add(descriptor.pos)
+    converter, t = RAW_CONVERTERS[descriptor.converter]
+    code = 'f[{0}]'.format(descriptor.pos)
+    if converter:
+      code = '{0}({1})'.format(converter, code)
+    return code, t
+
+  def join(self, f, conjunction):
+    parts = map(self.expression, f.filters)
+    pushed = [part for part in parts if part is not None]
+
+    if conjunction == 'and':
+      # clauses left out of an and only make it let more through
+      if not pushed:
+        return None
+    elif len(pushed) != len(parts) or not parts:
+      return None
+
+    code = '({0})'.format(' {0} '.format(conjunction).join(code for code, exact in pushed))
+    return code, len(pushed) == len(parts) and all(exact for code, exact in pushed)
+
+  def expression(self, f):
+    if isinstance(f, BaseTypes.NotFilter):
+      part = self.join(f, 'or')
+      if part is None or not part[1]:
+        return None
+      return 'not {0}'.format(part[0]), True
+
+    elif isinstance(f, BaseTypes.AndFilter):
+      return self.join(f, 'and')
+
+    elif isinstance(f, BaseTypes.OrFilter):
+      return self.join(f, 'or')
+
+    elif isinstance(f, (BaseTypes.ComparatorFilter, BaseTypes.MembershipFilter)):
+      code, t = self.raw(f.field)
+      if code is None:
+        return None
+
+      try:
+        if isinstance(f, BaseTypes.MembershipFilter):
+          return '({0} in {1})'.format(code, self.constant(f.constant(t))), True
+
+        op = OPERATORS.get(f.predicate)
+        if op is None:
+          return None
+        return '({0} {1} {2})'.format(code, op, self.constant(BaseTypes.coerce(f.rhs, t))), True
+
+      except ValueError:
+        return None
+
+    elif isinstance(f, (BaseTypes.GlobFilter, BaseTypes.RegexFilter)):
+      code, t = self.raw(f.field)
+      if t is not str:
+        return None
+
+      pattern = f.filter if isinstance(f, BaseTypes.GlobFilter) else f.predicate
+      return '({0}.match({1}) is not None)'.format(self.constant(pattern), code), True
+
+    return None
+
+def compile_line_filter(filter):
+  """A function of a raw accounting line that is False only for lines whose
+  records filter would drop, or None if no part of filter can be tested
+  without building the row.
+
+  Only the fields the filter reads are split off the front of the line. A
+  line that doesn't split or convert cleanly is let through for the row
+  to deal with."""
+  compiler = _LineCompiler()
+  part = compiler.expression(simplify(filter))
+  if part is None:
+    return None
+
+  source = ('def line_filter(line):\n'
+    '  try:\n'
+    '    f = line.split(":", {0})\n'
+    '    return {1}\n'
+    '  except (ValueError, IndexError):\n'
+    '    return True\n').format(max(compiler.positions) + 1, part[0])
+
+  try:
+    code = compile(source, '<line filter>', 'exec')
+  except (SyntaxError, MemoryError, RuntimeError):
+    return None
+
+  namespace = compiler.namespace
+  exec(code, namespace)
+  compiled = namespace['line_filter']
+  compiled.source = source
+  return compiled
+
+class AdaptiveFilter(object):
+  """Filter records, reordering clauses by what they cost and how often they pass.
+
+  Every interval records, sample records spread one every stride records
+  are run through the whole tree with each clause timed. The clauses of an
+  and are then ordered by cost over the rate they reject at, those of an
+  or/not by cost over the rate they pass at, which puts cheap deciding
+  checks first. The next sample * stride records go through the compiled
+  new and current orders in alternating batches of TRIAL_BATCH, and the
+  new order is only kept if it took less time per record.
+
+  Timing every clause only ever touches one record in stride, and a
+  measurement that misjudges the clauses never leaves a slower order in
+  place. Spreading both out keeps a log sorted by time, where the first
+  thousand records can all fall in the same hour, from deciding on a
+  stretch unlike the rest. The clauses start out in the order they are
+  written."""
+
+  SAMPLE = 1000
+  STRIDE = 50
+  INTERVAL = 1000000
+  TRIAL_BATCH = 100
+
+  def __init__(self, filter, row_class=sge_accounting.UGEAccountingRow, sample=SAMPLE, stride=STRIDE, interval=INTERVAL):
+    self.tree = simplify(filter)
+    self.row_class = row_class
+    self.sample = sample
+    self.stride = stride
+    self.interval = interval
+    self.compiled = compile_filter(self.tree, row_class)
+
+  def __call__(self, row):
+    return self.compiled(row)
+
+  def filter(self, rows):
+    rows = iter(rows)
+    while True:
+      # [calls, passes, seconds] by id of each clause
+      self.stats = {}
+      profiled = 0
+      window = itertools.islice(rows, self.sample * self.stride)
+      for row in window:
+        profiled += 1
+        if self._timed(self.tree, row):
+          yield row
+
+        for row in itertools.ifilter(self.compiled, itertools.islice(window, self.stride - 1)):
+          yield row
+
+      if profiled == 0:
+        return
+
+      candidate = self._reordered(self.tree)
+      if _shape(candidate) != _shape(self.tree):
+        for row in self._trial(candidate, rows):
+          yield row
+
+      for row in itertools.ifilter(self.compiled, itertools.islice(rows, self.interval)):
+        yield row
+
+  def _trial(self, candidate, rows):
+    """The rows of the next sample * stride that pass, switching to the
+    candidate tree if it filtered its batches of them faster than the one
+    in use"""
+    # each row is only filtered once, its values are decoded on first use
+    # and a second run over it would be cheaper whichever order it had
+    plans = [self.compiled, compile_filter(candidate, self.row_class)]
+    seconds = [0.0, 0.0]
+    counts = [0, 0]
+    timer = timeit.default_timer
+
+    trial = itertools.islice(rows, self.sample * self.stride)
+    for turn in itertools.cycle((0, 1)):
+      batch = list(itertools.islice(trial, self.TRIAL_BATCH))
+      if not batch:
+        break
+
+      start = timer()
+      passed = filter(plans[turn], batch)
+      seconds[turn] += timer() - start
+      counts[turn] += len(batch)
+
+      for row in passed:
+        yield row
+
+    if counts[0] and counts[1] and seconds[1] / counts[1] < seconds[0] / counts[0]:
+      self.tree = candidate
+      self.compiled = plans[1]
+
+  def _timed(self, f, row):
+    start = timeit.default_timer()
+    if isinstance(f, BaseTypes.FilterAggrigator):
+      # every clause runs while profiling so each one is measured
+      results = [self._timed(child, row) for child in f.filters]
+      if isinstance(f, BaseTypes.NotFilter):
+        result = not any(results)
+      elif isinstance(f, BaseTypes.OrFilter):
+        result = any(results)
+      else:
+        result = all(results)
+    else:
+      result = bool(f(row))
+
+    stats = self.stats.setdefault(id(f), [0, 0, 0.0])
+    stats[0] += 1
+    stats[1] += result
+    stats[2] += timeit.default_timer() - start
+    return result
+
+  def _rank(self, f, rejects):
+    calls, passes, seconds = self.stats.get(id(f), (0, 0, 0.0))
+    if calls == 0:
+      return float('inf')
+
+    deciding = (calls - passes if rejects else passes) / float(calls)
+    return (seconds / calls) / max(deciding, 1e-6)
+
+  def _reordered(self, f):
+    """A copy of the and/or/not nodes of f, sharing its other clauses, in
+    the order measured to decide fastest"""
+    if not isinstance(f, BaseTypes.FilterAggrigator):
+      return f
+
+    # an and is decided by a clause that fails, or/not by one that passes
+    rejects = not isinstance(f, (BaseTypes.OrFilter, BaseTypes.NotFilter))
+    ordered = sorted(f.filters, key=lambda child: self._rank(child, rejects))
+
+    f = copy.copy(f)
+    f.filters = map(self._reordered, ordered)
+    return f
+
+def _shape(f):
+  """Something equal for trees with the same clauses in the same order"""
+  if not isinstance(f, BaseTypes.FilterAggrigator):
+    return id(f)
+  return type(f), tuple(map(_shape, f.filters))
@@ -9,49 +9,64 @@ from __future__ import print_function
 # - Format ({field name} {op} {value})
 # - Numeric/Date ops: <, >, =, !=, <=, >=
 # - String ops: = (exact equals), ~= /{python regex}/, *= {glob}
+# - All types: in {value}[,{value}...] or in @{file with a value per line}
+#
+# The text is read in a single pass. Context only ever moves its position
+# forward and every token is matched in place with a compiled pattern or
+# str.find, nothing copies the rest of the text, so parsing is linear in its
+# length. Open conjunctions are kept on an explicit stack rather than the
+# python stack so deeply nested machine written filters parse too.
 
 import qutiepy.filter.BaseTypes as BaseTypes
 
-import sys
-if sys.version_info < (2, 7):
-  import ordereddict
-else:
-  import collections as ordereddict
-
 import argparse
 import functools
 import operator
-import string
 import re
 
+WHITESPACE = re.compile(r'\s*')
+CONJUNCTION = re.compile(r'\(\s*(and|or|not)(?=[\s()])')
+FIELD = re.compile(r'[a-z_.]+')
+OPERATOR = re.compile(r'<=|>=|!=|\*=|~=|=|<|>|in(?=[\s@])')
+REGEX_FLAGS = re.compile(r'[^\s)]*')
+
 class Context(object):
   def __init__(self, text):
     self.text = text.strip()
     self.pos = 0
 
-  @property
-  def current(self):
-    return self.text[self.pos:]
-
   @property
   def done(self):
     return self.pos == len(self.text)
 
   def lstrip(self):
-    while not self.done and self.text[self.pos] in string.whitespace:
-      self.pos += 1
+    self.pos = WHITESPACE.match(self.text, self.pos).end()
+
+  def peek(self, char):
+    return self.text.startswith(char, self.pos)
+
+  def match(self, pattern):
+    """Consume and return the match of pattern at the current position or None"""
+    m = pattern.match(self.text, self.pos)
+    if m is not None:
+      self.pos = m.end()
+    return m
+
+  def upto(self, char, what):
+    """Consume and return the text up to, not including, the next char"""
+    end = self.text.find(char, self.pos)
+    if end == -1:
+      raise ParseError('Error while parsing {0} at position {1}. Looking for a {2}'.format(what, self.pos, char))
+
+    value = self.text[self.pos:end]
+    self.pos = end
+    return value
 
 class ParseError(Exception):
   pass
 
 def _handle_simple_value(context):
-  curr = context.current
-  i = 0
-  while curr[i] != ')':
-    i += 1
-
-  context.pos += i
-  return curr[:i]
+  return context.upto(')', 'value')
 
 def _handle_predicate_value(op, context, field):
   const = _handle_simple_value(context)
@@ -61,51 +76,67 @@ def _handle_glob_value(context, field):
   value = _handle_simple_value(context)
   return BaseTypes.GlobFilter(field, value)
 
+def _handle_set_value(context, field):
+  context.lstrip()
+  text = _handle_simple_value(context).strip()
+
+  if not text.startswith('@'):
+    return BaseTypes.MembershipFilter(field, [value.strip() for value in text.split(',')])
+
+  try:
+    with open(text[1:]) as fd:
+      values = [line.strip() for line in fd]
+  except IOError as ex:
+    raise ParseError('Unable to read the values for {0} from {1}: {2}'.format(field, text[1:], ex.strerror))
+
+  return BaseTypes.MembershipFilter(field,
+    [value for value in values if value and not value.startswith('#')])
+
 def _handle_regex_value(context, field):
   context.lstrip()
-  curr = context.current
+  if context.done:
+    raise ParseError('Error while parsing regex at position {0}. Looking for a pattern'.format(context.pos))
 
   # This is the trick used in vim the first non space caracter
   # encountered is counted as the pattern delimiter. We go until
   # we match a the caracter again. So the user can select a delimiter
   # that is not in the regex anywhere rather than dealing with metacharacter
   # madness.
-  delim = curr[0]
-  i = 1
-  while curr[i] != delim:
-    i += 1
+  delim = context.text[context.pos]
+  context.pos += 1
+  pattern = context.upto(delim, 'regex')
+  context.pos += 1
 
-  pattern = curr[1:i]
-
-  j = i + 1
   flags = 0
-  while curr[j] not in string.whitespace + ')':
-    f = getattr(re, curr[j], None)
+  start = context.pos
+  for i, flag in enumerate(context.match(REGEX_FLAGS).group()):
+    f = getattr(re, flag, None)
     if f is None:
-      raise ParseError('Unknown flag regex flag {0} to parse filter at position {1}'.format(curr[j], context.pos))
+      raise ParseError('Unknown flag regex flag {0} to parse filter at position {1}'.format(flag, start + i))
 
     flags |= f
-    j += 1
 
-  context.pos += j
   context.lstrip()
   return BaseTypes.RegexFilter(field, pattern, flags)
 
 class Parser(argparse.Action):
-  AND_TOKEN = '(and'
-  OR_TOKEN = '(or'
-  NOT_TOKEN = '(not'
-
-  OPERATOR_TOKENS = ordereddict.OrderedDict([
-    ('=',  functools.partial(_handle_predicate_value, operator.eq)),
-    ('<=', functools.partial(_handle_predicate_value, operator.le)),
-    ('>=', functools.partial(_handle_predicate_value, operator.ge)),
-    ('!=', functools.partial(_handle_predicate_value, operator.ne)),
-    ('<',  functools.partial(_handle_predicate_value, operator.lt)),
-    ('>',  functools.partial(_handle_predicate_value, operator.gt)),
-    ('*=', _handle_glob_value),
-    ('~=', _handle_regex_value)
-  ])
+  CONJUNCTIONS = {
+    'and': BaseTypes.AndFilter,
+    'or': BaseTypes.OrFilter,
+    'not': BaseTypes.NotFilter,
+  }
+
+  OPERATOR_TOKENS = {
+    '=':  functools.partial(_handle_predicate_value, operator.eq),
+    '<=': functools.partial(_handle_predicate_value, operator.le),
+    '>=': functools.partial(_handle_predicate_value, operator.ge),
+    '!=': functools.partial(_handle_predicate_value, operator.ne),
+    '<':  functools.partial(_handle_predicate_value, operator.lt),
+    '>':  functools.partial(_handle_predicate_value, operator.gt),
+    '*=': _handle_glob_value,
+    '~=': _handle_regex_value,
+    'in': _handle_set_value
+  }
 
   def __init__(self, option_strings, dest, nargs=None, const=None, default=None, type=None, choices=None, required=False, help=None, metavar=None):
     super(Parser, self).__init__(
@@ -117,83 +148,78 @@ class Parser(argparse.Action):
   def __call__(self, parser, namespace, value, option_string):
     assert(len(value) == 1)
 
-    context = Context(value[0])
-    setattr(namespace, self.dest, self._parse(context))
-
-  def _parse(self, context):
-      context.lstrip()
-
-      if context.current.startswith(Parser.AND_TOKEN):
-        filter = self._handle_and(context)
-
-      elif context.current.startswith(Parser.OR_TOKEN):
-        filter = self._handle_or(context)
+    text = value[0]
+    try:
+      # machine written filters can come from a file
+      if text.startswith('@'):
+        with open(text[1:]) as fd:
+          text = fd.read()
 
-      elif context.current.startswith(Parser.NOT_TOKEN):
-        filter = self._handle_not(context)
+      setattr(namespace, self.dest, self._parse(Context(text)))
 
-      elif context.current.startswith('('):
-        filter = self._handle_op(context)
+    except IOError as ex:
+      raise argparse.ArgumentError(self, 'Unable to read the filter from {0}: {1}'.format(text[1:], ex.strerror))
 
-      else:
-        raise ParseError('Error unable to parse filter at position {0}: Expected a ('.format(context.pos))
+    except ParseError as ex:
+      raise argparse.ArgumentError(self, str(ex))
 
-      return filter
+  def _parse(self, context):
+    # conjunctions that are still open, innermost last
+    stack = []
 
-  def _handle_conjunction(self, context, conjunction):
     while True:
       context.lstrip()
 
-      if context.current.startswith('('):
-        conjunction.add_filter(self._parse(context))
-
-      elif context.current.startswith(')'):
+      if stack and context.peek(')'):
         context.pos += 1
-        return conjunction
+        filter = stack.pop()
+
+      elif context.peek('('):
+        conjunction = context.match(CONJUNCTION)
+        if conjunction is not None:
+          stack.append(Parser.CONJUNCTIONS[conjunction.group(1)]())
+          continue
+
+        filter = self._handle_op(context)
+
+      elif stack:
+        raise ParseError('Error while parsing {0} at postiion {1}. Looking for a )'.format(
+          type(stack[-1]).__name__, context.pos))
 
       else:
-        raise ParseError('Error while parsing and at postiion {0}. Looking for a )'.format(context.pos))
+        raise ParseError('Error unable to parse filter at position {0}: Expected a ('.format(context.pos))
 
-  def _handle_and(self, context):
-    context.pos += len(Parser.AND_TOKEN)
-    return self._handle_conjunction(context, BaseTypes.AndFilter())
+      if stack:
+        stack[-1].add_filter(filter)
+        continue
 
-  def _handle_or(self, context):
-    context.pos += len(Parser.OR_TOKEN)
-    return self._handle_conjunction(context, BaseTypes.OrFilter())
+      context.lstrip()
+      if not context.done:
+        raise ParseError('Error unexpected text after the filter at position {0}'.format(context.pos))
 
-  def _handle_not(self, context):
-    context.pos += len(Parser.NOT_TOKEN)
-    return self._handle_conjunction(context, BaseTypes.NotFilter())
+      return filter
 
   def _handle_op(self, context):
     context.pos += 1
     context.lstrip()
 
-    curr = context.current
-    i = 0
-    while curr[i] in string.ascii_lowercase or curr[i] == '_' or curr[i] == '.':
-      i += 1
+    field = context.match(FIELD)
+    if field is None:
+      raise ParseError('Error while parsing operator at position {0}. Looking for a field name.'.format(context.pos))
 
-    field = curr[:i]
-    context.pos += i
     context.lstrip()
-
-    # We can't just look this up. The tokens have to be checked in order so that
-    # the correct one is selected.
-    value_parser = None
-    for token,op in Parser.OPERATOR_TOKENS.iteritems():
-      if context.current.startswith(token):
-        context.pos += len(token)
-        value_parser = op
-
-    if not value_parser:
+    token = context.match(OPERATOR)
+    if token is None:
       raise ParseError('Error while parsing operator at position {0}. Looking for a relational operator.'.format(context.pos))
 
-    predicate = value_parser(context, field)
+    predicate = Parser.OPERATOR_TOKENS[token.group()](context, field.group())
 
-    if not context.current.startswith(')'):
+    if not context.peek(')'):
         raise ParseError('Error while parsing operator at postiion {0}. Looking for a )'.format(context.pos))
 
     context.pos += 1
     return predicate
+
+def parse(text):
+  """Parse a filter expression into a tree of BaseTypes filters"""
+  return Parser([], 'filter')._parse(Context(text))
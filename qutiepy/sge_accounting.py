@@ -9,6 +9,8 @@ import csv
 import collections
 import datetime
 import decimal
+import fileinput
+import sys
 import warnings
 
 import sge_common
@@ -28,12 +30,88 @@ def uge_datetime(time):
     ms_val = int(time)
     return datetime.datetime.fromtimestamp(ms_val // 1000).replace(microsecond=(ms_val%1000) * 1000)
 
-class AccountingRow(collections.Mapping):
-  _fields = []
+def uge_unescape(val):
+    # UGE swaps the ':' in free text fields for 0xFF so they don't break the record
+    return val.replace('\xFF', ':')
 
-  @classmethod
-  def _addfield(cls, field_desc):
-    cls._fields.append(field_desc)
+class AccountingField(object):
+  def __init__(self, pos=None, converter=int, doc=None, depends=None):
+    self.pos = pos
+    self.converter = converter
+    self.doc = doc
+    # the fields a computed field reads, None if they aren't known
+    self.depends = depends
+    # set by AccountingRowType once the field is part of a row class
+    self.slot = None
+
+  def __call__(self, fget):
+    self.converter = fget
+    return self
+
+  def __set__(self, obj, value):
+    raise AttributeError("Accounting Fields are read only")
+
+  def __get__(self, obj, objtype=None):
+    if obj is None:
+      return self
+
+    val = obj._values[self.slot]
+    if val is not NOT_DECODED:
+      return val
+
+    if self.pos is None:
+      if not self.converter:
+        raise AttributeError('unreadable attribute')
+
+      val = self.converter(obj)
+
+    else:
+      val = obj._rawrow[self.pos]
+
+      if self.converter is not None:
+        try:
+          val = self.converter(val)
+        except ValueError as ex:
+          raise ValueError("Error with pos {0} caused by {1}".format(self.pos, ex))
+
+    obj._values[self.slot] = val
+    return val
+
+# marks a field of a row that has not been decoded yet
+NOT_DECODED = object()
+
+class AccountingRowType(type):
+  """Lays out the fields of an AccountingRow class.
+
+  Every field gets an index into the row's list of decoded values. A
+  subclass overriding a field keeps its parent's index and new fields are
+  added at the end, so a field has the same index whatever its class. Rows
+  keep their state in __slots__, the classes don't get a __dict__ unless
+  they ask for one."""
+
+  def __new__(mcs, name, bases, namespace):
+    namespace.setdefault('__slots__', ())
+    cls = super(AccountingRowType, mcs).__new__(mcs, name, bases, namespace)
+
+    names = list(getattr(cls, '_fields', ()))
+    descriptors = dict(getattr(cls, '_descriptors', {}))
+    own = sorted(((member.pos is None, member.pos, key), member)
+      for key, member in namespace.items() if isinstance(member, AccountingField))
+
+    for (computed, pos, key), member in own:
+      if key not in descriptors:
+        names.append(key)
+
+      member.slot = names.index(key)
+      descriptors[key] = member
+
+    cls._fields = tuple(names)
+    cls._descriptors = descriptors
+    return cls
+
+class AccountingRow(object):
+  __metaclass__ = AccountingRowType
+  __slots__ = ('_rawrow', '_values')
 
   @classmethod
   def fields(cls):
@@ -43,68 +121,54 @@ class AccountingRow(collections.Mapping):
         itertools.ifilter(lambda member_item: type(member_item[1]) is AccountingField,
           cls.__dict__.iteritems())))
 
+  @classmethod
+  def descriptors(cls):
+    """Map every field name, inherited ones included, to its AccountingField"""
+    return dict(cls._descriptors)
+
   def __init__(self, row):
     self._rawrow = row
-    self._memorizedrow = dict()
+    self._values = [NOT_DECODED] * len(self._fields)
 
   def __len__(self):
-    return len(type(self)._fields)
+    return len(self._fields)
 
   def __getitem__(self, key):
-      try:
-          if type(key) is int:
-              return self._rawrow[key]
+    if type(key) is int:
+      return self._rawrow[key]
 
-          elif type(key) is str:
-              val = self._memorizedrow.get(key)
-              if val:
-                return val
+    try:
+      field = self._descriptors[key]
+    except KeyError:
+      raise KeyError("key %s is not an available field." % key)
+    except TypeError:
+      raise TypeError("key must be an int or a string")
 
-              return self.__getattribute__(key)
-
-          else:
-              raise TypeError("key must be an int or a string")
-
-      except AttributeError as ex:
-          raise IndexError("key %s is not an available field." % key, ex)
+    return field.__get__(self, type(self))
 
   def __iter__(self):
-    return itertools.ifilter(lambda member: type(member) is AccountingField, self.__dict__)
-
-class AccountingField(object):
-  def __init__(self, pos=None, converter=int, doc=None):
-    self.pos = pos
-    self.converter = converter
-    self.doc = doc
+    return iter(self._fields)
 
-  def __call__(self, fget):
-    self.converter = fget
-    return self
+  def __contains__(self, key):
+    return key in self._descriptors
 
-  def __set__(self, obj, value):
-    raise AttributeError("Accounting Fields are read only")
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
 
-  def __get__(self, obj, objtype=None):
-    # Set up the field in the row object
-    if obj is None:
-      objtype._addfield(self)
-      return self
-
-    if self.pos is None:
-      if self.converter:
-        return self.converter(obj)
+  def keys(self):
+    return list(self._fields)
 
-      raise AttributeError('unreadable attribute')
+  def values(self):
+    return [self[key] for key in self._fields]
 
-    val = obj._rawrow[self.pos]
+  def items(self):
+    return [(key, self[key]) for key in self._fields]
 
-    if self.converter is not None:
-      try:
-        val = self.converter(val)
-      except ValueError as ex:
-        raise ValueError("Error with pos {0} caused by {1}".format(self.pos, ex))
-
-    return obj._memorizedrow.setdefault(self.pos, val)
+# the Mapping mixins would give every row a __dict__
+collections.Mapping.register(AccountingRow)
 
 class GEFailedField(AccountingField):
   SGE_FAILED_MESSAGES = collections.defaultdict(
@@ -177,6 +241,10 @@ class GEFailedField(AccountingField):
   def __ne__(self, other):
     return self.errno != self.coerce(other)
 
+  def __hash__(self):
+    # equal to the plain error number so sets can hold either
+    return hash(self.errno)
+
   @property
   def message(self):
     return GEFailedField.SGE_FAILED_MESSAGES[self.errno]
@@ -232,26 +300,26 @@ class SGEAccountingRow(AccountingRow):
     arid = AccountingField(43)
     ar_submission_time = AccountingField(44, sge_datetime)
 
-    @AccountingField()
+    @AccountingField(depends=('submission_time', 'start_time'))
     def waiting_time(self):
       if self.submission_time < self.start_time:
         return self.start_time - self.submission_time
 
       return datetime.timedelta(0)
 
-    @AccountingField()
+    @AccountingField(depends=('waiting_time',))
     def waiting_time_sec(self):
       td = self.waiting_time
       return ((td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6)
 
-    @AccountingField()
+    @AccountingField(depends=('submission_time', 'end_time'))
     def aggregate_time(self):
         if self.submission_time < self.end_time:
             return self.end_time - self.submission_time
 
         return datetime.timedelta(0)
 
-    @AccountingField()
+    @AccountingField(depends=('aggregate_time',))
     def aggregate_time_sec(self):
       td = self.aggregate_time
       return ((td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6)
@@ -263,13 +331,8 @@ class UGEAccountingRow(SGEAccountingRow):
     maxvmem = AccountingField(42, float)
     ar_submission_time = AccountingField(44, uge_datetime)
 
-    @AccountingField(45)
-    def cwd(self, val):
-      return val.replace('\xFF', ':')
-
-    @AccountingField(46)
-    def submit_cmd(self, val):
-      return val.replace('\xFF', ':')
+    cwd = AccountingField(45, uge_unescape)
+    submit_cmd = AccountingField(46, uge_unescape)
 
 class SGEAccountingFile(object):
     """Handles parsing the sge accounting log"""
@@ -282,12 +345,21 @@ class SGEAccountingFile(object):
         strict = False
         lineterminator='\n'
 
-    def __init__(self, fd=None):
+    def __init__(self, fd=None, offset=None, line_filter=None, columns=None):
+        # With an offset reading starts there and self.offset follows the
+        # end of the last record handed out, fd must then be a seekable file.
+        # line_filter drops raw lines before they are tokenized, see
+        # qutiepy.filter.Compiler.compile_line_filter, and only the first
+        # columns fields of a line are split out, see projected_columns.
+        self.offset = offset
+        self.line_filter = line_filter
+        self.columns = columns
+
         if fd is None:
             paths = sge_common.Paths()
             self.accounting_file = file(paths.accouting_file, 'rb')
 
-        elif issubclass(fd, collections.Iterable):
+        elif isinstance(fd, collections.Iterable):
           self.accounting_file = fd
 
         else:
@@ -295,18 +367,127 @@ class SGEAccountingFile(object):
               'object that yields accounting file lines')
 
     def __iter__(self):
-        for record in self.build_reader(self.accounting_file):
-            if len(record) > 45:
-                yield UGEAccountingRow(record)
-            else:
-                yield SGEAccountingRow(record)
+        if self.offset is None:
+            return itertools.imap(self.make_row,
+                self.build_reader(self.accounting_file, self.line_filter, self.columns))
+
+        return self._iter_from_offset()
+
+    def _iter_from_offset(self):
+        end = [self.offset]
+
+        def lines():
+            for offset, line in self.read_lines(self.accounting_file, self.offset):
+                end[0] = offset + len(line)
+                if self.line_filter is None or self.line_filter(line):
+                    yield line
+                else:
+                    # every line before this one has been handed out
+                    self.offset = end[0]
+
+        for record in self.build_reader(lines(), columns=self.columns):
+            yield self.make_row(record)
+            self.offset = end[0]
+
+    @staticmethod
+    def make_row(record):
+        # a projected record keeps the rest of the line unsplit in its last
+        # field, counting the colons left in it gives the full field count
+        if record and len(record) + record[-1].count(':') > 45:
+            return UGEAccountingRow(record)
+
+        return SGEAccountingRow(record)
+
+    @staticmethod
+    def read_lines(fd, offset=0, partial=False):
+        """Yield (offset, line) for each record line starting at offset.
+
+        Comment lines are skipped. Unless partial is set a trailing line
+        without a newline is left alone; sge_qmaster may still be writing it."""
+        fd.seek(offset)
+        for line in iter(fd.readline, ''):
+            if line[-1] != '\n' and not partial:
+                break
+
+            if not line.startswith('#'):
+                yield offset, line
+
+            offset += len(line)
 
     @staticmethod
-    def build_reader(fd):
-        return csv.reader(
-            itertools.ifilterfalse(
-                lambda line: line.startswith('#'),
-                fd),
-            dialect=SGEAccountingFile.Dialect())
+    def build_reader(fd, line_filter=None, columns=None):
+        lines = itertools.ifilterfalse(lambda line: line.startswith('#'), fd)
+        if line_filter is not None:
+            lines = itertools.ifilter(line_filter, lines)
+
+        if columns is not None:
+            return _split_records(lines, columns)
+
+        return csv.reader(lines, dialect=SGEAccountingFile.Dialect())
+
+def _split_records(lines, columns):
+    for line in lines:
+        line = line.rstrip('\r\n')
+        # like the csv reader a blank line is an empty record
+        yield line.split(':', columns) if line else []
+
+def projected_columns(names):
+    """How many fields from the front of a line hold every field in names
+    and the fields the computed ones among them read. None when that can't
+    be told, an unknown name or a computed field that doesn't list what it
+    reads, and the whole line has to be split.
+
+    Every other field of a row built from such a record is wrong, so names
+    has to cover everything that will be read from it."""
+    descriptors = UGEAccountingRow.descriptors()
+    names = list(names)
+    seen = set()
+    columns = 0
+
+    while names:
+        name = names.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+
+        field = descriptors.get(name)
+        if field is None:
+            return None
+
+        if field.pos is not None:
+            columns = max(columns, field.pos + 1)
+        elif field.depends is None:
+            return None
+        else:
+            names.extend(field.depends)
+
+    return columns
+
+def open_accounting_files(paths, cache=None, index=None, bounds=None, line_filter=None, columns=None):
+    """Yield the records of each accounting file in turn.
+
+    '-' reads standard in, anything else may be compressed. When a cache
+    (see qutiepy.sge_cache) is given on disk files are read through it.
+    Otherwise with an index and time bounds (see qutiepy.sge_index) only the
+    parts of plain files that can hold records within the bounds are read,
+    text lines line_filter rejects are skipped and only the first columns
+    fields of a line are split out. Either way the records still have to be
+    filtered."""
+    for path in paths:
+        if path == '-':
+            records = SGEAccountingFile(sys.stdin, line_filter=line_filter, columns=columns)
+
+        elif cache is not None:
+            records = cache.rows(path)
+
+        elif index is not None and bounds and index.indexable(path):
+            records = index.rows(path, bounds, line_filter, columns)
+
+        else:
+            records = SGEAccountingFile(fileinput.hook_compressed(path, 'rb'),
+                line_filter=line_filter, columns=columns)
+
+        for row in records:
+            yield row
 
 # vim: set shiftwidth=2 tabstop=2
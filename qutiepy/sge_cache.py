@@ -0,0 +1,468 @@
+from __future__ import print_function
+from __future__ import division
+
+"""Columnar on-disk cache of parsed accounting files.
+
+Every source file gets a directory with one flat binary file per field.
+Fixed width fields are native arrays which numpy.memmap (or array.fromfile)
+can read as is, string fields are an int64 array of end offsets next to a
+blob. meta.json records the dtypes along with the size/mtime/inode of the
+source, a stale cache is rebuilt and a log that only grew is appended to."""
+
+import array
+import decimal
+import errno
+import fcntl
+import fileinput
+import hashlib
+import itertools
+import json
+import os
+import sys
+
+import qutiepy.sge_common as sge_common
+from qutiepy.sge_accounting import (AccountingField, GEFailedField,
+  SGEAccountingFile, SGEAccountingRow, UGEAccountingRow,
+  sge_datetime, uge_datetime, uge_unescape)
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+CACHE_VERSION = 1
+
+# rows are written and read this many at a time
+CHUNK_ROWS = 65536
+
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2')
+
+def _int64_typecode():
+  for code in ('l', 'q'):
+    try:
+      if array.array(code).itemsize == 8:
+        return code
+    except ValueError:
+      pass
+
+  raise RuntimeError('No 64 bit integer array type on this platform')
+
+INT64 = _int64_typecode()
+
+# converter -> (column kind, raw string -> stored value)
+ENCODERS = {
+  str: ('str', str),
+  uge_unescape: ('str', uge_unescape),
+  int: ('int', int),
+  float: ('float', float),
+  # kept as text so the exact digits survive
+  decimal.Decimal: ('decimal', str),
+  # every timestamp is stored in milliseconds like UGE writes them
+  sge_datetime: ('datetime', lambda raw: int(raw) * 1000),
+  uge_datetime: ('datetime', int),
+  GEFailedField: ('failed', int),
+}
+
+# column kind -> (array typecode or None for strings, stored value -> row value)
+KINDS = {
+  'str': (None, None),
+  'decimal': (None, decimal.Decimal),
+  'int': (INT64, None),
+  'failed': (INT64, GEFailedField),
+  'datetime': (INT64, uge_datetime),
+  'float': ('d', None),
+}
+
+FLAVOR_SGE = 0
+FLAVOR_UGE = 1
+# the line did not convert cleanly, the row is rebuilt from _raw
+FLAVOR_RAW = 2
+
+FLAVORS = {
+  FLAVOR_SGE: SGEAccountingRow,
+  FLAVOR_UGE: UGEAccountingRow,
+}
+
+def row_fields(row_class):
+  """Sorted (name, AccountingField) pairs of the fields stored in a log line"""
+  return sorted(
+    [(name, field) for name, field in row_class.descriptors().items() if field.pos is not None],
+    key=lambda item: item[1].pos)
+
+def cached_row_class(row_class):
+  """A row_class whose raw values are the stored column values.
+
+  Strings and numbers are stored as their final values, the rest are
+  decoded lazily on access just like a row read from text."""
+  members = {}
+  for name, field in row_fields(row_class):
+    kind = ENCODERS.get(field.converter, ('str', None))[0]
+    members[name] = AccountingField(field.pos, KINDS[kind][1])
+
+  return type(row_class)('Cached' + row_class.__name__, (row_class,), members)
+
+CACHED_FLAVORS = dict((flavor, cached_row_class(row_class))
+  for flavor, row_class in FLAVORS.items())
+
+def _typestr(typecode):
+  return '{0}{1}{2}'.format(
+    '<' if sys.byteorder == 'little' else '>',
+    {'d': 'f', 'B': 'u'}.get(typecode, 'i'),
+    array.array(typecode).itemsize)
+
+class _FixedColumn(object):
+  def __init__(self, path, typecode):
+    self.path = path
+    self.typecode = typecode
+    self.itemsize = array.array(typecode).itemsize
+
+  @property
+  def dtype(self):
+    return _typestr(self.typecode)
+
+  def truncate(self, rows):
+    with open(self.path, 'ab') as fd:
+      fd.truncate(rows * self.itemsize)
+
+  def extend(self, values):
+    with open(self.path, 'ab') as fd:
+      array.array(self.typecode, values).tofile(fd)
+
+  def reader(self, start):
+    return _FixedReader(self, start)
+
+  def load(self, rows):
+    if numpy is not None:
+      if rows == 0:
+        return numpy.zeros(0, dtype=self.dtype)
+      return numpy.memmap(self.path, dtype=self.dtype, mode='r', shape=(rows,))
+
+    values = array.array(self.typecode)
+    with open(self.path, 'rb') as fd:
+      values.fromfile(fd, rows)
+    return values
+
+class _ColumnReader(object):
+  """Reads a column count values at a call from where it was opened, the
+  files it holds open are closed by close() or leaving a with block"""
+
+  def close(self):
+    raise NotImplementedError()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+class _FixedReader(_ColumnReader):
+  def __init__(self, column, start):
+    self.typecode = column.typecode
+    self.fd = open(column.path, 'rb')
+    self.fd.seek(start * column.itemsize)
+
+  def __call__(self, count):
+    values = array.array(self.typecode)
+    values.fromfile(self.fd, count)
+    return values
+
+  def close(self):
+    self.fd.close()
+
+class _StringReader(_ColumnReader):
+  def __init__(self, column, start):
+    self.fd = open(column.blob_path, 'rb')
+    self.fd.seek(column._end(start))
+    self.end = self.fd.tell()
+    try:
+      self.read_ends = column.offsets.reader(start)
+    except:
+      self.fd.close()
+      raise
+
+  def __call__(self, count):
+    ends = self.read_ends(count)
+    if not ends:
+      return []
+
+    blob = self.fd.read(ends[-1] - self.end)
+    self.end = ends[-1]
+    return blob.split('\n')[:-1]
+
+  def close(self):
+    self.read_ends.close()
+    self.fd.close()
+
+class _StringColumn(object):
+  # Values are written newline terminated, they come from a line based log
+  # so can't hold one themselves, and a whole chunk splits in one call. The
+  # offsets make random access possible without scanning the blob.
+
+  def __init__(self, path):
+    self.offsets = _FixedColumn(path + '.off', INT64)
+    self.blob_path = path + '.str'
+
+  @property
+  def dtype(self):
+    return 'str'
+
+  def _end(self, rows):
+    if rows == 0:
+      return 0
+    with self.offsets.reader(rows - 1) as read:
+      return read(1)[0]
+
+  def truncate(self, rows):
+    end = self._end(rows)
+    self.offsets.truncate(rows)
+    with open(self.blob_path, 'ab') as fd:
+      fd.truncate(end)
+
+  def extend(self, values, base):
+    ends = array.array(INT64)
+    end = base
+    for value in values:
+      end += len(value) + 1
+      ends.append(end)
+
+    with open(self.blob_path, 'ab') as fd:
+      fd.write('\n'.join(values))
+      fd.write('\n')
+    self.offsets.extend(ends)
+    return end
+
+  def reader(self, start):
+    return _StringReader(self, start)
+
+  def load(self, rows):
+    with self.reader(0) as read:
+      return read(rows)
+
+class ColumnStore(object):
+  """The cached columns of a single accounting file"""
+
+  def __init__(self, directory, source):
+    self.directory = directory
+    self.source = source
+    self.compressed = os.path.splitext(source)[1] in COMPRESSED_EXTENSIONS
+
+    self.fields = row_fields(UGEAccountingRow)
+    self.columns = {
+      '_flavor': _FixedColumn(self._path('_flavor.col'), 'B'),
+      '_offset': _FixedColumn(self._path('_offset.col'), INT64),
+      '_raw': _StringColumn(self._path('_raw')),
+    }
+    self.kinds = {}
+    for name, field in self.fields:
+      kind = ENCODERS.get(field.converter, ('str', None))[0]
+      typecode = KINDS[kind][0]
+      self.kinds[name] = kind
+      if typecode is None:
+        self.columns[name] = _StringColumn(self._path(name))
+      else:
+        self.columns[name] = _FixedColumn(self._path(name + '.col'), typecode)
+
+    # (column name, position, raw -> stored) for each flavor of row
+    self.encoders = {}
+    for flavor, row_class in FLAVORS.items():
+      self.encoders[flavor] = [
+        (name, field.pos, ENCODERS.get(field.converter, ('str', field.converter))[1])
+        for name, field in row_fields(row_class)]
+
+    self.meta = None
+
+  def _path(self, name):
+    return os.path.join(self.directory, name)
+
+  def _open_source(self):
+    if self.compressed:
+      return fileinput.hook_compressed(self.source, 'rb')
+    return open(self.source, 'rb')
+
+  def _load_meta(self):
+    try:
+      with open(self._path('meta.json'), 'rb') as fd:
+        meta = json.load(fd)
+    except (IOError, ValueError):
+      return None
+
+    if meta.get('version') != CACHE_VERSION or meta.get('byteorder') != sys.byteorder:
+      return None
+
+    return meta
+
+  def _save_meta(self, meta):
+    tmp = self._path('meta.json.tmp')
+    with open(tmp, 'wb') as fd:
+      json.dump(meta, fd, indent=1, sort_keys=True)
+    os.rename(tmp, self._path('meta.json'))
+
+  @staticmethod
+  def _stat_matches(meta, st):
+    return (meta['inode'] == st.st_ino and meta['size'] == st.st_size
+      and meta['mtime'] == st.st_mtime)
+
+  def _can_extend(self, meta, st):
+    if self.compressed or meta['inode'] != st.st_ino or st.st_size < meta['size']:
+      return False
+
+    with open(self.source, 'rb') as fd:
+      return sge_common.fingerprint(fd, meta['offset']) == meta['fingerprint']
+
+  def refresh(self):
+    """Bring the columns up to date with the source file"""
+    try:
+      os.makedirs(self.directory)
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+
+    with open(self._path('lock'), 'wb') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+
+      st = os.stat(self.source)
+      meta = self._load_meta()
+      if meta is not None and self._stat_matches(meta, st):
+        self.meta = meta
+        return
+
+      if meta is None or not self._can_extend(meta, st):
+        meta = {
+          'version': CACHE_VERSION,
+          'byteorder': sys.byteorder,
+          'source': self.source,
+          'rows': 0,
+          'offset': 0,
+          'columns': dict((name, {'kind': self.kinds.get(name, name), 'dtype': column.dtype})
+            for name, column in self.columns.items()),
+        }
+
+      self._extend(meta)
+      meta.update(inode=st.st_ino, size=st.st_size, mtime=st.st_mtime)
+      self._save_meta(meta)
+      self.meta = meta
+
+  def _extend(self, meta):
+    for column in self.columns.values():
+      column.truncate(meta['rows'])
+
+    ends = dict((name, column._end(meta['rows']))
+      for name, column in self.columns.items() if isinstance(column, _StringColumn))
+
+    with self._open_source() as fd:
+      lines = SGEAccountingFile.read_lines(fd, meta['offset'], partial=self.compressed)
+      while True:
+        chunk = list(itertools.islice(lines, CHUNK_ROWS))
+        if not chunk:
+          break
+
+        for name, values in self._encode(chunk).items():
+          if name in ends:
+            ends[name] = self.columns[name].extend(values, ends[name])
+          else:
+            self.columns[name].extend(values)
+
+        offset, line = chunk[-1]
+        meta['rows'] += len(chunk)
+        meta['offset'] = offset + len(line)
+
+      if not self.compressed:
+        meta['fingerprint'] = sge_common.fingerprint(fd, meta['offset'])
+
+  def _encode(self, chunk):
+    columns = dict((name, []) for name in self.columns)
+    missing = dict((name, '' if KINDS[kind][0] is None else 0)
+      for name, kind in self.kinds.items())
+
+    records = SGEAccountingFile.build_reader(line for offset, line in chunk)
+    for (offset, line), record in itertools.izip(chunk, records):
+      flavor = FLAVOR_UGE if len(record) > 45 else FLAVOR_SGE
+
+      try:
+        values = dict(missing)
+        for name, pos, encode in self.encoders[flavor]:
+          values[name] = encode(record[pos])
+      except (ValueError, IndexError):
+        flavor = FLAVOR_RAW
+        values = missing
+
+      for name, value in values.items():
+        columns[name].append(value)
+      columns['_flavor'].append(flavor)
+      columns['_offset'].append(offset)
+      columns['_raw'].append(line.rstrip('\n') if flavor == FLAVOR_RAW else '')
+
+    return columns
+
+  def column(self, name):
+    """One cached column, a numpy.memmap when numpy is installed"""
+    return self.columns[name].load(self.meta['rows'])
+
+  def __iter__(self):
+    rows = self.meta['rows']
+    names = [name for name, field in self.fields]
+    sge_row = CACHED_FLAVORS[FLAVOR_SGE]
+    sge_len = len(row_fields(SGEAccountingRow))
+    uge_row = CACHED_FLAVORS[FLAVOR_UGE]
+
+    # closed when the rows run out and when the consumer stops early
+    readers = {}
+    try:
+      for name, column in self.columns.items():
+        readers[name] = column.reader(0)
+
+      done = 0
+      while done < rows:
+        count = min(CHUNK_ROWS, rows - done)
+        chunk = dict((name, read(count)) for name, read in readers.items())
+        flavors = chunk['_flavor']
+
+        # fields are stored in log order so zipping the columns rebuilds the record
+        for i, values in enumerate(itertools.izip(*[chunk[name] for name in names])):
+          flavor = flavors[i]
+          if flavor == FLAVOR_UGE:
+            yield uge_row(values)
+
+          elif flavor == FLAVOR_SGE:
+            yield sge_row(values[:sge_len])
+
+          else:
+            yield SGEAccountingFile.make_row(next(SGEAccountingFile.build_reader([chunk['_raw'][i]])))
+
+        done += count
+
+    finally:
+      for read in readers.values():
+        read.close()
+
+    # whatever was appended since the last refresh, or is still being written
+    with self._open_source() as fd:
+      for offset, line in SGEAccountingFile.read_lines(fd, self.meta['offset'], partial=True):
+        yield SGEAccountingFile.make_row(next(SGEAccountingFile.build_reader([line])))
+
+class AccountingCache(object):
+  """A directory of ColumnStores, one per accounting file"""
+
+  ENVIRONMENT_VARIABLE = 'QUTIEPY_CACHE_DIR'
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  @classmethod
+  def from_option(cls, directory):
+    """None when caching is turned off"""
+    if not directory:
+      return None
+    return cls(directory)
+
+  def store(self, path):
+    source = os.path.abspath(path)
+    key = '{0}-{1}'.format(
+      hashlib.sha1(source).hexdigest()[:16],
+      os.path.basename(source))
+    return ColumnStore(os.path.join(self.directory, key), source)
+
+  def rows(self, path):
+    store = self.store(path)
+    store.refresh()
+    return iter(store)
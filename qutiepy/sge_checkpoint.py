@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+"""Remember how far into the live accounting file a previous run got.
+
+A checkpoint stores the byte offset just past the last record read, a hash of
+the bytes in front of it and the inode of the file. Resuming seeks straight to
+the offset after checking the file is still the one that was read, a rotated
+or truncated log is read again from the start."""
+
+import errno
+import json
+import os
+import warnings
+
+import qutiepy.sge_common as sge_common
+
+class Checkpoint(object):
+  ENVIRONMENT_VARIABLE = 'QUTIEPY_CHECKPOINT_DIR'
+  DEFAULT_DIRECTORY = os.path.join('~', '.qutiepy', 'checkpoints')
+
+  def __init__(self, name, directory=None):
+    if not name or os.sep in name or name.startswith('.'):
+      raise ValueError('Invalid checkpoint name {0!r}'.format(name))
+
+    if directory is None:
+      directory = os.environ.get(Checkpoint.ENVIRONMENT_VARIABLE, Checkpoint.DEFAULT_DIRECTORY)
+
+    self.name = name
+    self.directory = os.path.expanduser(directory)
+
+  @property
+  def path(self):
+    return os.path.join(self.directory, self.name + '.json')
+
+  def load(self):
+    """The saved checkpoint or None if there isn't one"""
+    try:
+      with open(self.path, 'rb') as fd:
+        return json.load(fd)
+    except IOError as ex:
+      if ex.errno == errno.ENOENT:
+        return None
+      raise
+
+  def resume_offset(self, fd):
+    """Where to start reading the open accounting file fd"""
+    saved = self.load()
+    if saved is None:
+      return 0
+
+    st = os.fstat(fd.fileno())
+    if st.st_ino != saved['inode']:
+      warnings.warn('{0} was rotated since checkpoint {1}, reading it from the start'.format(
+        saved['path'], self.name))
+      return 0
+
+    offset = saved['offset']
+    if st.st_size < offset or sge_common.fingerprint(fd, offset) != saved['fingerprint']:
+      warnings.warn('{0} was truncated or rewritten since checkpoint {1}, reading it from the start'.format(
+        saved['path'], self.name))
+      return 0
+
+    return offset
+
+  def save(self, fd, offset):
+    """Record that fd has been read up to offset"""
+    try:
+      os.makedirs(self.directory)
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+
+    state = {
+      'path': os.path.abspath(fd.name),
+      'inode': os.fstat(fd.fileno()).st_ino,
+      'offset': offset,
+      'fingerprint': sge_common.fingerprint(fd, offset),
+    }
+
+    tmp = self.path + '.tmp'
+    with open(tmp, 'wb') as out:
+      json.dump(state, out, indent=1, sort_keys=True)
+    os.rename(tmp, self.path)
@@ -1,8 +1,37 @@
 """Some common things for sge"""
 
+import hashlib
 import os.path
 import os
 
+FINGERPRINT_SIZE = 4096
+
+# read backwards this much at a time looking for the end of the last line
+TAIL_BYTES = 65536
+
+def fingerprint(fd, offset, size=FINGERPRINT_SIZE):
+    """Hash the bytes just before offset.
+
+    Comparing this against a saved value tells a file that was appended to
+    from one that was truncated or replaced in place."""
+    start = max(0, offset - size)
+    fd.seek(start)
+    return hashlib.sha1(fd.read(offset - start)).hexdigest()
+
+def complete_end(fd, size):
+    """The offset just past the last newline in the first size bytes of fd,
+    a line still being written is left for next time"""
+    end = size
+    while end > 0:
+        start = max(0, end - TAIL_BYTES)
+        fd.seek(start)
+        newline = fd.read(end - start).rfind('\n')
+        if newline != -1:
+            return start + newline + 1
+        end = start
+
+    return 0
+
 class Paths(object):
     def __init__(self, env=None):
         if not env:
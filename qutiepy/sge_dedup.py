@@ -0,0 +1,104 @@
+from __future__ import print_function
+
+"""Drop records read more than once from overlapping accounting files.
+
+A copy of the live accounting file and an archive of the same weeks hold
+the same records, read one after the other every job is counted twice. A
+record is the same job as one seen before when its job_number, task_number,
+pe_taskid, end_time and hostname all match.
+
+The keys seen are kept exactly, in sets split by the day of end_time. Only
+the sets of the last RESIDENT_DAYS days used stay in memory, older ones are
+marshalled to a temporary file and read back when a record ending that day
+turns up again. Each file is written in about end_time order, so reading
+them one after another loads a day's set about once per file and memory
+holds a week of keys however many years are read."""
+
+import itertools
+import marshal
+import tempfile
+
+DEDUP_FIELDS = ('job_number', 'task_number', 'pe_taskid', 'end_time', 'hostname')
+
+RESIDENT_DAYS = 7
+
+class Deduplicator(object):
+  """Passes on the first of each set of records with the same key"""
+
+  def __init__(self, resident_days=RESIDENT_DAYS, directory=None):
+    self.resident_days = resident_days
+    self.directory = directory
+    self.duplicates = 0
+
+    # day -> set of keys, and when each was last used
+    self.resident = {}
+    self.used = {}
+    self.clock = itertools.count()
+    # days whose keys changed since they were last spilled
+    self.dirty = set()
+    # day -> (offset, length) of its keys in spilled
+    self.offsets = {}
+    self.spilled = None
+
+    self.day = None
+    self.keys = None
+
+  def _spill(self, day, keys):
+    if self.spilled is None:
+      self.spilled = tempfile.TemporaryFile(prefix='qutiepy-dedup-', dir=self.directory)
+
+    data = marshal.dumps(keys)
+    self.spilled.seek(0, 2)
+    self.offsets[day] = (self.spilled.tell(), len(data))
+    self.spilled.write(data)
+
+  def _load(self, day):
+    offset, length = self.offsets[day]
+    self.spilled.seek(offset)
+    return marshal.loads(self.spilled.read(length))
+
+  def _switch(self, day):
+    """Make the keys of day the current ones"""
+    keys = self.resident.get(day)
+    if keys is None:
+      keys = self._load(day) if day in self.offsets else set()
+
+      if len(self.resident) >= self.resident_days:
+        old_day = min(self.used, key=self.used.get)
+        old_keys = self.resident.pop(old_day)
+        del self.used[old_day]
+        if old_day in self.dirty or old_day not in self.offsets:
+          self._spill(old_day, old_keys)
+          self.dirty.discard(old_day)
+
+      self.resident[day] = keys
+
+    self.used[day] = next(self.clock)
+    self.day = day
+    self.keys = keys
+
+  def filter(self, rows):
+    try:
+      for row in rows:
+        end_time = row.end_time
+        day = end_time.toordinal()
+        if day != self.day:
+          self._switch(day)
+
+        key = (row.job_number, row.task_number, row.pe_taskid, row.hostname,
+          ((end_time.hour * 60 + end_time.minute) * 60 + end_time.second) * 1000000 + end_time.microsecond)
+        if key in self.keys:
+          self.duplicates += 1
+          continue
+
+        self.keys.add(key)
+        self.dirty.add(day)
+        yield row
+
+    finally:
+      self.close()
+
+  def close(self):
+    if self.spilled is not None:
+      self.spilled.close()
+      self.spilled = None
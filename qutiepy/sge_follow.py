@@ -0,0 +1,209 @@
+from __future__ import print_function
+from __future__ import division
+
+"""Follow the live accounting file as sge_qmaster writes to it.
+
+The file is read up to its last complete line, a line still being written is
+left until its newline shows up. When there is nothing new the follower
+waits for the file to change. On Linux it is woken by inotify watching the
+directory, so a record is passed on as soon as it is written and an idle
+follower costs nothing. The file is checked every POLL_MAX seconds as well,
+inotify doesn't see writes made by other hosts to a file on NFS. Without
+inotify the file is polled, every POLL_MIN seconds after a change, backing
+off to POLL_MAX while it stays quiet.
+
+A log that is rotated, a new file under the path, is read to its end before
+the new one is opened and read from the start. One truncated in place is
+read from the start again."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+import warnings
+
+import qutiepy.sge_common as sge_common
+from qutiepy.sge_accounting import SGEAccountingFile
+
+POLL_MIN = 0.05
+POLL_MAX = 0.5
+
+# what is read at most at once
+READ_BYTES = 2**20
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x002
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+_EVENT = struct.Struct('iIII')
+
+class _Inotify(object):
+  """Waits for a file in a directory to change, through libc's inotify"""
+
+  def __init__(self, path):
+    self.name = os.path.basename(path)
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    mask = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    if libc.inotify_add_watch(self.fd, os.path.dirname(os.path.abspath(path)), mask) < 0:
+      error = ctypes.get_errno()
+      os.close(self.fd)
+      raise OSError(error, os.strerror(error))
+
+  @classmethod
+  def create(cls, path):
+    """None where inotify can't be used"""
+    try:
+      return cls(path)
+    except (OSError, AttributeError):
+      return None
+
+  def _changed(self):
+    """Whether any event waiting is about the file"""
+    try:
+      data = os.read(self.fd, 65536)
+    except OSError as ex:
+      if ex.errno == errno.EAGAIN:
+        return False
+      raise
+
+    offset = 0
+    changed = False
+    while offset < len(data):
+      wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+      offset += _EVENT.size
+      name = data[offset:offset + length].rstrip('\0')
+      offset += length
+      changed = changed or name == self.name
+
+    return changed
+
+  def wait(self, timeout):
+    deadline = time.time() + timeout
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return
+
+      if select.select([self.fd], [], [], remaining)[0] and self._changed():
+        return
+
+  def close(self):
+    os.close(self.fd)
+
+class AccountingFollower(object):
+  """The records of the accounting file at path from offset on, waiting for
+  more at its end for ever. An offset of None starts at the end of what is
+  there now. idle is called whenever everything written so far has been
+  handed out and the follower is about to wait.
+
+  fd and offset are the file being read and how far into it the records
+  handed out go, what a Checkpoint saves."""
+
+  def __init__(self, path, offset=None, line_filter=None, columns=None, idle=None):
+    self.path = path
+    self.line_filter = line_filter
+    self.columns = columns
+    self.idle = idle
+
+    self.fd = open(path, 'rb')
+    if offset is None:
+      offset = sge_common.complete_end(self.fd, os.fstat(self.fd.fileno()).st_size)
+    self.offset = offset
+
+  def _lines(self, partial=False):
+    """The complete lines after offset, all of them when partial is set"""
+    self.fd.seek(self.offset)
+    chunks = [self.fd.read(READ_BYTES)]
+    # a line longer than READ_BYTES is read on until its newline, or to the
+    # end of the file for the partial line left at the end of an old log
+    while chunks[-1] and (partial or '\n' not in chunks[-1]):
+      chunks.append(self.fd.read(READ_BYTES))
+
+    data = ''.join(chunks)
+    end = len(data) if partial else data.rfind('\n') + 1
+    self.offset += end
+    return data[:end].splitlines(True)
+
+  def _rows(self, lines):
+    return [SGEAccountingFile.make_row(record)
+      for record in SGEAccountingFile.build_reader(lines, self.line_filter, self.columns)]
+
+  def _replacement(self):
+    """The file now at path when it is no longer the one being read"""
+    try:
+      st = os.stat(self.path)
+    except OSError as ex:
+      if ex.errno == errno.ENOENT:
+        # in between moving the old log away and creating the new one
+        return None
+      raise
+
+    if st.st_ino != os.fstat(self.fd.fileno()).st_ino:
+      return open(self.path, 'rb')
+
+    if st.st_size < self.offset:
+      warnings.warn('{0} was truncated, reading it from the start'.format(self.path))
+      self.offset = 0
+    return None
+
+  def __iter__(self):
+    inotify = _Inotify.create(self.path)
+    poll = POLL_MIN
+    # whether records were handed out since idle was last called
+    busy = True
+    try:
+      while True:
+        lines = self._lines()
+        if lines:
+          for row in self._rows(lines):
+            yield row
+          busy = True
+          poll = POLL_MIN
+          continue
+
+        offset = self.offset
+        replacement = self._replacement()
+        if replacement is not None:
+          # the rest of the old log, a last line without a newline included
+          lines = self._lines()
+          while lines:
+            for row in self._rows(lines):
+              yield row
+            lines = self._lines()
+          for row in self._rows(self._lines(partial=True)):
+            yield row
+
+          self.fd.close()
+          self.fd = replacement
+          self.offset = 0
+          continue
+
+        if self.offset != offset:
+          # truncated
+          continue
+
+        if busy and self.idle is not None:
+          self.idle()
+        busy = False
+
+        if inotify is not None:
+          inotify.wait(POLL_MAX)
+        else:
+          time.sleep(poll)
+          poll = min(poll * 2, POLL_MAX)
+
+    finally:
+      if inotify is not None:
+        inotify.close()
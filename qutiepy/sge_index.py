@@ -0,0 +1,267 @@
+from __future__ import print_function
+from __future__ import division
+
+"""Sparse time index of plain accounting files.
+
+Every BLOCK_RECORDS records the index notes the byte offset the block starts
+at and the smallest and largest submission, start and end time in it. The
+log is written in roughly end time order but not exactly, jobs finish out of
+order and clocks jump, so instead of trusting the order the index keeps the
+running maximum of the block maxima and the running minimum, from the end,
+of the block minima. Both only ever grow, so a bisect over them finds the
+first block that can hold a time after a bound and the last that can hold
+one before it, however out of order the records are. Disorder only makes
+the range read wider, never drops a record, and within the range only the
+blocks whose own times overlap the bounds are read.
+
+The index of a file that has only been appended to is extended from its
+last partial block, anything else is rebuilt."""
+
+import bisect
+import datetime
+import errno
+import hashlib
+import json
+import operator
+import os
+import time
+
+import qutiepy.filter.BaseTypes as BaseTypes
+import qutiepy.sge_common as sge_common
+from qutiepy.sge_accounting import SGEAccountingFile
+
+INDEX_VERSION = 1
+BLOCK_RECORDS = 1024
+
+# the indexed fields and where they are in a record
+FIELDS = (('submission_time', 8), ('start_time', 9), ('end_time', 10))
+
+# Bounds are widened by this many seconds. Rows convert times to local
+# datetimes and the filter constants are local too, this covers a clock
+# change between the two conversions.
+MARGIN = 2 * 3600
+
+_LOWER = (operator.gt, operator.ge, operator.eq)
+_UPPER = (operator.lt, operator.le, operator.eq)
+
+def epoch(value):
+  """Seconds since the epoch of a local datetime"""
+  return time.mktime(value.timetuple()) + value.microsecond / 10**6
+
+def time_bounds(filter):
+  """{field: [low, high]} in seconds since the epoch that every record
+  matching filter lies within, None for an open end. Only comparisons
+  and'ed together at the top of the filter narrow anything."""
+  bounds = {}
+  fields = dict(FIELDS)
+  clauses = [filter]
+  while clauses:
+    f = clauses.pop()
+    if isinstance(f, BaseTypes.AndFilter):
+      clauses.extend(f.filters)
+      continue
+
+    if not isinstance(f, BaseTypes.ComparatorFilter) or f.field not in fields:
+      continue
+
+    try:
+      value = epoch(BaseTypes.coerce(f.rhs, datetime.datetime))
+    except (ValueError, OverflowError, TypeError):
+      continue
+
+    low, high = bounds.get(f.field, (None, None))
+    if f.predicate in _LOWER:
+      low = value - MARGIN if low is None else max(low, value - MARGIN)
+    if f.predicate in _UPPER:
+      high = value + MARGIN if high is None else min(high, value + MARGIN)
+
+    if low is not None or high is not None:
+      bounds[f.field] = [low, high]
+
+  return bounds
+
+def _record_times(line):
+  fields = line.split(':', 11)
+  # UGE writes more than 45 fields and its times in milliseconds
+  scale = 1000 if line.count(':') > 44 else 1
+  return [int(fields[pos]) / scale for name, pos in FIELDS]
+
+class TimeIndex(object):
+  """The index of one accounting file, kept in path"""
+
+  def __init__(self, path, source):
+    self.path = path
+    self.source = source
+    self.meta = None
+
+  def _load(self):
+    try:
+      with open(self.path, 'rb') as fd:
+        meta = json.load(fd)
+    except IOError as ex:
+      if ex.errno == errno.ENOENT:
+        return None
+      raise
+    except ValueError:
+      return None
+
+    if meta.get('version') != INDEX_VERSION or meta.get('source') != self.source:
+      return None
+    return meta
+
+  def _save(self, meta):
+    tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+    with open(tmp, 'wb') as out:
+      json.dump(meta, out)
+    os.rename(tmp, self.path)
+
+  def refresh(self):
+    """Bring the index up to date with the source file"""
+    try:
+      os.makedirs(os.path.dirname(self.path))
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+
+    with open(self.source, 'rb') as fd:
+      st = os.fstat(fd.fileno())
+      meta = self._load()
+
+      if meta is not None and meta['inode'] == st.st_ino and meta['size'] == st.st_size:
+        self.meta = meta
+        return
+
+      if (meta is None or meta['inode'] != st.st_ino or st.st_size < meta['offset']
+          or sge_common.fingerprint(fd, meta['offset']) != meta['fingerprint']):
+        meta = {
+          'version': INDEX_VERSION,
+          'source': self.source,
+          'fields': [name for name, pos in FIELDS],
+          'offset': 0,
+          # [offset, records, then min and max of each field]
+          'blocks': [],
+        }
+
+      self._extend(fd, meta)
+      meta.update(inode=st.st_ino, size=st.st_size,
+        fingerprint=sge_common.fingerprint(fd, meta['offset']))
+      self._save(meta)
+      self.meta = meta
+
+  def _extend(self, fd, meta):
+    blocks = meta['blocks']
+    if blocks and blocks[-1][1] < BLOCK_RECORDS:
+      # the last block fills up before a new one starts
+      meta['offset'] = blocks.pop()[0]
+
+    block = None
+    for offset, line in SGEAccountingFile.read_lines(fd, meta['offset']):
+      if block is None:
+        block = [offset, 0] + [float('inf'), float('-inf')] * len(FIELDS)
+        blocks.append(block)
+
+      try:
+        lows = highs = _record_times(line)
+      except (ValueError, IndexError):
+        # a broken record could hold any time, so could its block
+        lows, highs = [float('-inf')] * len(FIELDS), [float('inf')] * len(FIELDS)
+
+      for i in xrange(len(FIELDS)):
+        block[2 + 2 * i] = min(block[2 + 2 * i], lows[i])
+        block[3 + 2 * i] = max(block[3 + 2 * i], highs[i])
+
+      block[1] += 1
+      meta['offset'] = offset + len(line)
+      if block[1] == BLOCK_RECORDS:
+        block = None
+
+  def ranges(self, bounds):
+    """(start, end) byte ranges that hold every record within bounds, an
+    end of None reads to the end of the file"""
+    blocks = self.meta['blocks']
+    columns = [(2 + 2 * self.meta['fields'].index(name), low, high)
+      for name, (low, high) in bounds.items()]
+    first, last = 0, len(blocks)
+
+    for column, low, high in columns:
+      if low is not None:
+        reach = []
+        for block in blocks:
+          reach.append(max(reach[-1], block[column + 1]) if reach else block[column + 1])
+        first = max(first, bisect.bisect_left(reach, low))
+
+      if high is not None:
+        floor = []
+        for block in reversed(blocks):
+          floor.append(min(floor[-1], block[column]) if floor else block[column])
+        floor.reverse()
+        last = min(last, bisect.bisect_right(floor, high))
+
+    # a record far out of order widens the window above, so each block in
+    # it is checked on its own and the ones that can hold a match merged
+    ranges = []
+    for i in xrange(first, last):
+      block = blocks[i]
+      if any((low is not None and block[column + 1] < low) or (high is not None and block[column] > high)
+          for column, low, high in columns):
+        continue
+
+      end = blocks[i + 1][0] if i + 1 < len(blocks) else self.meta['offset']
+      if ranges and ranges[-1][1] == block[0]:
+        ranges[-1] = (ranges[-1][0], end)
+      else:
+        ranges.append((block[0], end))
+
+    # records written since the index was brought up to date are always read
+    if ranges and ranges[-1][1] == self.meta['offset']:
+      ranges[-1] = (ranges[-1][0], None)
+    else:
+      ranges.append((self.meta['offset'], None))
+
+    return ranges
+
+class AccountingIndex(object):
+  """A directory of TimeIndexes, one per accounting file"""
+
+  ENVIRONMENT_VARIABLE = 'QUTIEPY_INDEX_DIR'
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  @classmethod
+  def from_option(cls, directory):
+    """None when indexing is turned off"""
+    if not directory:
+      return None
+    return cls(directory)
+
+  @staticmethod
+  def indexable(path):
+    return path != '-' and os.path.splitext(path)[1] not in ('.gz', '.bz2')
+
+  def index(self, path):
+    source = os.path.abspath(path)
+    key = '{0}-{1}.json'.format(
+      hashlib.sha1(source).hexdigest()[:16],
+      os.path.basename(source))
+
+    index = TimeIndex(os.path.join(self.directory, key), source)
+    index.refresh()
+    return index
+
+  def ranges(self, path, bounds):
+    return self.index(path).ranges(bounds)
+
+  def rows(self, path, bounds, line_filter=None, columns=None):
+    """The rows of path that may be within bounds, see time_bounds"""
+    ranges = self.ranges(path, bounds)
+
+    def lines():
+      with open(path, 'rb') as fd:
+        for start, end in ranges:
+          for offset, line in SGEAccountingFile.read_lines(fd, start, partial=True):
+            if end is not None and offset >= end:
+              break
+            yield line
+
+    return iter(SGEAccountingFile(lines(), line_filter=line_filter, columns=columns))
@@ -0,0 +1,356 @@
+from __future__ import print_function
+
+"""Parse accounting files across a pool of processes.
+
+A plain accounting file is cut into byte ranges that end on a newline. Each
+worker reads its range, tokenizes the lines, runs any filters pushed down to
+it and sends back the records that are left. Records come back either in
+file order or as soon as a range is done, which keeps every worker busy when
+one range is slow. Only a window of ranges is in flight at once so a
+consumer that falls behind doesn't pile the whole file up in memory.
+
+Compressed files can't be split, instead a process per file decompresses
+and parses it ahead of time, up to one file per job at once. Each hands its
+records over in batches through a queue that only holds a few of them, so a
+reader that gets ahead blocks rather than filling memory. In file order the
+files are taken one after another while the next ones are prefetched,
+otherwise batches are taken from whichever file has one ready.
+
+Standard in and cached files are read the usual way and the filters are run
+on them here."""
+
+import collections
+import fileinput
+import itertools
+import marshal
+import multiprocessing
+import os
+import Queue
+import signal
+
+import qutiepy.filter.BaseTypes as BaseTypes
+import qutiepy.filter.Compiler as Compiler
+from qutiepy.sge_accounting import SGEAccountingFile, open_accounting_files
+
+CHUNK_BYTES = 16 * 2**20
+BATCH_RECORDS = 10000
+PREFETCH_BATCHES = 4
+
+def byte_ranges(fd, chunk_bytes=CHUNK_BYTES, start=0, end=None):
+  """Split fd from start to end, or its end, into (start, end) ranges of
+  about chunk_bytes ending on newlines. start has to be the start of a line."""
+  size = os.fstat(fd.fileno()).st_size
+  if end is not None:
+    size = min(size, end)
+
+  ranges = []
+  while start < size:
+    fd.seek(min(start + chunk_bytes, size))
+    # the range runs to the end of the line the cut falls in
+    fd.readline()
+    end = min(fd.tell(), size)
+    ranges.append((start, end))
+    start = end
+
+  return ranges
+
+def _filtered_records(records, filters):
+  if not filters:
+    return records
+
+  rows = itertools.imap(SGEAccountingFile.make_row, records)
+  for tree, reorder in filters:
+    rows = Compiler.filter_rows(tree, rows, reorder)
+
+  return (row._rawrow for row in rows)
+
+def _error(ex):
+  return '{0}: {1}'.format(type(ex).__name__, ex)
+
+_worker_filters = ()
+_worker_line_filter = None
+_worker_columns = None
+
+def _init_worker(filters, line_filter, columns):
+  global _worker_filters, _worker_line_filter, _worker_columns
+  # ^C is the parent's to handle, it tears the pool down
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  _worker_filters = filters
+  _worker_line_filter = line_filter
+  _worker_columns = columns
+
+def range_lines(path, start, end):
+  """The lines of path between the byte offsets start and end, see
+  byte_ranges"""
+  with open(path, 'rb') as fd:
+    fd.seek(start)
+    return fd.read(end - start).splitlines(True)
+
+def _parse_range(task):
+  path, start, end = task
+  try:
+    lines = range_lines(path, start, end)
+    records = _filtered_records(
+      SGEAccountingFile.build_reader(lines, _worker_line_filter, _worker_columns), _worker_filters)
+
+    # marshal loads a list of lists of strings faster than pickle or csv
+    return True, marshal.dumps(list(records))
+
+  except Exception as ex:
+    return False, _error(ex)
+
+def _prefetch_file(path, filters, line_filter, columns, queue, tag):
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  try:
+    records = _filtered_records(
+      SGEAccountingFile.build_reader(fileinput.hook_compressed(path, 'rb'), line_filter, columns), filters)
+
+    while True:
+      batch = list(itertools.islice(records, BATCH_RECORDS))
+      if not batch:
+        break
+      queue.put((tag, True, marshal.dumps(batch)))
+
+    queue.put((tag, True, None))
+
+  except Exception as ex:
+    queue.put((tag, False, _error(ex)))
+
+class _Prefetch(object):
+  """A process reading a compressed file into queue, (tag, ok, batch) at a
+  time with None for a batch once the file is done"""
+
+  def __init__(self, path, filters, line_filter, columns, queue, tag):
+    self.path = path
+    self.queue = queue
+    self.tag = tag
+    self.process = multiprocessing.Process(target=_prefetch_file,
+      args=(path, filters, line_filter, columns, queue, tag))
+    self.process.daemon = True
+    self.process.start()
+
+def _receive(queue, prefetches):
+  while True:
+    try:
+      return queue.get(timeout=1)
+    except Queue.Empty:
+      if not any(prefetch.process.is_alive() for prefetch in prefetches):
+        raise RuntimeError('Reading {0} stopped without finishing'.format(
+          ', '.join(prefetch.path for prefetch in prefetches)))
+
+def _finished(finished, pending, pool, workers):
+  """The next (index, result) put on finished. An exception func raised
+  for a pending task is raised here, as is a worker dying, which would
+  leave its task pending forever."""
+  while True:
+    try:
+      # a timeout also lets ^C through, which a bare get doesn't in python 2
+      return finished.get(timeout=1)
+    except Queue.Empty:
+      # the callback isn't called for a task that raised
+      for result in pending.itervalues():
+        if result.ready() and not result.successful():
+          result.get()
+
+      # the pool only replaces a worker that died
+      if set(worker.pid for worker in pool._pool) != workers:
+        raise RuntimeError('A worker process died before finishing its task')
+
+def windowed_map(pool, func, tasks, window, ordered=True):
+  """pool.imap with at most window results in flight or waiting to be taken"""
+  tasks = iter(enumerate(tasks))
+  finished = Queue.Queue()
+  pending = {}
+  results = {}
+  outstanding = 0
+  expected = 0
+  workers = set(worker.pid for worker in pool._pool)
+
+  def submit():
+    for i, task in tasks:
+      pending[i] = pool.apply_async(func, (task,), callback=lambda result, i=i: finished.put((i, result)))
+      return 1
+    return 0
+
+  for i in xrange(window):
+    outstanding += submit()
+
+  while outstanding:
+    i, result = _finished(finished, pending, pool, workers)
+    del pending[i]
+    outstanding -= 1
+
+    if not ordered:
+      outstanding += submit()
+      yield result
+      continue
+
+    results[i] = result
+    while expected in results:
+      yield results.pop(expected)
+      expected += 1
+
+    # results held back for order count against the window as well
+    while outstanding + len(results) < window and submit():
+      outstanding += 1
+
+class ParallelReader(object):
+  """Read accounting files with a pool of jobs processes.
+
+  filters is a sequence of (filter tree, reorder) pairs, see
+  qutiepy.filter.Compiler.filter_rows, every record handed out has passed
+  them. What of them can be tested on the raw lines is, before they are
+  tokenized. The workers are forked with the filters in place so the
+  trees don't have to pickle. With columns only that many fields are split
+  off the front of each line, see
+  qutiepy.sge_accounting.projected_columns, which also makes for less to
+  send back."""
+
+  def __init__(self, jobs=None, ordered=True, filters=(), columns=None, chunk_bytes=CHUNK_BYTES):
+    self.jobs = jobs or multiprocessing.cpu_count()
+    self.ordered = ordered
+    self.filters = tuple(filters)
+    self.columns = columns
+    self.line_filter = None
+    if self.filters:
+      self.line_filter = Compiler.compile_line_filter(
+        BaseTypes.AndFilter(*[tree for tree, reorder in self.filters]))
+    self.chunk_bytes = chunk_bytes
+    self.pool = None
+    self.prefetches = []
+
+  @staticmethod
+  def splittable(path):
+    return path != '-' and os.path.splitext(path)[1] not in ('.gz', '.bz2')
+
+  def filter(self, rows):
+    """Run the filters over rows read some other way"""
+    for tree, reorder in self.filters:
+      rows = Compiler.filter_rows(tree, rows, reorder)
+    return rows
+
+  def rows(self, path, ranges=((0, None),)):
+    """The records of one plain accounting file, or of the (start, end)
+    byte ranges of it"""
+    if self.pool is None:
+      self.pool = multiprocessing.Pool(self.jobs, _init_worker,
+        (self.filters, self.line_filter, self.columns))
+
+    tasks = []
+    with open(path, 'rb') as fd:
+      for start, end in ranges:
+        tasks.extend((path, chunk_start, chunk_end)
+          for chunk_start, chunk_end in byte_ranges(fd, self.chunk_bytes, start, end))
+
+    for ok, payload in windowed_map(self.pool, _parse_range, tasks, 2 * self.jobs, self.ordered):
+      if not ok:
+        raise ValueError('Error parsing {0}: {1}'.format(path, payload))
+
+      for record in marshal.loads(payload):
+        yield SGEAccountingFile.make_row(record)
+
+  def _batches(self, queue, running, refill=None):
+    """Rows from the batches on queue until the running prefetches are
+    done, refill is called whenever one finishes"""
+    while running:
+      tag, ok, payload = _receive(queue, running)
+      prefetch = next(prefetch for prefetch in running if prefetch.tag == tag)
+      if not ok:
+        raise ValueError('Error parsing {0}: {1}'.format(prefetch.path, payload))
+
+      if payload is None:
+        prefetch.process.join()
+        running.remove(prefetch)
+        if refill is not None:
+          refill()
+        continue
+
+      for record in marshal.loads(payload):
+        yield SGEAccountingFile.make_row(record)
+
+  def _prefetch(self, path, queue=None):
+    if queue is None:
+      queue = multiprocessing.Queue(PREFETCH_BATCHES)
+
+    # a missing file is reported here like it would be read in order
+    open(path, 'rb').close()
+
+    prefetch = _Prefetch(path, self.filters, self.line_filter, self.columns, queue, len(self.prefetches))
+    self.prefetches.append(prefetch)
+    return prefetch
+
+  def open_accounting_files(self, paths, cache=None, index=None, bounds=None):
+    """Like qutiepy.sge_accounting.open_accounting_files, with plain files
+    split across the pool and compressed ones read ahead in their own
+    processes"""
+    compressed = [path for path in paths
+      if cache is None and path != '-' and not self.splittable(path)]
+
+    try:
+      if self.ordered:
+        records = self._ordered(paths, cache, index, bounds, compressed)
+      else:
+        records = self._unordered(paths, cache, index, bounds, compressed)
+
+      for row in records:
+        yield row
+
+    finally:
+      self.close()
+
+  def _others(self, path, cache, index, bounds):
+    if cache is None and self.splittable(path):
+      if index is not None and bounds:
+        return self.rows(path, index.ranges(path, bounds))
+      return self.rows(path)
+
+    return self.filter(open_accounting_files([path], cache,
+      line_filter=self.line_filter, columns=self.columns))
+
+  def _ordered(self, paths, cache, index, bounds, compressed):
+    ahead = collections.deque()
+    compressed = collections.deque(compressed)
+
+    for path in paths:
+      while compressed and len(ahead) < self.jobs:
+        ahead.append(self._prefetch(compressed.popleft()))
+
+      if ahead and ahead[0].path == path:
+        prefetch = ahead.popleft()
+        records = self._batches(prefetch.queue, [prefetch])
+      else:
+        records = self._others(path, cache, index, bounds)
+
+      for row in records:
+        yield row
+
+  def _unordered(self, paths, cache, index, bounds, compressed):
+    queue = multiprocessing.Queue(PREFETCH_BATCHES * self.jobs)
+    compressed = collections.deque(compressed)
+    running = []
+
+    def start():
+      while compressed and len(running) < self.jobs:
+        running.append(self._prefetch(compressed.popleft(), queue))
+
+    # the first files are decompressing while the rest are read
+    start()
+    for path in paths:
+      if cache is not None or path == '-' or self.splittable(path):
+        for row in self._others(path, cache, index, bounds):
+          yield row
+
+    for row in self._batches(queue, running, start):
+      yield row
+
+  def close(self):
+    for prefetch in self.prefetches:
+      if prefetch.process.is_alive():
+        prefetch.process.terminate()
+      prefetch.process.join()
+    self.prefetches = []
+
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool.join()
+      self.pool = None
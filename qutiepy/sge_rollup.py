@@ -0,0 +1,190 @@
+from __future__ import print_function
+
+"""Totals of accounting files kept from one run to the next.
+
+For each source file the store keeps totals split into buckets, one per
+month say, and how far into the file they go: the byte offset past the last
+record counted with a hash of the bytes in front of it, and the inode, size
+and mtime of the file. A later run only has to total the records written
+since then and rewrites just the buckets those records fall in. A log that
+was rotated, truncated or rewritten, or a compressed archive that changed at
+all, is totalled again from the start.
+
+Buckets are pickled objects with a merge() method. A save writes the changed
+buckets under a new generation and only then points meta.json at them, a
+run that dies part way through leaves the previous totals and watermark as
+they were."""
+
+import cPickle as pickle
+import errno
+import fcntl
+import hashlib
+import json
+import os
+
+import qutiepy.sge_common as sge_common
+from qutiepy.sge_cache import COMPRESSED_EXTENSIONS
+
+STORE_VERSION = 1
+
+class SourceRollup(object):
+  """The stored totals of a single accounting file.
+
+  lock() works out what is left to read into ranges, a list of (start, end)
+  byte ranges with an end of None for all of a compressed file. The new
+  totals are handed to commit(), which also releases the lock."""
+
+  def __init__(self, directory, path, version):
+    self.directory = directory
+    self.path = path
+    self.source = os.path.abspath(path)
+    self.version = version
+    self.compressed = os.path.splitext(path)[1] in COMPRESSED_EXTENSIONS
+
+    self.meta = None
+    self.ranges = []
+    self._lock = None
+    self._update = None
+
+  def _path(self, name):
+    return os.path.join(self.directory, name)
+
+  def _load_meta(self):
+    try:
+      with open(self._path('meta.json'), 'rb') as fd:
+        meta = json.load(fd)
+    except (IOError, ValueError):
+      return None
+
+    if (meta.get('version') != STORE_VERSION or meta.get('rollup_version') != self.version
+        or meta.get('source') != self.source):
+      return None
+
+    return meta
+
+  def _save_meta(self, meta):
+    tmp = self._path('meta.json.tmp')
+    with open(tmp, 'wb') as fd:
+      json.dump(meta, fd, indent=1, sort_keys=True)
+    os.rename(tmp, self._path('meta.json'))
+
+  def lock(self):
+    try:
+      os.makedirs(self.directory)
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+
+    self._lock = open(self._path('lock'), 'wb')
+    fcntl.flock(self._lock, fcntl.LOCK_EX)
+
+    meta = self._load_meta()
+    with open(self.source, 'rb') as fd:
+      st = os.fstat(fd.fileno())
+      stat = dict(inode=st.st_ino, size=st.st_size, mtime=st.st_mtime)
+
+      if self.compressed:
+        if meta is not None and all(meta[k] == v for k, v in stat.items()):
+          self.ranges = []
+        else:
+          meta = None
+          self.ranges = [(0, None)]
+        self._update = dict(stat, offset=None, fingerprint=None)
+
+      else:
+        if (meta is None or meta['inode'] != st.st_ino or st.st_size < meta['offset']
+            or sge_common.fingerprint(fd, meta['offset']) != meta['fingerprint']):
+          meta = None
+
+        start = 0 if meta is None else meta['offset']
+        end = sge_common.complete_end(fd, st.st_size)
+        self.ranges = [(start, end)] if end > start else []
+        self._update = dict(stat, offset=end, fingerprint=sge_common.fingerprint(fd, end))
+
+    if meta is None:
+      # nothing stored or it no longer applies, the file is read from the start
+      meta = {
+        'version': STORE_VERSION,
+        'rollup_version': self.version,
+        'source': self.source,
+        'generation': 0,
+        'buckets': [],
+      }
+    self.meta = meta
+
+  def buckets(self):
+    """{key: totals} of everything stored"""
+    buckets = {}
+    for key, name in self.meta['buckets']:
+      with open(self._path(name), 'rb') as fd:
+        buckets[tuple(key)] = pickle.load(fd)
+
+    return buckets
+
+  def commit(self, buckets):
+    """Merge {key: totals} of the records in ranges into the stored totals"""
+    try:
+      # past any file left by an earlier life of the store, so nothing
+      # meta.json points at is ever overwritten
+      generation = 1 + max([self.meta['generation']] + [int(name.split('.')[-2])
+        for name in os.listdir(self.directory) if name.endswith('.pickle')])
+      stored = dict((tuple(key), name) for key, name in self.meta['buckets'])
+
+      for key, totals in buckets.iteritems():
+        if key in stored:
+          with open(self._path(stored[key]), 'rb') as fd:
+            previous = pickle.load(fd)
+          previous.merge(totals)
+          totals = previous
+
+        name = '{0}.{1}.pickle'.format('-'.join(str(part) for part in key), generation)
+        with open(self._path(name), 'wb') as fd:
+          pickle.dump(totals, fd, pickle.HIGHEST_PROTOCOL)
+        stored[key] = name
+
+      meta = dict(self.meta, generation=generation,
+        buckets=sorted([list(key), name] for key, name in stored.items()))
+      meta.update(self._update)
+      self._save_meta(meta)
+      self.meta = meta
+
+      # the buckets replaced, along with any from before a rebuild or left
+      # by a run that died part way
+      live = set(name for key, name in meta['buckets'])
+      for name in os.listdir(self.directory):
+        if name.endswith('.pickle') and name not in live:
+          os.unlink(self._path(name))
+
+    finally:
+      self.close()
+
+  def close(self):
+    if self._lock is not None:
+      self._lock.close()
+      self._lock = None
+
+class RollupStore(object):
+  """A directory of SourceRollups, one per accounting file.
+
+  name keeps the totals of different reports apart, a change to version
+  throws away totals pickled by an older release."""
+
+  ENVIRONMENT_VARIABLE = 'QUTIEPY_ROLLUP_DIR'
+
+  def __init__(self, directory, name, version):
+    self.directory = os.path.join(directory, name)
+    self.version = version
+
+  @classmethod
+  def from_option(cls, directory, name, version):
+    """None when the store is turned off"""
+    if not directory:
+      return None
+    return cls(directory, name, version)
+
+  def source(self, path):
+    source = os.path.abspath(path)
+    key = '{0}-{1}'.format(
+      hashlib.sha1(source).hexdigest()[:16],
+      os.path.basename(source))
+    return SourceRollup(os.path.join(self.directory, key), path, self.version)
@@ -0,0 +1,333 @@
+from __future__ import print_function
+from __future__ import division
+
+"""Answer queries over records held in memory.
+
+A server reads its records once, in a thread of its own, keeps them in the
+order they came and listens on a Unix domain socket. A client sends its
+command line, the server forks a process that runs the pipeline components
+over the records and sends their output back. The fork hands each query the
+records as they are at that moment without copying anything up front and
+queries run side by side.
+
+Records are held as their text, a parsed record takes up seven times the
+memory. Each query splits off only the fields its pipeline reads, see
+qutiepy.sge_accounting.projected_columns.
+
+Like qutiepy.sge_index does for files, every BLOCK_RECORDS records the
+smallest and largest submission, start and end time are noted, a query only
+goes through the blocks that can hold records within the time bounds of its
+leading filters.
+
+A request is one frame holding the client's working directory and arguments
+separated by NULs. The answer is frames of standard out and standard error
+followed by one with the exit status."""
+
+import errno
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import threading
+import traceback
+
+from qutiepy.sge_accounting import SGEAccountingFile, UGEAccountingRow
+from qutiepy.sge_index import BLOCK_RECORDS, FIELDS
+
+# how often finished queries are reaped and the reader is checked on
+WAKE_SECONDS = 1.0
+
+LISTEN_BACKLOG = 64
+
+# standard out is sent once this much has been written to it
+CHANNEL_BYTES = 2**16
+
+# kind, length
+_FRAME = struct.Struct('!cI')
+
+def _send(connection, kind, data):
+  connection.sendall(_FRAME.pack(kind, len(data)) + data)
+
+def _receive(fd):
+  """(kind, data) of the next frame read from the file fd, None at its end"""
+  header = fd.read(_FRAME.size)
+  if len(header) < _FRAME.size:
+    return None
+
+  kind, length = _FRAME.unpack(header)
+  data = fd.read(length)
+  if len(data) < length:
+    return None
+  return kind, data
+
+class _Channel(object):
+  """A file object sending what is written to it as frames of kind"""
+
+  def __init__(self, connection, kind, buffer_bytes=0):
+    self.connection = connection
+    self.kind = kind
+    self.buffer_bytes = buffer_bytes
+    self.chunks = []
+    self.size = 0
+
+  def write(self, text):
+    self.chunks.append(text)
+    self.size += len(text)
+    if self.size >= self.buffer_bytes:
+      self.flush()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    if self.chunks:
+      _send(self.connection, self.kind, ''.join(self.chunks))
+      self.chunks = []
+      self.size = 0
+
+  def isatty(self):
+    return False
+
+class RecordStore(object):
+  """Records in the order they were added, indexed by their times"""
+
+  def __init__(self):
+    # the fields of each record joined back into a line
+    self.lines = []
+    # [first line, low, high, low, high, ...] for each block, the times in
+    # FIELDS order
+    self.blocks = []
+    # held while records are added, a fork taken under it sees whole blocks
+    self.lock = threading.Lock()
+
+  def add(self, row):
+    raw = row._rawrow
+    # UGE writes its times in milliseconds
+    scale = 1000 if isinstance(row, UGEAccountingRow) else 1
+    try:
+      lows = highs = [int(raw[pos]) / scale for name, pos in FIELDS]
+    except (ValueError, IndexError):
+      # a broken record could hold any time, so could its block
+      lows, highs = [float('-inf')] * len(FIELDS), [float('inf')] * len(FIELDS)
+
+    with self.lock:
+      if len(self.lines) % BLOCK_RECORDS == 0:
+        self.blocks.append([len(self.lines)] + [float('inf'), float('-inf')] * len(FIELDS))
+
+      block = self.blocks[-1]
+      for i in xrange(len(FIELDS)):
+        block[1 + 2 * i] = min(block[1 + 2 * i], lows[i])
+        block[2 + 2 * i] = max(block[2 + 2 * i], highs[i])
+      self.lines.append(':'.join(raw))
+
+  def rows_within(self, bounds, columns=None):
+    """The records that may be within bounds, see
+    qutiepy.sge_index.time_bounds, in the order they were added. Only the
+    first columns fields of each are split out."""
+    names = [name for name, pos in FIELDS]
+    ranges = [(1 + 2 * names.index(name), low, high) for name, (low, high) in (bounds or {}).items()]
+
+    for block in self.blocks:
+      if any((low is not None and block[column + 1] < low) or (high is not None and block[column] > high)
+          for column, low, high in ranges):
+        continue
+
+      for line in self.lines[block[0]:block[0] + BLOCK_RECORDS]:
+        yield SGEAccountingFile.make_row(line.split(':', columns) if columns is not None else line.split(':'))
+
+class RecordServer(object):
+  """Serves records on the Unix domain socket at path.
+
+  Iterating over it reads records into a RecordStore in the background and
+  answers queries until interrupted, it hands out nothing itself. Queries
+  are only taken once records has ended or caught_up() has been called.
+  answer(argv, store) runs a query in the process forked for it, with
+  standard out and error going to the client, an exit status is passed on
+  with SystemExit."""
+
+  def __init__(self, path, records, answer=None):
+    self.path = path
+    self.records = records
+    self.answer = answer
+    self.store = RecordStore()
+    self.ready = threading.Event()
+    self.failure = None
+    self.children = set()
+
+  def caught_up(self):
+    """Every record there is so far has been read"""
+    self.ready.set()
+
+  def _read(self):
+    try:
+      for row in self.records:
+        self.store.add(row)
+    except Exception as ex:
+      self.failure = ex
+    self.ready.set()
+
+  def _check(self):
+    """Raise what stopped the reader in the thread serving"""
+    if self.failure is not None:
+      raise self.failure
+
+  def __iter__(self):
+    self.serve()
+    return iter(())
+
+  def serve(self):
+    # found out before the records are read rather than after
+    self._remove_stale()
+
+    reader = threading.Thread(target=self._read, name='qutiepy-reader')
+    # interrupting the server doesn't wait for a reader following the log
+    reader.daemon = True
+    reader.start()
+
+    while not self.ready.wait(WAKE_SECONDS):
+      pass
+    self._check()
+
+    listener = self._listen()
+    try:
+      while True:
+        self._check()
+        self._reap()
+        if select.select([listener], [], [], WAKE_SECONDS)[0]:
+          connection, address = listener.accept()
+          self._fork(listener, connection)
+
+    finally:
+      listener.close()
+      try:
+        os.remove(self.path)
+      except OSError as ex:
+        if ex.errno != errno.ENOENT:
+          raise
+
+  def _remove_stale(self):
+    """Remove a socket left at path by a server that is gone, one still
+    being listened on is an error"""
+    try:
+      if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+        return
+    except OSError as ex:
+      if ex.errno == errno.ENOENT:
+        return
+      raise
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(self.path)
+    except socket.error as ex:
+      if ex.errno != errno.ECONNREFUSED:
+        raise
+      os.remove(self.path)
+      return
+    finally:
+      probe.close()
+
+    raise socket.error(errno.EADDRINUSE, 'A server is already listening on {0}'.format(self.path))
+
+  def _listen(self):
+    self._remove_stale()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      # only the user running the server can connect until the socket is
+      # chmod'ed, a query runs with the server's permissions
+      umask = os.umask(0o177)
+      try:
+        listener.bind(self.path)
+      finally:
+        os.umask(umask)
+      listener.listen(LISTEN_BACKLOG)
+    except:
+      listener.close()
+      raise
+
+    return listener
+
+  def _reap(self):
+    for pid in list(self.children):
+      if os.waitpid(pid, os.WNOHANG)[0]:
+        self.children.discard(pid)
+
+  def _fork(self, listener, connection):
+    with self.store.lock:
+      pid = os.fork()
+
+    if pid:
+      connection.close()
+      self.children.add(pid)
+      return
+
+    status = 1
+    try:
+      listener.close()
+      status = self._answer(connection)
+    finally:
+      # the parent's exit handlers and buffered output aren't this
+      # process's to run
+      os._exit(status)
+
+  def _answer(self, connection):
+    request = _receive(connection.makefile('rb'))
+    if request is None or request[0] != 'q':
+      return 1
+
+    arguments = request[1].split('\0')
+    stdout = sys.stdout = _Channel(connection, 'o', CHANNEL_BYTES)
+    stderr = sys.stderr = _Channel(connection, 'e')
+    try:
+      os.chdir(arguments[0])
+      self.answer(arguments[1:], self.store)
+      status = 0
+    except SystemExit as ex:
+      if ex.code is None or isinstance(ex.code, int):
+        status = ex.code or 0
+      else:
+        print(ex.code, file=stderr)
+        status = 1
+    except Exception:
+      traceback.print_exc()
+      status = 1
+
+    stdout.flush()
+    stderr.flush()
+    _send(connection, 'x', str(status))
+    return status
+
+def query(path, argv, stdout=None, stderr=None):
+  """Run the command line argv on the server listening at path, writing
+  its output to stdout and stderr. The exit status it ended with."""
+  stdout = stdout or sys.stdout
+  stderr = stderr or sys.stderr
+
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(path)
+    _send(connection, 'q', '\0'.join([os.getcwd()] + list(argv)))
+
+    frames = connection.makefile('rb')
+    while True:
+      frame = _receive(frames)
+      if frame is None:
+        raise socket.error(errno.ECONNRESET, 'The server closed the connection before answering')
+
+      kind, data = frame
+      if kind == 'o':
+        stdout.write(data)
+      elif kind == 'e':
+        stdout.flush()
+        stderr.write(data)
+        stderr.flush()
+      elif kind == 'x':
+        stdout.flush()
+        return int(data)
+
+  finally:
+    connection.close()
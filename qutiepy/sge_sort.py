@@ -0,0 +1,132 @@
+from __future__ import print_function
+
+"""Sort records that may not fit in memory.
+
+Records are gathered until their estimated size reaches the memory budget,
+sorted and, when more are still to come, spilled to a temporary file as a
+run. Spilled records are stored as the index of their row class and the
+raw values of the row, marshalled and compressed a block at a time, which
+keeps runs to a fraction of the size of the log they came from. Once the
+input ends the runs are merged with heapq.merge, only a block of each run is
+in memory at once.
+
+The sort is stable: records with equal keys come out in the order they went
+in, with --reverse as well. Keys are worked out again as the records are
+read back, so they can be any values the row gives, datetimes included."""
+
+import heapq
+import itertools
+import marshal
+import struct
+import sys
+import tempfile
+import zlib
+
+DEFAULT_BUFFER_MB = 256
+
+# records per compressed block of a run, each run being merged holds one
+BLOCK_RECORDS = 256
+
+_LENGTH = struct.Struct('<I')
+
+class Descending(object):
+  """A key ordered backwards, for merging runs sorted in reverse"""
+  __slots__ = ('key',)
+
+  def __init__(self, key):
+    self.key = key
+
+  def __lt__(self, other):
+    return other.key < self.key
+
+  def __eq__(self, other):
+    return self.key == other.key
+
+  def __ne__(self, other):
+    return self.key != other.key
+
+def row_size(row):
+  """Roughly the bytes a row takes up in memory"""
+  raw = row._rawrow
+  return (sys.getsizeof(row) + sys.getsizeof(raw) + sum(itertools.imap(sys.getsizeof, raw))
+    + sys.getsizeof(row._values))
+
+class _Run(object):
+  """A sorted run spilled to a temporary file"""
+
+  def __init__(self, rows, classes, directory):
+    # shared by every run of a sorter, classes are added as they turn up
+    self.classes = classes
+    self.fd = tempfile.TemporaryFile(prefix='qutiepy-sort-', dir=directory)
+    for start in xrange(0, len(rows), BLOCK_RECORDS):
+      block = [(classes.setdefault(type(row), len(classes)), row._rawrow)
+        for row in rows[start:start + BLOCK_RECORDS]]
+      data = zlib.compress(marshal.dumps(block), 1)
+      self.fd.write(_LENGTH.pack(len(data)))
+      self.fd.write(data)
+
+    self.fd.flush()
+
+  def __iter__(self):
+    """The rows of the run in order, it can only be read once"""
+    self.fd.seek(0)
+    classes = None
+    try:
+      while True:
+        header = self.fd.read(_LENGTH.size)
+        if not header:
+          break
+
+        block = marshal.loads(zlib.decompress(self.fd.read(_LENGTH.unpack(header)[0])))
+        if classes is None:
+          classes = dict((index, cls) for cls, index in self.classes.items())
+        for index, raw in block:
+          yield classes[index](raw)
+    finally:
+      self.fd.close()
+
+class ExternalSorter(object):
+  """Sorts rows by key(row) holding about buffer_bytes of them in memory,
+  add() every row then iterate over the sorter for them in order"""
+
+  def __init__(self, key, reverse=False, buffer_bytes=DEFAULT_BUFFER_MB * 2**20, directory=None):
+    self.key = key
+    self.reverse = reverse
+    self.buffer_bytes = buffer_bytes
+    self.directory = directory
+
+    self.rows = []
+    self.size = 0
+    self.runs = []
+    # row class -> the index it is spilled as
+    self.classes = {}
+
+  def add(self, row):
+    self.rows.append(row)
+    self.size += row_size(row)
+    if self.size >= self.buffer_bytes:
+      self._spill()
+
+  def _sorted(self):
+    self.rows.sort(key=self.key, reverse=self.reverse)
+    rows, self.rows, self.size = self.rows, [], 0
+    return rows
+
+  def _spill(self):
+    self.runs.append(_Run(self._sorted(), self.classes, self.directory))
+
+  def _decorated(self, number, rows):
+    key = self.key
+    if self.reverse:
+      return ((Descending(key(row)), number, position, row) for position, row in enumerate(rows))
+    return ((key(row), number, position, row) for position, row in enumerate(rows))
+
+  def __iter__(self):
+    if not self.runs:
+      return iter(self._sorted())
+
+    # what is left in memory is the last run, it doesn't need writing out
+    runs = self.runs + [self._sorted()]
+    self.runs = []
+    merged = heapq.merge(*[self._decorated(number, run) for number, run in enumerate(runs)])
+    return (row for key, number, position, row in merged)
@@ -15,6 +15,10 @@ setup(
   author='Seth Sims',
   author_email='xzy3@users.noreply.github.com',
   install_requires=install_requires ,
+  extras_require={
+    'numpy' : ['numpy'],
+    'arrow' : ['pyarrow']
+  },
   packages=find_packages(),
   entry_points={
     'console_scripts' : [
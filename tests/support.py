@@ -0,0 +1,33 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# three records: dave, bob and sethsims
+ACCOUNTING = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'accounting')
+
+class CommandTestCase(unittest.TestCase):
+  """Runs the command line tools against an SGE_ROOT holding ACCOUNTING"""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    common = os.path.join(self.root, 'default', 'common')
+    os.makedirs(common)
+    self.accounting = os.path.join(common, 'accounting')
+    shutil.copy(ACCOUNTING, self.accounting)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def run_entry(self, name, *argv):
+    """(exit status, stdout, stderr) of running qutiepy.entry.name with argv"""
+    env = dict(os.environ, SGE_ROOT=self.root, SGE_CELL='default')
+    process = subprocess.Popen([sys.executable, '-c',
+        'import sys; from qutiepy.entry.{0} import main; sys.argv[0] = "{0}"; main()'.format(name)] + list(argv),
+      cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
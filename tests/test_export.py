@@ -0,0 +1,21 @@
+import unittest
+
+from support import CommandTestCase
+
+class ExportCsvTest(CommandTestCase):
+  def test_header_follows_earlier_output(self):
+    status, stdout, stderr = self.run_entry('qutiepy', '-s', '-i', self.accounting,
+      'format', '{owner}', 'export', '--as', 'csv', '--fields', 'owner,job_number')
+    self.assertEqual(status, 0, stderr)
+    self.assertEqual(stdout.splitlines(), [
+      'dave', 'bob', 'sethsims',
+      'owner,job_number', 'dave,1000', 'bob,1001', 'sethsims,1002'])
+
+  def test_header_without_records(self):
+    status, stdout, stderr = self.run_entry('qutiepy', '-s', '-i', self.accounting,
+      'filter', '(owner=nobody)', 'export', '--as', 'csv', '--fields', 'owner')
+    self.assertEqual(status, 0, stderr)
+    self.assertEqual(stdout.splitlines(), ['owner'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,37 @@
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+import qutiepy.sge_follow as sge_follow
+from support import ACCOUNTING
+
+class FollowerTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'accounting')
+    shutil.copy(ACCOUNTING, self.path)
+    self.read_bytes = sge_follow.READ_BYTES
+
+  def tearDown(self):
+    sge_follow.READ_BYTES = self.read_bytes
+    shutil.rmtree(self.directory)
+
+  def follow(self, count):
+    follower = sge_follow.AccountingFollower(self.path, 0)
+    try:
+      return [row.owner for row in itertools.islice(follower, count)]
+    finally:
+      follower.fd.close()
+
+  def test_reads_records(self):
+    self.assertEqual(self.follow(3), ['dave', 'bob', 'sethsims'])
+
+  def test_line_longer_than_a_read(self):
+    # every line of the file is longer than a read
+    sge_follow.READ_BYTES = 16
+    self.assertEqual(self.follow(3), ['dave', 'bob', 'sethsims'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+import signal
+import unittest
+
+from qutiepy.sge_parallel import windowed_map
+
+def _square(n):
+  return n * n
+
+def _fail(n):
+  if n == 3:
+    raise ValueError('task {0} failed'.format(n))
+  return n
+
+def _die(n):
+  if n == 3:
+    os.kill(os.getpid(), signal.SIGKILL)
+  return n
+
+class WindowedMapTest(unittest.TestCase):
+  def setUp(self):
+    self.pool = multiprocessing.Pool(2)
+
+  def tearDown(self):
+    self.pool.terminate()
+    self.pool.join()
+
+  def test_ordered(self):
+    self.assertEqual(list(windowed_map(self.pool, _square, range(20), 4)), [n * n for n in range(20)])
+
+  def test_unordered(self):
+    self.assertEqual(sorted(windowed_map(self.pool, _square, range(20), 4, False)), [n * n for n in range(20)])
+
+  def test_worker_exception_is_raised(self):
+    with self.assertRaisesRegexp(ValueError, 'task 3 failed'):
+      list(windowed_map(self.pool, _fail, range(10), 4))
+
+  def test_dead_worker_is_raised(self):
+    with self.assertRaises(RuntimeError):
+      list(windowed_map(self.pool, _die, range(10), 4))
+
+if __name__ == '__main__':
+  unittest.main()
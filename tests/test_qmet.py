@@ -0,0 +1,18 @@
+import unittest
+
+from support import CommandTestCase
+
+class QmetFormatTest(CommandTestCase):
+  def test_known_field(self):
+    status, stdout, stderr = self.run_entry('qmet', '--owner', 'dave', '--format', '$owner $job_name')
+    self.assertEqual(status, 0)
+    self.assertEqual(stdout, 'dave job_23\n')
+
+  def test_unknown_field(self):
+    status, stdout, stderr = self.run_entry('qmet', '--format', '$nope')
+    self.assertEqual(status, 2)
+    self.assertIn('Malformed format option', stderr)
+    self.assertNotIn('Traceback', stderr)
+
+if __name__ == '__main__':
+  unittest.main()